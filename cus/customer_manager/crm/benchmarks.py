@@ -0,0 +1,143 @@
+"""
+Request benchmarks for the crm views (``manage.py benchmark_crm``).
+
+Each scenario issues the same request a number of times through the Django
+test client and reports latency percentiles and query counts, so runs can be
+compared across commits. Scenarios that write run inside a transaction that
+is rolled back, with uploads stored in a temporary MEDIA_ROOT, so the
+benchmark leaves the database as it found it.
+"""
+import random
+import shutil
+import tempfile
+from io import BytesIO
+from time import perf_counter
+
+from django.conf import settings
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.db import connection, transaction
+from django.test import Client, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from PIL import Image
+
+from .models import Customer
+
+PERCENTILES = (50, 90, 95, 99)
+
+
+def percentile(values, pct):
+    """Linear-interpolated percentile of ``values`` (sorted)."""
+    if not values:
+        return None
+    position = (len(values) - 1) * pct / 100
+    lower = int(position)
+    upper = min(lower + 1, len(values) - 1)
+    return values[lower] + (values[upper] - values[lower]) * (position - lower)
+
+
+def image_receipt():
+    buffer = BytesIO()
+    Image.new('RGB', (800, 600), 'white').save(buffer, format='PNG')
+    return SimpleUploadedFile('receipt.png', buffer.getvalue(), content_type='image/png')
+
+
+def scenarios(rng, customer_ids, search_terms):
+    """Scenario name -> (callable(client) returning a response, writes?)."""
+    def customer_list(client):
+        return client.get(reverse('customer_list'))
+
+    def customer_list_search(client):
+        return client.get(reverse('customer_list'), {'search': rng.choice(search_terms)})
+
+    def customer_detail(client):
+        return client.get(reverse('customer_detail', args=[rng.choice(customer_ids)]))
+
+    def invoice_create(client):
+        customer_id = rng.choice(customer_ids)
+        return client.post(
+            reverse('invoice_create', args=[customer_id]),
+            {'customer': customer_id, 'amount': '250.00', 'receipt': image_receipt()},
+        )
+
+    def message_schedule(client):
+        customer_id = rng.choice(customer_ids)
+        return client.post(reverse('message_schedule', args=[customer_id]), {
+            'customer': customer_id, 'message_content': 'Benchmark reminder',
+            'message_type': 'SMS', 'days_from_today': 3,
+        })
+
+    return {
+        'customer_list': (customer_list, False),
+        'customer_list_search': (customer_list_search, False),
+        'customer_detail': (customer_detail, False),
+        'invoice_create': (invoice_create, True),
+        'message_schedule': (message_schedule, True),
+    }
+
+
+def _measure(client, request, writes):
+    with CaptureQueriesContext(connection) as queries:
+        start = perf_counter()
+        if writes:
+            with transaction.atomic():
+                response = request(client)
+                transaction.set_rollback(True)
+        else:
+            response = request(client)
+        elapsed = perf_counter() - start
+    return elapsed, len(queries), response.status_code
+
+
+def _summarize(timings, query_counts, statuses):
+    timings = sorted(timings)
+    summary = {f'p{pct}_ms': round(percentile(timings, pct) * 1000, 2) for pct in PERCENTILES}
+    summary.update({
+        'mean_ms': round(sum(timings) / len(timings) * 1000, 2),
+        'min_ms': round(timings[0] * 1000, 2),
+        'max_ms': round(timings[-1] * 1000, 2),
+        'queries_min': min(query_counts),
+        'queries_max': max(query_counts),
+        'statuses': sorted(set(statuses)),
+    })
+    return summary
+
+
+def run_benchmarks(iterations=50, warmup=5, only=None, random_seed=0):
+    """Run the scenarios and return a JSON-serializable report."""
+    rng = random.Random(random_seed)
+    customer_ids = list(Customer.objects.order_by('?').values_list('id', flat=True)[:1000])
+    if not customer_ids:
+        raise ValueError("There are no customers to benchmark against; run seed_crm first.")
+    search_terms = [name.split()[0] for name in Customer.objects.filter(id__in=customer_ids[:50])
+                    .values_list('name', flat=True)]
+    client = Client()
+    media_root = tempfile.mkdtemp()
+    # Receipt conversion runs in the rolled-back transaction's on_commit, i.e. never
+    settings_override = override_settings(
+        ALLOWED_HOSTS=[*settings.ALLOWED_HOSTS, 'testserver'], MEDIA_ROOT=media_root, CRM_TASKS_INLINE=True,
+    )
+    settings_override.enable()
+    results = {}
+    try:
+        for name, (request, writes) in scenarios(rng, customer_ids, search_terms).items():
+            if only and name not in only:
+                continue
+            for _ in range(warmup):
+                _measure(client, request, writes)
+            timings, query_counts, statuses = [], [], []
+            for _ in range(iterations):
+                elapsed, queries, status = _measure(client, request, writes)
+                timings.append(elapsed)
+                query_counts.append(queries)
+                statuses.append(status)
+            results[name] = _summarize(timings, query_counts, statuses)
+    finally:
+        settings_override.disable()
+        shutil.rmtree(media_root, ignore_errors=True)
+    return {
+        'customers': Customer.objects.count(),
+        'database': connection.vendor,
+        'iterations': iterations,
+        'results': results,
+    }
@@ -0,0 +1,131 @@
+"""
+Caches for reference data and pre-rendered fragments.
+
+Treatments rarely change but are needed by every CustomerForm render, so they
+are kept in process memory together with the HTML of the empty create-customer
+form. Everything cached here belongs to a version number stored in Django's
+cache (shared between processes when a shared backend is configured). Saving
+or deleting a Treatment bumps the version, and each process drops its local
+copy the next time it sees a new version.
+
+Rows of the customer list are cached in Django's cache itself, keyed on a
+per-customer version that signals replace whenever the customer or its
+unsent messages change (see ``attach_customer_rows``).
+"""
+import threading
+import uuid
+
+from django.conf import settings
+from django.core.cache import cache
+from django.db import transaction
+from django.template.loader import render_to_string
+from django.utils.safestring import mark_safe
+
+from . import metrics
+
+from .models import Treatment
+
+TREATMENT_VERSION_KEY = 'crm:treatment_version'
+
+_state = {'version': None}
+_lock = threading.Lock()
+
+
+def treatment_version():
+    version = cache.get(TREATMENT_VERSION_KEY)
+    if version is None:
+        cache.add(TREATMENT_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+        version = cache.get(TREATMENT_VERSION_KEY)
+    return version
+
+
+def bump_treatment_version():
+    cache.set(TREATMENT_VERSION_KEY, uuid.uuid4().hex, timeout=None)
+
+
+def _cached(key, build):
+    global _state
+    version = treatment_version()
+    state = _state
+    if state['version'] != version:
+        state = {'version': version}
+    if key not in state:
+        with _lock:
+            state[key] = build()
+    _state = state
+    return state[key]
+
+
+def treatment_choices():
+    """``[(id, name), ...]`` of every Treatment, for rendering choice widgets."""
+    return _cached('treatments', lambda: list(Treatment.objects.order_by('id').values_list('id', 'name')))
+
+
+def empty_customer_form_html():
+    """The rendered fields of an unbound CustomerForm (no CSRF token, safe to share)."""
+    from .forms import CustomerForm
+
+    return _cached('empty_customer_form', lambda: render_to_string('crm/form_fields.html', {'form': CustomerForm()}))
+
+
+CUSTOMER_VERSION_KEY = 'crm:customer_version:{}'
+# Bump the key version whenever crm/customer_row.html changes its markup
+CUSTOMER_ROW_KEY = 'crm:customer_row:v2:{}:{}'
+
+
+def bump_customer_versions(customer_ids):
+    """Invalidate the cached list rows of these customers."""
+    customer_ids = list(customer_ids)
+    if not customer_ids:
+        return
+
+    def bump():
+        cache.set_many({CUSTOMER_VERSION_KEY.format(pk): uuid.uuid4().hex for pk in customer_ids}, timeout=None)
+
+    bump()
+    # Inside a transaction, another request may cache the old row before the commit
+    # makes the change visible; bumping again at commit drops that row as well
+    if transaction.get_connection().in_atomic_block:
+        transaction.on_commit(bump)
+
+
+def customer_versions(customer_ids):
+    """``{customer_id: version}``, creating versions for customers that have none yet."""
+    keys = {CUSTOMER_VERSION_KEY.format(pk): pk for pk in customer_ids}
+    found = cache.get_many(keys)
+    versions = {keys[key]: version for key, version in found.items()}
+    for key, pk in keys.items():
+        if key not in found:
+            version = uuid.uuid4().hex
+            # If a write set a version in the meantime, the row this request read may
+            # predate it, so it is left out and rendered without caching
+            if cache.add(key, version, timeout=None):
+                versions[pk] = version
+    return versions
+
+
+def attach_customer_rows(customers):
+    """
+    Set ``customer.row_html`` to the cached customer_list row of each customer,
+    rendering (and caching) only the rows whose version changed.
+
+    Versions and fragments are each fetched with one ``get_many``. The
+    fragment excludes the delete form, whose CSRF token is per user.
+    """
+    versions = customer_versions([customer.id for customer in customers])
+    keys = {customer.id: CUSTOMER_ROW_KEY.format(customer.id, versions[customer.id])
+            for customer in customers if customer.id in versions}
+    cached = cache.get_many(keys.values())
+    rendered = {}
+    for customer in customers:
+        key = keys.get(customer.id)
+        html = cached.get(key) if key else None
+        if html is None:
+            html = render_to_string('crm/customer_row.html', {'customer': customer})
+            if key:
+                rendered[key] = html
+        customer.row_html = mark_safe(html)
+    if rendered:
+        cache.set_many(rendered, timeout=getattr(settings, 'CRM_ROW_CACHE_TIMEOUT', 86400))
+    metrics.registry.count_fragments(hits=len(cached), misses=len(customers) - len(cached))
+    return customers
@@ -0,0 +1,122 @@
+"""
+Bulk messaging campaigns.
+
+``schedule_campaign`` selects the campaign's recipients in id-ordered chunks
+and writes one MessageSchedule per recipient with ``bulk_create``. Schedule
+dates are staggered at ``messages_per_minute`` from the campaign start, so the
+dispatcher picks them up at a steady pace rather than all at once.
+
+The scheduling job touches ``Campaign.updated_at`` with every batch, and only
+while it still holds the campaign: each batch is written with a conditional
+UPDATE on the heartbeat it last wrote. A campaign whose job died part way
+(restart, crash) has fewer messages scheduled than recipients and a stale
+heartbeat; ``resume_campaigns()`` (``manage.py resume_campaigns``) claims it
+the same way and schedules the rest. A job that was only slow finds its claim
+taken at its next batch and stops, so no customer gets the message twice.
+"""
+from datetime import timedelta
+
+from django.db import transaction
+from django.db.models import F
+from django.utils import timezone
+
+from . import search
+from .models import Campaign, Customer, MessageSchedule
+
+
+def campaign_recipients(campaign):
+    customers = Customer.objects.all()
+    if campaign.treatment_id:
+        customers = customers.filter(treatment=campaign.treatment_id)
+    if campaign.min_age is not None:
+        customers = customers.filter(age__gte=campaign.min_age)
+    if campaign.max_age is not None:
+        customers = customers.filter(age__lte=campaign.max_age)
+    if campaign.sex:
+        customers = customers.filter(sex=campaign.sex)
+    if campaign.search:
+        customers = search.filter_customers(customers, campaign.search)
+    return customers
+
+
+def _heartbeat(campaign_id, since, **changes):
+    """Apply ``changes`` unless another job touched the campaign after ``since``; returns the new heartbeat or None."""
+    now = timezone.now()
+    campaigns = Campaign.objects.filter(id=campaign_id)
+    if since is not None:
+        campaigns = campaigns.filter(updated_at=since)
+    return now if campaigns.update(updated_at=now, **changes) else None
+
+
+def schedule_campaign(campaign_id, batch_size=1000, claimed_at=None):
+    """Generate the campaign's messages, updating its progress counters per batch.
+
+    ``claimed_at`` is the heartbeat written when the campaign was claimed for
+    resuming; scheduling stops as soon as another job has claimed it since.
+    """
+    campaign = Campaign.objects.get(id=campaign_id)
+    recipients = campaign_recipients(campaign).order_by('id')
+    heartbeat = _heartbeat(campaign.id, claimed_at, recipient_count=recipients.count())
+
+    position = campaign.scheduled_count
+    last_id = 0
+    if position:
+        # Resume after the last customer that already has a message from this campaign
+        last_id = MessageSchedule.objects.filter(campaign=campaign).order_by('-customer_id').values_list(
+            'customer_id', flat=True
+        ).first() or 0
+    while heartbeat:
+        ids = list(recipients.filter(id__gt=last_id).values_list('id', flat=True)[:batch_size])
+        if not ids:
+            break
+        messages = [
+            MessageSchedule(
+                customer_id=customer_id,
+                campaign=campaign,
+                message_content=campaign.message_content,
+                message_type=campaign.message_type,
+                schedule_date=campaign.start_date + timedelta(
+                    minutes=(position + offset) // campaign.messages_per_minute
+                ),
+            )
+            for offset, customer_id in enumerate(ids)
+        ]
+        with transaction.atomic():
+            heartbeat = _heartbeat(
+                campaign.id, heartbeat, scheduled_count=F('scheduled_count') + len(messages),
+            )
+            if not heartbeat:
+                break
+            MessageSchedule.objects.bulk_create(messages)
+        position += len(messages)
+        last_id = ids[-1]
+    return position
+
+
+def interrupted_campaigns(older_than=timedelta(minutes=10)):
+    """Campaigns not all scheduled whose job has not reported progress for ``older_than``."""
+    return Campaign.objects.filter(
+        scheduled_count__lt=F('recipient_count'), updated_at__lt=timezone.now() - older_than,
+    )
+
+
+def resume_campaigns(older_than=timedelta(minutes=10), batch_size=1000):
+    """Claim and finish scheduling the interrupted campaigns; returns how many were resumed."""
+    resumed = 0
+    for campaign_id in list(interrupted_campaigns(older_than).order_by('id').values_list('id', flat=True)):
+        # Claim it, like convert_receipt(); another resume (or the original job) may have got there first
+        claimed_at = timezone.now()
+        if interrupted_campaigns(older_than).filter(id=campaign_id).update(updated_at=claimed_at):
+            schedule_campaign(campaign_id, batch_size=batch_size, claimed_at=claimed_at)
+            resumed += 1
+    return resumed
+
+
+def record_sent(messages):
+    """Add dispatched ``messages`` to their campaigns' sent counters."""
+    counts = {}
+    for message in messages:
+        if message.campaign_id:
+            counts[message.campaign_id] = counts.get(message.campaign_id, 0) + 1
+    for campaign_id, count in counts.items():
+        Campaign.objects.filter(id=campaign_id).update(sent_count=F('sent_count') + count)
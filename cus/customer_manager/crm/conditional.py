@@ -0,0 +1,104 @@
+"""
+Conditional GET (ETag / Last-Modified) for the customer pages.
+
+The validators come from one aggregate query over the ``updated_at`` columns
+and row counts (counts catch deletes, which leave no timestamp behind), so a
+reload of an unchanged page is answered with 304 Not Modified without running
+the view. The ETag also covers the CSRF cookie, which is embedded in the page,
+and the Treatment cache version for pages that show treatment names.
+
+The customer list has no Last-Modified: deleting a customer leaves the newest
+``updated_at`` as it was, which only the count in the ETag notices. (Due
+reminders are not part of the page; they are pushed by ``crm.reminders``.)
+Pages are sent with ``Cache-Control: private, no-cache`` so browsers always
+revalidate instead of reusing them on a heuristic.
+"""
+import hashlib
+from functools import wraps
+
+from django.conf import settings
+from django.contrib.messages import get_messages
+from django.db.models import Count, Max, OuterRef, Subquery, Value
+from django.utils.cache import patch_cache_control
+from django.views.decorators.http import condition
+
+from . import caching
+from .models import Customer, Invoice, MessageSchedule
+
+
+def _aggregate(queryset, aggregate):
+    """``aggregate`` over ``queryset`` as a scalar subquery (no GROUP BY, one row)."""
+    return Subquery(queryset.order_by().annotate(_all=Value(1)).values('_all').annotate(value=aggregate).values('value'))
+
+
+def _cached_state(request, key, compute):
+    # condition() asks for the ETag and the Last-Modified separately; query once
+    states = request.__dict__.setdefault('_crm_conditional_state', {})
+    if key not in states:
+        states[key] = compute()
+    return states[key]
+
+
+def _etag(request, *parts):
+    # A pending flash message is shown once; the page has to be rendered for it
+    if len(get_messages(request)):
+        return None
+    parts += (request.COOKIES.get(settings.CSRF_COOKIE_NAME),)
+    return 'W/"%s"' % hashlib.sha1(repr(parts).encode()).hexdigest()
+
+
+def customer_list_state():
+    messages = MessageSchedule.objects.all()
+    return Customer.objects.order_by().annotate(_all=Value(1)).values('_all').annotate(
+        customers=Count('id'),
+        customers_updated=Max('updated_at'),
+        messages=_aggregate(messages, Count('id')),
+        messages_updated=_aggregate(messages, Max('updated_at')),
+    ).values_list('customers', 'customers_updated', 'messages', 'messages_updated').get()
+
+
+def customer_list_etag(request, *args, **kwargs):
+    return _etag(request, _cached_state(request, 'customer_list', customer_list_state))
+
+
+def customer_detail_state(customer_id):
+    """``(etag parts, last modified)``, or None for an unknown customer."""
+    invoices = Invoice.objects.filter(customer=OuterRef('pk'))
+    messages = MessageSchedule.objects.filter(customer=OuterRef('pk'))
+    row = Customer.objects.filter(id=customer_id).annotate(
+        invoices=_aggregate(invoices, Count('id')),
+        invoices_updated=_aggregate(invoices, Max('updated_at')),
+        messages=_aggregate(messages, Count('id')),
+        messages_updated=_aggregate(messages, Max('updated_at')),
+    ).values_list('updated_at', 'invoices', 'invoices_updated', 'messages', 'messages_updated').first()
+    if row is None:
+        return None
+    return row, max(value for value in (row[0], row[2], row[4]) if value is not None)
+
+
+def customer_detail_etag(request, customer_id):
+    state = _cached_state(request, 'customer_detail', lambda: customer_detail_state(customer_id))
+    if state is None:
+        return None
+    return _etag(request, state[0], caching.treatment_version())
+
+
+def customer_detail_last_modified(request, customer_id):
+    state = _cached_state(request, 'customer_detail', lambda: customer_detail_state(customer_id))
+    if state is None or len(get_messages(request)):
+        return None
+    return state[1]
+
+
+def conditional_page(etag_func, last_modified_func=None):
+    """``condition()`` plus ``Cache-Control: private, no-cache`` on the response."""
+    def decorator(view):
+        conditional_view = condition(etag_func=etag_func, last_modified_func=last_modified_func)(view)
+
+        @wraps(view)
+        def wrapper(request, *args, **kwargs):
+            response = conditional_view(request, *args, **kwargs)
+            patch_cache_control(response, private=True, no_cache=True)
+            return response
+        return wrapper
+    return decorator
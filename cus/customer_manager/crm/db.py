@@ -0,0 +1,35 @@
+"""
+Per-connection database setup.
+
+SQLite connections get ``DEFAULT_SQLITE_PRAGMAS`` (or the
+``CRM_SQLITE_PRAGMAS`` setting, which replaces them) when they are opened:
+WAL lets readers run while a write is in progress, ``busy_timeout`` makes a
+writer wait for the lock instead of failing with "database is locked", and
+``synchronous=NORMAL`` (safe under WAL) avoids an fsync on every commit.
+``mmap_size`` and ``cache_size`` keep hot pages in memory.
+
+With persistent connections (``CONN_MAX_AGE``) this runs once per connection,
+not once per request.
+"""
+from django.conf import settings
+from django.db.backends.signals import connection_created
+from django.dispatch import receiver
+
+DEFAULT_SQLITE_PRAGMAS = {
+    'journal_mode': 'WAL',
+    'busy_timeout': 5000,       # milliseconds
+    'synchronous': 'NORMAL',
+    'mmap_size': 268435456,     # 256 MiB
+    'cache_size': -20000,       # negative: KiB, so about 20 MB
+}
+
+
+@receiver(connection_created)
+def configure_connection(sender, connection, **kwargs):
+    if connection.vendor != 'sqlite':
+        return
+    pragmas = getattr(settings, 'CRM_SQLITE_PRAGMAS', DEFAULT_SQLITE_PRAGMAS)
+    with connection.cursor() as cursor:
+        for name, value in pragmas.items():
+            # In-memory databases (the test database) keep journal_mode=memory
+            cursor.execute(f'PRAGMA {name} = {value}')
@@ -0,0 +1,155 @@
+"""
+Database-backed dispatcher for scheduled messages.
+
+Due ``MessageSchedule`` rows are claimed in batches with a conditional UPDATE,
+so several dispatcher processes can run side by side without sending the same
+message twice. Claimed rows are handed to the configured send backend and the
+ones it accepted are marked ``is_sent`` in a single UPDATE. A claim that is
+never completed (e.g. the worker crashed) expires after
+``CRM_DISPATCH_CLAIM_TIMEOUT`` seconds and the row becomes claimable again.
+
+Run it with ``python manage.py dispatch_messages``.
+"""
+import logging
+import time
+import uuid
+from datetime import timedelta
+
+from django.conf import settings
+from django.db.models import Q
+from django.utils import timezone
+from django.utils.module_loading import import_string
+
+from . import campaigns, providers
+from .models import MessageSchedule
+
+logger = logging.getLogger(__name__)
+
+
+class BaseMessageBackend:
+    """Send backends take a list of claimed messages and return the ids they sent."""
+
+    def send_messages(self, messages):
+        raise NotImplementedError('subclasses of BaseMessageBackend must override send_messages()')
+
+
+class ConsoleBackend(BaseMessageBackend):
+    """Print messages instead of sending them (local development)."""
+
+    def send_messages(self, messages):
+        for message in messages:
+            print(f"Sending {message.message_type} to {message.customer.phone_number}: {message.message_content}")
+        return [message.id for message in messages]
+
+
+# Messages "sent" by the LocMemBackend, for tests
+outbox = []
+
+
+class LocMemBackend(BaseMessageBackend):
+    """Keep sent messages in ``crm.dispatch.outbox`` (tests)."""
+
+    def send_messages(self, messages):
+        outbox.extend(messages)
+        return [message.id for message in messages]
+
+
+class ProviderBackend(BaseMessageBackend):
+    """
+    Send through the configured SMS/WhatsApp provider (see ``crm.providers``).
+
+    Sends nothing while no ``CRM_PROVIDER['BASE_URL']`` is set: the messages
+    stay unsent until a provider is configured. Use the ConsoleBackend to
+    print them in local development.
+    """
+
+    def send_messages(self, messages):
+        client = providers.get_client()
+        if client is None:
+            logger.warning("No message provider configured; %d message(s) were not sent", len(messages))
+            return []
+        by_ref = {str(message.id): message.id for message in messages}
+        accepted = client.send([
+            providers.outbound(message.id, message.customer.phone_digits, message.message_type, message.message_content)
+            for message in messages
+        ])
+        return [by_ref[ref] for ref in accepted if ref in by_ref]
+
+
+def get_backend(path=None):
+    return import_string(path or getattr(settings, 'CRM_MESSAGE_BACKEND', 'crm.dispatch.ConsoleBackend'))()
+
+
+def claimable_messages(now):
+    timeout = getattr(settings, 'CRM_DISPATCH_CLAIM_TIMEOUT', 600)
+    # Messages of a deleted customer are never sent, even before the purge removes them
+    return MessageSchedule.objects.filter(is_sent=False, schedule_date__lte=now, customer__deleted_at__isnull=True).filter(
+        Q(claimed_at__isnull=True) | Q(claimed_at__lt=now - timedelta(seconds=timeout))
+    )
+
+
+def claim_due_messages(batch_size=100, now=None):
+    """
+    Claim up to ``batch_size`` due messages and return them.
+
+    The UPDATE repeats the claimable filter, so rows another worker claimed in
+    the meantime are skipped instead of being claimed twice.
+    """
+    now = now or timezone.now()
+    token = uuid.uuid4().hex
+    ids = list(
+        claimable_messages(now).order_by('schedule_date', 'id').values_list('id', flat=True)[:batch_size]
+    )
+    if not ids:
+        return []
+    claimable_messages(now).filter(id__in=ids).update(claimed_at=now, claim_token=token)
+    return list(MessageSchedule.objects.filter(claim_token=token).select_related('customer'))
+
+
+def dispatch_batch(backend, batch_size=100, now=None):
+    """Claim and send one batch. Returns ``(sent, failed)`` counts."""
+    messages = claim_due_messages(batch_size, now=now)
+    if not messages:
+        return 0, 0
+    token = messages[0].claim_token
+    claimed_ids = [message.id for message in messages]
+    try:
+        sent_ids = set(backend.send_messages(messages))
+    except Exception:
+        logger.exception("Message backend failed to send a batch of %d messages", len(messages))
+        sent_ids = set()
+    failed_ids = [pk for pk in claimed_ids if pk not in sent_ids]
+
+    MessageSchedule.objects.filter(id__in=sent_ids, claim_token=token).update(is_sent=True, claim_token='')
+    campaigns.record_sent([message for message in messages if message.id in sent_ids])
+    # Release the rest so the next run retries them
+    MessageSchedule.objects.filter(id__in=failed_ids, claim_token=token).update(claimed_at=None, claim_token='')
+    return len(sent_ids), len(failed_ids)
+
+
+def dispatch_due_messages(backend=None, batch_size=100, now=None, rate=None):
+    """
+    Send everything that is due right now. Returns ``(sent, failed)`` counts.
+
+    ``rate`` caps the send rate in messages per second (defaults to
+    ``CRM_DISPATCH_RATE``; None means unlimited).
+    """
+    backend = backend or get_backend()
+    if rate is None:
+        rate = getattr(settings, 'CRM_DISPATCH_RATE', None)
+    if rate:
+        batch_size = min(batch_size, max(1, int(rate)))
+    started = time.monotonic()
+    total_sent = total_failed = 0
+    while True:
+        sent, failed = dispatch_batch(backend, batch_size, now=now)
+        total_sent += sent
+        total_failed += failed
+        # Failed rows are released and would be re-claimed at once, so stop on any failure
+        if not sent or failed:
+            return total_sent, total_failed
+        if rate:
+            # Hold back until the average rate since the start is under the limit
+            delay = total_sent / rate - (time.monotonic() - started)
+            if delay > 0:
+                time.sleep(delay)
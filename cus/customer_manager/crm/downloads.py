@@ -0,0 +1,110 @@
+"""
+Serving stored files (receipts) from views.
+
+With ``CRM_SENDFILE = 'x-sendfile'`` (Apache mod_xsendfile, lighttpd) or
+``'x-accel-redirect'`` (nginx, with ``CRM_SENDFILE_PREFIX`` mapped to an
+internal location over MEDIA_ROOT) the view only checks access and names the
+file; the web server sends it, so a large PDF does not hold a Python worker.
+Otherwise the file is streamed with ``FileResponse``, honouring single byte
+ranges (``Range``/``If-Range``) so downloads can resume.
+
+Stored names never change content (see ``crm.storage``), so responses carry
+a strong ETag taken from the name. The receipt URL is per invoice, though, and
+the invoice's receipt can be replaced, so browsers must revalidate
+(``private, no-cache``): an unchanged receipt costs a 304, a replaced one is
+fetched again.
+"""
+import mimetypes
+import os
+import re
+
+from django.conf import settings
+from django.http import FileResponse, HttpResponse
+from django.utils.cache import get_conditional_response
+from django.utils.http import content_disposition_header
+
+RANGE_RE = re.compile(r'^bytes=(\d*)-(\d*)$')
+CACHE_CONTROL = 'private, no-cache'
+
+
+def parse_range(header, size):
+    """``(start, end)`` (inclusive) for a single-range header, None to send everything, or 'invalid'."""
+    match = RANGE_RE.match(header.strip()) if header else None
+    if not match or not any(match.groups()):
+        # Absent, malformed or multiple ranges: a full response is always allowed
+        return None
+    start, end = match.groups()
+    if not start:
+        # Suffix range: the last N bytes
+        length = int(end)
+        if not length:
+            return 'invalid'
+        return max(size - length, 0), size - 1
+    start = int(start)
+    if end and int(end) < start:
+        # Syntactically invalid (RFC 9110, 14.1.1): ignore the header
+        return None
+    if start >= size:
+        return 'invalid'
+    return start, min(int(end), size - 1) if end else size - 1
+
+
+class RangeFile:
+    """File wrapper yielding bytes ``start``..``end`` in chunks (closed by FileResponse)."""
+
+    def __init__(self, file, start, end, chunk_size=64 * 1024):
+        self.file = file
+        self.remaining = end - start + 1
+        self.chunk_size = chunk_size
+        file.seek(start)
+
+    def __iter__(self):
+        while self.remaining > 0:
+            chunk = self.file.read(min(self.chunk_size, self.remaining))
+            if not chunk:
+                break
+            self.remaining -= len(chunk)
+            yield chunk
+
+    def close(self):
+        self.file.close()
+
+
+def file_response(request, storage, name, filename):
+    """Respond with the stored file ``name``, downloaded as ``filename``."""
+    etag = '"%s"' % os.path.splitext(os.path.basename(name))[0]
+    not_modified = get_conditional_response(request, etag=etag)
+    if not_modified is not None:
+        not_modified['Cache-Control'] = CACHE_CONTROL
+        return not_modified
+
+    content_type = mimetypes.guess_type(filename)[0] or 'application/octet-stream'
+    sendfile = getattr(settings, 'CRM_SENDFILE', None)
+    if sendfile:
+        response = HttpResponse(content_type=content_type)
+        if sendfile == 'x-accel-redirect':
+            response['X-Accel-Redirect'] = getattr(settings, 'CRM_SENDFILE_PREFIX', '/protected-media/') + name
+        else:
+            response['X-Sendfile'] = storage.path(name)
+    else:
+        size = storage.size(name)
+        byte_range = None
+        if request.method == 'GET' and request.headers.get('If-Range', etag) == etag:
+            byte_range = parse_range(request.headers.get('Range'), size)
+        if byte_range == 'invalid':
+            response = HttpResponse(status=416)
+            response['Content-Range'] = f'bytes */{size}'
+            return response
+        file = storage.open(name, 'rb')
+        if byte_range is None:
+            response = FileResponse(file, content_type=content_type)
+        else:
+            start, end = byte_range
+            response = FileResponse(RangeFile(file, start, end), status=206, content_type=content_type)
+            response['Content-Range'] = f'bytes {start}-{end}/{size}'
+            response['Content-Length'] = str(end - start + 1)
+        response['Accept-Ranges'] = 'bytes'
+    response['Content-Disposition'] = content_disposition_header(False, filename)
+    response['ETag'] = etag
+    response['Cache-Control'] = CACHE_CONTROL
+    return response
@@ -0,0 +1,120 @@
+"""
+Merging customers registered more than once (``manage.py merge_duplicate_customers``).
+
+A shared phone number alone does not make two records the same person:
+family members often share a household line. Customers with the same
+normalized phone number (``Customer.phone_digits``) are only merged when
+their name or their email also matches; the oldest record takes over the
+others' invoices, messages (archived ones too) and treatments, and the
+others are deleted. Phone numbers still shared by different people
+afterwards are reported for a human to look at.
+"""
+from collections import defaultdict
+
+from django.db import transaction
+from django.db.models import Count
+from django.utils import timezone
+
+from . import rollups
+from .models import ArchivedMessageSchedule, Customer, Invoice, MessageSchedule
+
+
+def duplicate_groups():
+    """Phone numbers shared by more than one customer, with the customer count."""
+    return (
+        Customer.objects.exclude(phone_digits='').values('phone_digits')
+        .annotate(customers=Count('id')).filter(customers__gt=1).order_by('phone_digits')
+    )
+
+
+def merge_customers(keeper_id, duplicate_ids):
+    """Move everything of the ``duplicate_ids`` customers to ``keeper_id`` and delete them."""
+    Through = Customer.treatment.through
+    with transaction.atomic():
+        treatments = defaultdict(set)
+        for customer_id, treatment_id in Through.objects.filter(
+            customer_id__in=[keeper_id, *duplicate_ids],
+        ).values_list('customer_id', 'treatment_id'):
+            treatments[customer_id].add(treatment_id)
+        merged_treatments = set().union(*treatments.values())
+        # m2m_changed moves the keeper's own revenue to the added treatments
+        Customer.objects.get(id=keeper_id).treatment.add(*merged_treatments - treatments[keeper_id])
+
+        # QuerySet.update() skips the Invoice signals; move the revenue explicitly
+        invoices = Invoice.objects.filter(customer_id__in=duplicate_ids)
+        changes = []
+        for customer_id, date_created, amount in invoices.values_list('customer_id', 'date_created', 'amount'):
+            day = timezone.localdate(date_created)
+            changes.append((day, customer_id, treatments[customer_id], amount, -1))
+            changes.append((day, keeper_id, merged_treatments, amount, 1))
+        rollups.apply(changes)
+        invoices.update(customer_id=keeper_id)
+        MessageSchedule.objects.filter(customer_id__in=duplicate_ids).update(customer_id=keeper_id)
+        ArchivedMessageSchedule.objects.filter(customer_id__in=duplicate_ids).update(customer_id=keeper_id)
+        Customer.objects.filter(id__in=duplicate_ids).delete()
+
+
+def _normalized(value):
+    return ' '.join((value or '').split()).casefold()
+
+
+def _same_person(a, b):
+    (_, name_a, email_a), (_, name_b, email_b) = a, b
+    return any(
+        value and value == _normalized(other)
+        for value, other in ((_normalized(name_a), name_b), (_normalized(email_a), email_b))
+    )
+
+
+def same_person_clusters(members):
+    """Split ``(id, name, email)`` rows sharing a phone number into people, oldest first.
+
+    Rows belong to the same person when their name (ignoring case and
+    spacing) or their email (ignoring case) matches.
+    """
+    clusters = []
+    for member in members:
+        matching = [cluster for cluster in clusters if any(_same_person(member, other) for other in cluster)]
+        clusters = [cluster for cluster in clusters if cluster not in matching]
+        clusters.append(sorted([member, *(other for cluster in matching for other in cluster)]))
+    return sorted(clusters)
+
+
+def phone_groups(batch_size=100):
+    """Yield ``(phone_digits, clusters)`` for every phone number shared by several customers."""
+    last = ''
+    while True:
+        batch = list(
+            duplicate_groups().filter(phone_digits__gt=last).values_list('phone_digits', flat=True)[:batch_size]
+        )
+        if not batch:
+            return
+        members = defaultdict(list)
+        for phone_digits, *member in Customer.objects.filter(phone_digits__in=batch).order_by('id').values_list(
+            'phone_digits', 'id', 'name', 'email',
+        ):
+            members[phone_digits].append(tuple(member))
+        for phone_digits in batch:
+            yield phone_digits, same_person_clusters(members[phone_digits])
+        last = batch[-1]
+
+
+def merge_duplicates(batch_size=100):
+    """Merge every customer registered more than once.
+
+    Returns ``(customers kept, customers removed, to review)``, the last being
+    the ``(phone_digits, clusters)`` of phone numbers still shared by
+    different people.
+    """
+    kept = removed = 0
+    review = []
+    for phone_digits, clusters in phone_groups(batch_size):
+        with transaction.atomic():
+            for (keeper_id, *_), *duplicates in clusters:
+                if duplicates:
+                    merge_customers(keeper_id, [pk for pk, *_ in duplicates])
+                    kept += 1
+                    removed += len(duplicates)
+        if len(clusters) > 1:
+            review.append((phone_digits, [cluster[:1] for cluster in clusters]))
+    return kept, removed, review
@@ -0,0 +1,87 @@
+"""
+Streaming CSV exports of customers, invoices and scheduled messages.
+
+Rows are read with ``values_list().iterator(chunk_size=...)`` so no model
+instances are built and only one chunk is held in memory at a time. Customer
+treatments are fetched with one query per chunk rather than one per customer.
+The generators yield CSV text, ready for ``StreamingHttpResponse`` or a file.
+Deleted customers are left out, and so are their invoices and messages while
+they wait for the purge (see ``crm.purge``).
+"""
+import csv
+from collections import defaultdict
+from itertools import islice
+
+from django.db.models import Value
+
+from .models import ArchivedMessageSchedule, Customer, Invoice, MessageSchedule
+
+DEFAULT_CHUNK_SIZE = 2000
+
+
+class Echo:
+    """File-like object whose write() returns the value, so csv.writer yields lines."""
+
+    def write(self, value):
+        return value
+
+
+def _chunks(iterator, size):
+    while True:
+        chunk = list(islice(iterator, size))
+        if not chunk:
+            return
+        yield chunk
+
+
+def customer_rows(chunk_size=DEFAULT_CHUNK_SIZE):
+    yield ('id', 'name', 'email', 'phone_number', 'address', 'problem', 'age', 'sex', 'treatments')
+    rows = Customer.objects.order_by('id').values_list(
+        'id', 'name', 'email', 'phone_number', 'address', 'problem', 'age', 'sex'
+    ).iterator(chunk_size=chunk_size)
+    for chunk in _chunks(rows, chunk_size):
+        treatments = defaultdict(list)
+        through = Customer.treatment.through.objects.filter(
+            customer_id__in=[row[0] for row in chunk]
+        ).order_by('customer_id', 'treatment__name').values_list('customer_id', 'treatment__name')
+        for customer_id, name in through:
+            treatments[customer_id].append(name)
+        for row in chunk:
+            yield row + ('; '.join(treatments[row[0]]),)
+
+
+def invoice_rows(chunk_size=DEFAULT_CHUNK_SIZE):
+    fields = ('id', 'customer_id', 'customer__name', 'amount', 'date_created', 'receipt')
+    yield fields
+    yield from Invoice.objects.filter(customer__deleted_at__isnull=True).order_by('id').values_list(
+        *fields,
+    ).iterator(chunk_size=chunk_size)
+
+
+def message_rows(chunk_size=DEFAULT_CHUNK_SIZE):
+    fields = (
+        'id', 'customer_id', 'customer__name', 'message_type', 'schedule_date',
+        'is_sent', 'is_reminder_sent', 'message_content',
+    )
+    yield fields
+    yield from MessageSchedule.objects.filter(customer__deleted_at__isnull=True).order_by('id').values_list(
+        *fields,
+    ).iterator(chunk_size=chunk_size)
+    # Archived messages (see crm.archive) are all sent and acknowledged
+    yield from ArchivedMessageSchedule.objects.filter(customer__deleted_at__isnull=True).annotate(
+        is_sent=Value(True), is_reminder_sent=Value(True),
+    ).order_by('id').values_list(*fields).iterator(chunk_size=chunk_size)
+
+
+EXPORTS = {
+    'customers': customer_rows,
+    'invoices': invoice_rows,
+    'messages': message_rows,
+}
+
+
+def stream_csv(table, chunk_size=DEFAULT_CHUNK_SIZE):
+    """Yield the CSV lines of one of the ``EXPORTS`` tables."""
+    writer = csv.writer(Echo())
+    for row in EXPORTS[table](chunk_size):
+        yield writer.writerow(row)
@@ -1,10 +1,14 @@
 from django import forms
-from .models import Customer, Treatment, Invoice, MessageSchedule
+from .models import Campaign, Customer, Treatment, Invoice, MessageSchedule
+from . import caching, phones
+from django.db.models import Q
+from django.db.models.functions import Lower
 from datetime import timedelta
 from django.utils import timezone
 from django.core.validators import validate_email
 from django.core.exceptions import ValidationError
 import imghdr
+import re
 
 def validate_file_type(value):
     allowed_mime_types = ['application/pdf', 'image/jpeg', 'image/png']
@@ -46,6 +50,12 @@ class CustomerForm(forms.ModelForm):
         choices=MessageSchedule.MESSAGE_TYPES,
         label="Message Type"
     )
+    allow_duplicate = forms.BooleanField(
+        required=False, label="Save even if a customer with this phone number or email already exists"
+    )
+
+    # Imports skip the per-row lookup; manage.py merge_duplicate_customers cleans up afterwards
+    check_duplicates = True
 
     class Meta:
         model = Customer
@@ -64,6 +74,62 @@ class CustomerForm(forms.ModelForm):
         label="Treatment",
     )
 
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Render the treatment checkboxes from the reference-data cache instead of
+        # querying the table on every render (validation still uses the queryset)
+        if isinstance(self.fields['treatment'], forms.ModelMultipleChoiceField):
+            self.fields['treatment'].widget.choices = caching.treatment_choices()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if self.check_duplicates and not cleaned_data.get('allow_duplicate'):
+            self.check_for_duplicates(cleaned_data)
+        return cleaned_data
+
+    def check_for_duplicates(self, cleaned_data):
+        # One lookup over the phone_digits and LOWER(email) indexes
+        phone_digits = phones.normalize(cleaned_data.get('phone_number'))
+        email = (cleaned_data.get('email') or '').lower()
+        matches = Q()
+        if phone_digits:
+            matches |= Q(phone_digits=phone_digits)
+        if email:
+            matches |= Q(email_lower=email)
+        if not matches:
+            return
+        duplicates = Customer.objects.alias(email_lower=Lower('email')).filter(matches).exclude(pk=self.instance.pk)
+        for customer in duplicates.only('id', 'name', 'email', 'phone_digits')[:5]:
+            if phone_digits and customer.phone_digits == phone_digits:
+                self.add_error('phone_number', f"{customer.name} (#{customer.id}) already has this phone number.")
+            if email and customer.email.lower() == email:
+                self.add_error('email', f"{customer.name} (#{customer.id}) already has this email.")
+
+class CustomerImportForm(CustomerForm):
+    """One row of a bulk customer import. Treatments are given by name, separated by ';' or ','."""
+    treatment = forms.CharField(required=True, label="Treatment")
+    check_duplicates = False
+
+    def __init__(self, *args, treatments_by_name=None, **kwargs):
+        super().__init__(*args, **kwargs)
+        # Lower-cased treatment name -> Treatment id, looked up once per import
+        self.treatments_by_name = treatments_by_name or {}
+
+    def clean_treatment(self):
+        names = [name.strip() for name in re.split(r'[;,]', self.cleaned_data['treatment']) if name.strip()]
+        unknown = [name for name in names if name.lower() not in self.treatments_by_name]
+        if unknown:
+            raise ValidationError(f"Unknown treatment(s): {', '.join(unknown)}.")
+        if not names:
+            raise ValidationError("At least one treatment is required.")
+        return sorted({self.treatments_by_name[name.lower()] for name in names})
+
+class CustomerImportUploadForm(forms.Form):
+    file = forms.FileField(
+        label="Customer File",
+        help_text="CSV or XLSX with the columns: name, email, phone_number, address, problem, age, sex, treatment.",
+    )
+
 class InvoiceForm(forms.ModelForm):
     receipt = forms.FileField(validators=[validate_file_type], required=True)
 
@@ -74,6 +140,63 @@ class InvoiceForm(forms.ModelForm):
             'customer': forms.HiddenInput()  # Make the customer field hidden
         }
 
+class DateRangeForm(forms.Form):
+    date_from = forms.DateField(
+        required=False, label="From", widget=forms.DateInput(attrs={'type': 'date'})
+    )
+    date_to = forms.DateField(
+        required=False, label="To", widget=forms.DateInput(attrs={'type': 'date'})
+    )
+
+    def clean(self):
+        cleaned_data = super().clean()
+        date_from, date_to = cleaned_data.get('date_from'), cleaned_data.get('date_to')
+        if date_from and date_to and date_from > date_to:
+            raise ValidationError("The start date must be before the end date.")
+        return cleaned_data
+
+class InvoiceEmailBulkForm(DateRangeForm):
+    customer = forms.IntegerField(required=False, widget=forms.HiddenInput())
+
+    def clean(self):
+        cleaned_data = super().clean()
+        # Without any filter every invoice would be emailed
+        if not cleaned_data.get('customer') and not (cleaned_data.get('date_from') and cleaned_data.get('date_to')):
+            if not self.errors:
+                raise ValidationError("Choose a customer or both dates.")
+        return cleaned_data
+
+class ReminderAcknowledgeForm(forms.Form):
+    """Reminders to mark as sent: the listed ids, or every reminder due by ``due_before``."""
+    MAX_IDS = 1000
+
+    message_ids = forms.CharField(required=False, help_text="Comma-separated message ids.")
+    due_before = forms.DateTimeField(required=False)
+
+    def clean_message_ids(self):
+        value = self.cleaned_data['message_ids']
+        try:
+            ids = {int(part) for part in value.split(',') if part.strip()}
+        except ValueError:
+            raise ValidationError("Message ids must be numbers.")
+        if len(ids) > self.MAX_IDS:
+            raise ValidationError(f"At most {self.MAX_IDS} messages can be marked at once.")
+        return sorted(ids)
+
+    def clean(self):
+        cleaned_data = super().clean()
+        if not cleaned_data.get('message_ids') and not cleaned_data.get('due_before') and not self.errors:
+            raise ValidationError("Give the message ids or a due date.")
+        return cleaned_data
+
+    def queryset(self):
+        messages = MessageSchedule.objects.filter(is_reminder_sent=False)
+        if self.cleaned_data['message_ids']:
+            messages = messages.filter(id__in=self.cleaned_data['message_ids'])
+        if self.cleaned_data['due_before']:
+            messages = messages.filter(schedule_date__lte=self.cleaned_data['due_before'], is_sent=False)
+        return messages
+
 class MessageScheduleForm(forms.ModelForm):
     days_from_today = forms.IntegerField(
         min_value=1,
@@ -94,3 +217,29 @@ class MessageScheduleForm(forms.ModelForm):
         if commit:
             instance.save()
         return instance
+
+class CampaignForm(forms.ModelForm):
+    start_date = forms.DateTimeField(
+        label="Start Date",
+        widget=forms.DateTimeInput(attrs={'type': 'datetime-local'}),
+        help_text="The first messages are sent at this time; the rest follow at the rate below.",
+    )
+
+    class Meta:
+        model = Campaign
+        fields = [
+            'name', 'message_content', 'message_type',
+            'treatment', 'min_age', 'max_age', 'sex', 'search',
+            'start_date', 'messages_per_minute',
+        ]
+
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.fields['treatment'].widget.choices = [('', 'Any treatment')] + caching.treatment_choices()
+
+    def clean(self):
+        cleaned_data = super().clean()
+        min_age, max_age = cleaned_data.get('min_age'), cleaned_data.get('max_age')
+        if min_age is not None and max_age is not None and min_age > max_age:
+            raise ValidationError("Minimum age cannot be greater than maximum age.")
+        return cleaned_data
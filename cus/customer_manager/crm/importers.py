@@ -0,0 +1,99 @@
+"""
+Streaming bulk import of customers from CSV or XLSX.
+
+Rows are read one at a time, validated with ``CustomerImportForm`` (the same
+rules as ``CustomerForm``) and inserted with ``bulk_create`` in batches, together
+with their treatment through-rows. Only one batch is held in memory at a time,
+and rejected rows are reported through a callback rather than collected.
+"""
+import csv
+import io
+
+from django.db import transaction
+
+from . import caching, search
+from .forms import CustomerImportForm
+from .models import Customer, Treatment
+
+try:
+    import openpyxl
+except ImportError:
+    openpyxl = None
+
+COLUMNS = ('name', 'email', 'phone_number', 'address', 'problem', 'age', 'sex', 'treatment')
+
+
+def detect_format(filename):
+    return 'xlsx' if filename.lower().endswith('.xlsx') else 'csv'
+
+
+def read_csv(file):
+    """Yield one dict per row of a binary CSV file."""
+    text = io.TextIOWrapper(file, encoding='utf-8-sig', newline='')
+    try:
+        yield from csv.DictReader(text)
+    finally:
+        # Leave the underlying file open for the caller
+        text.detach()
+
+
+def read_xlsx(file):
+    """Yield one dict per row of the first sheet of an XLSX file."""
+    if openpyxl is None:
+        raise ValueError("Importing XLSX files requires the openpyxl package.")
+    workbook = openpyxl.load_workbook(file, read_only=True, data_only=True)
+    try:
+        rows = workbook.worksheets[0].iter_rows(values_only=True)
+        header = [str(cell).strip() if cell is not None else '' for cell in next(rows, ())]
+        for values in rows:
+            yield {key: '' if value is None else str(value) for key, value in zip(header, values)}
+    finally:
+        workbook.close()
+
+
+def read_rows(file, fmt='csv'):
+    return read_xlsx(file) if fmt == 'xlsx' else read_csv(file)
+
+
+def _insert_batch(batch):
+    """Insert ``[(customer, treatment_ids), ...]`` with one query per table."""
+    with transaction.atomic():
+        customers = Customer.objects.bulk_create([customer for customer, _ in batch])
+        Through = Customer.treatment.through
+        Through.objects.bulk_create([
+            Through(customer_id=customer.id, treatment_id=treatment_id)
+            for customer, (_, treatment_ids) in zip(customers, batch)
+            for treatment_id in treatment_ids
+        ])
+        # bulk_create skips the post_save signal that normally indexes customers
+        search.index_customers(customers)
+        caching.bump_customer_versions(customer.id for customer in customers)
+
+
+def import_customers(rows, batch_size=500, on_reject=None):
+    """
+    Import customers from an iterable of dicts keyed by ``COLUMNS``.
+
+    ``on_reject(line_number, errors)`` is called for every invalid row, where
+    ``line_number`` counts the header as line 1. Returns a dict of counts.
+    """
+    treatments_by_name = {name.lower(): pk for pk, name in Treatment.objects.values_list('id', 'name')}
+    created = rejected = 0
+    batch = []
+    for line_number, row in enumerate(rows, start=2):
+        data = {column: (row.get(column) or '').strip() for column in COLUMNS}
+        form = CustomerImportForm(data, treatments_by_name=treatments_by_name)
+        if not form.is_valid():
+            rejected += 1
+            if on_reject:
+                on_reject(line_number, {field: list(errors) for field, errors in form.errors.items()})
+            continue
+        batch.append((form.instance, form.cleaned_data['treatment']))
+        if len(batch) >= batch_size:
+            _insert_batch(batch)
+            created += len(batch)
+            batch = []
+    if batch:
+        _insert_batch(batch)
+        created += len(batch)
+    return {'created': created, 'rejected': rejected}
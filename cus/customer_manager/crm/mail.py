@@ -0,0 +1,97 @@
+"""
+Invoice email delivery.
+
+All invoices are sent over a single connection from ``get_connection()``,
+rather than one ``send_mail()`` (and one SMTP session) per invoice. They are
+read in batches but sent one message at a time, each built (and its receipt
+file read, when it is ready) just before it goes out, so only one attachment
+is held in memory.
+
+An invoice that fails to send is logged to the ``crm.mail`` logger with its
+id and counted as failed; the others are still sent, and the ones already
+sent are not counted as failed.
+"""
+import logging
+import mimetypes
+import os
+
+from django.conf import settings
+from django.core.mail import EmailMessage, get_connection
+
+from .models import Invoice
+
+logger = logging.getLogger(__name__)
+
+
+def invoice_email(invoice):
+    customer = invoice.customer
+    email = EmailMessage(
+        subject=f"Invoice #{invoice.id} from Customer Management App",
+        body=(
+            f"Dear {customer.name},\n\nPlease find the details of your invoice.\n\n"
+            f"Invoice Amount: ${invoice.amount}\nDate: {invoice.date_created}\n\nThank you."
+        ),
+        from_email=getattr(settings, 'CRM_INVOICE_FROM_EMAIL', 'noreply@example.com'),
+        to=[customer.email],
+    )
+    if invoice.receipt and invoice.receipt_status == Invoice.RECEIPT_READY:
+        # Stored names are content digests; name the attachment after the invoice
+        filename = f"invoice-{invoice.id}{os.path.splitext(invoice.receipt.name)[1]}"
+        with invoice.receipt.open('rb') as file:
+            email.attach(filename, file.read(), mimetypes.guess_type(filename)[0] or 'application/octet-stream')
+    return email
+
+
+def invoices_for(customer_id=None, date_from=None, date_to=None, invoice_id=None):
+    # Deleted customers keep their invoices until the purge (crm.purge) removes them
+    invoices = Invoice.objects.filter(customer__deleted_at__isnull=True)
+    if invoice_id:
+        invoices = invoices.filter(id=invoice_id)
+    if customer_id:
+        invoices = invoices.filter(customer_id=customer_id)
+    if date_from:
+        invoices = invoices.filter(date_created__date__gte=date_from)
+    if date_to:
+        invoices = invoices.filter(date_created__date__lte=date_to)
+    return invoices
+
+
+def send_invoice_emails(invoices, batch_size=100):
+    """Email every invoice in ``invoices`` over one connection. Returns ``(sent, failed)`` counts.
+
+    ``batch_size`` is the number of invoices read per query.
+    """
+    invoices = invoices.select_related('customer').order_by('id')
+    sent = failed = 0
+    last_id = 0
+    with get_connection() as connection:
+        while True:
+            batch = list(invoices.filter(id__gt=last_id)[:batch_size])
+            if not batch:
+                return sent, failed
+            last_id = batch[-1].id
+            for invoice in batch:
+                try:
+                    accepted = connection.send_messages([invoice_email(invoice)])
+                except Exception:
+                    logger.exception("Failed to email invoice %s", invoice.id)
+                    accepted = 0
+                if accepted:
+                    sent += 1
+                else:
+                    failed += 1
+
+
+def send_invoices_job(**filters):
+    """Background job: email the invoices matching the ``invoices_for`` filters."""
+    try:
+        sent, failed = send_invoice_emails(invoices_for(**filters))
+    except Exception:
+        # The mail server could not be reached at all
+        logger.exception("Emailing invoices (%s) failed", filters)
+        raise
+    if failed:
+        logger.error("Emailed %d invoice(s), %d failed (%s)", sent, failed, filters)
+    else:
+        logger.info("Emailed %d invoice(s)", sent)
+    return sent
@@ -0,0 +1,18 @@
+from django.core.management.base import BaseCommand
+
+from crm.archive import archive_messages, retention_days
+
+
+class Command(BaseCommand):
+    help = "Move sent and acknowledged messages past the retention window to the archive table."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--days', type=int, default=None,
+                            help="Keep messages scheduled within this many days (default: CRM_MESSAGE_RETENTION_DAYS).")
+        parser.add_argument('--chunk-size', type=int, default=500,
+                            help="Messages moved per transaction.")
+
+    def handle(self, *args, **options):
+        days = retention_days() if options['days'] is None else options['days']
+        archived = archive_messages(days=days, chunk_size=options['chunk_size'])
+        self.stdout.write(f"Archived {archived} message(s) sent more than {days} day(s) ago.")
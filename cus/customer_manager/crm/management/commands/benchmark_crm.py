@@ -0,0 +1,33 @@
+import json
+
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.benchmarks import run_benchmarks, scenarios
+
+
+class Command(BaseCommand):
+    help = "Time the main crm views and print latency percentiles and query counts as JSON."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--iterations', type=int, default=50)
+        parser.add_argument('--warmup', type=int, default=5)
+        parser.add_argument('--scenario', action='append', dest='scenarios',
+                            choices=sorted(scenarios(None, [], [])),
+                            help="Only run this scenario (repeatable).")
+        parser.add_argument('--label', default='',
+                            help="Free-form label stored in the report, e.g. a commit id.")
+        parser.add_argument('--output', '-o', default=None,
+                            help="File to write the JSON report to (defaults to standard output).")
+
+    def handle(self, *args, **options):
+        try:
+            report = run_benchmarks(options['iterations'], options['warmup'], options['scenarios'])
+        except ValueError as e:
+            raise CommandError(str(e))
+        report['label'] = options['label']
+        output = json.dumps(report, indent=2)
+        if options['output']:
+            with open(options['output'], 'w', encoding='utf-8') as file:
+                file.write(output + '\n')
+        else:
+            self.stdout.write(output)
@@ -0,0 +1,31 @@
+import time
+
+from django.core.management.base import BaseCommand
+
+from crm.dispatch import dispatch_due_messages, get_backend
+
+
+class Command(BaseCommand):
+    help = "Send scheduled messages that are due, polling the database until stopped."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Number of messages claimed per batch.")
+        parser.add_argument('--interval', type=float, default=30,
+                            help="Seconds to wait between polls when nothing is due.")
+        parser.add_argument('--once', action='store_true',
+                            help="Send what is due now and exit instead of polling.")
+        parser.add_argument('--rate', type=float, default=None,
+                            help="Maximum messages sent per second (defaults to CRM_DISPATCH_RATE).")
+        parser.add_argument('--backend', default=None,
+                            help="Dotted path of the send backend (defaults to CRM_MESSAGE_BACKEND).")
+
+    def handle(self, *args, **options):
+        backend = get_backend(options['backend'])
+        while True:
+            sent, failed = dispatch_due_messages(backend, batch_size=options['batch_size'], rate=options['rate'])
+            if sent or failed:
+                self.stdout.write(f"Sent {sent} message(s), {failed} failed.")
+            if options['once']:
+                return
+            time.sleep(options['interval'])
@@ -0,0 +1,23 @@
+from django.core.management.base import BaseCommand
+
+from crm.exports import DEFAULT_CHUNK_SIZE, EXPORTS, stream_csv
+
+
+class Command(BaseCommand):
+    help = "Stream a CSV export of customers, invoices or scheduled messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument('table', choices=sorted(EXPORTS))
+        parser.add_argument('--output', '-o', default=None,
+                            help="File to write to (defaults to standard output).")
+        parser.add_argument('--chunk-size', type=int, default=DEFAULT_CHUNK_SIZE,
+                            help="Rows fetched from the database per round trip.")
+
+    def handle(self, *args, **options):
+        lines = stream_csv(options['table'], options['chunk_size'])
+        if options['output']:
+            with open(options['output'], 'w', newline='', encoding='utf-8') as file:
+                file.writelines(lines)
+        else:
+            for line in lines:
+                self.stdout.write(line, ending='')
@@ -0,0 +1,41 @@
+import csv
+
+from django.conf import settings
+from django.core.management.base import BaseCommand, CommandError
+
+from crm.importers import detect_format, import_customers, read_rows
+
+
+class Command(BaseCommand):
+    help = "Import customers from a CSV or XLSX file in batches."
+
+    def add_arguments(self, parser):
+        parser.add_argument('path', help="CSV or XLSX file to import.")
+        parser.add_argument('--format', choices=['csv', 'xlsx'], default=None,
+                            help="File format (guessed from the extension by default).")
+        parser.add_argument('--batch-size', type=int, default=getattr(settings, 'CRM_IMPORT_BATCH_SIZE', 500),
+                            help="Number of customers inserted per batch.")
+        parser.add_argument('--rejects', default=None,
+                            help="Write rejected rows (line number and errors) to this CSV file.")
+
+    def handle(self, *args, **options):
+        fmt = options['format'] or detect_format(options['path'])
+        rejects_file = open(options['rejects'], 'w', newline='') if options['rejects'] else None
+        rejects_writer = csv.writer(rejects_file) if rejects_file else None
+
+        def on_reject(line_number, errors):
+            summary = '; '.join(f"{field}: {' '.join(messages)}" for field, messages in errors.items())
+            if rejects_writer:
+                rejects_writer.writerow([line_number, summary])
+            else:
+                self.stderr.write(f"Line {line_number}: {summary}")
+
+        try:
+            with open(options['path'], 'rb') as file:
+                result = import_customers(read_rows(file, fmt), batch_size=options['batch_size'], on_reject=on_reject)
+        except (OSError, ValueError) as e:
+            raise CommandError(str(e))
+        finally:
+            if rejects_file:
+                rejects_file.close()
+        self.stdout.write(f"Imported {result['created']} customer(s), rejected {result['rejected']} row(s).")
@@ -0,0 +1,41 @@
+from django.core.management.base import BaseCommand
+
+from crm.duplicates import merge_duplicates, phone_groups
+
+
+class Command(BaseCommand):
+    help = "Merge customers registered more than once (same phone number and same name or email)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=100,
+                            help="Phone numbers read per query.")
+        parser.add_argument('--dry-run', action='store_true',
+                            help="Only list the customers sharing a phone number and what would happen to them.")
+
+    def write_member(self, member, note=""):
+        pk, name, email = member
+        self.stdout.write(f"  #{pk} {name} <{email or '-'}> {note}".rstrip())
+
+    def handle(self, *args, **options):
+        if options['dry_run']:
+            removed = 0
+            for phone_digits, clusters in phone_groups(options['batch_size']):
+                self.stdout.write(f"{phone_digits}:")
+                for keeper, *duplicates in clusters:
+                    self.write_member(keeper, "(kept)" if duplicates else "(review)")
+                    for member in duplicates:
+                        self.write_member(member, f"(merged into #{keeper[0]})")
+                    removed += len(duplicates)
+            self.stdout.write(f"{removed} duplicate customer(s) would be merged.")
+            return
+        kept, removed, review = merge_duplicates(batch_size=options['batch_size'])
+        self.stdout.write(f"Merged {removed} duplicate customer(s) into {kept} customer(s).")
+        if review:
+            self.stdout.write(
+                f"{len(review)} phone number(s) are shared by customers with a different name and email; "
+                "merge them by hand if they are the same person:"
+            )
+            for phone_digits, clusters in review:
+                self.stdout.write(f"{phone_digits}:")
+                for (member,) in clusters:
+                    self.write_member(member)
@@ -0,0 +1,15 @@
+from django.core.management.base import BaseCommand
+
+from crm.purge import batch_size, purge_deleted_customers
+
+
+class Command(BaseCommand):
+    help = "Delete the invoices, messages and receipts of deleted customers, then the customers themselves."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=None,
+                            help="Rows deleted per transaction (default: CRM_PURGE_BATCH_SIZE).")
+
+    def handle(self, *args, **options):
+        purged = purge_deleted_customers(options['batch_size'] or batch_size())
+        self.stdout.write(f"Purged {purged} deleted customer(s).")
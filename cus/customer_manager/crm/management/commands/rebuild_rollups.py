@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from crm.rollups import rebuild
+
+
+class Command(BaseCommand):
+    help = "Rebuild the revenue rollups (per day, treatment and customer) from the invoice table."
+
+    def handle(self, *args, **options):
+        rebuild()
+        self.stdout.write("Revenue rollups rebuilt.")
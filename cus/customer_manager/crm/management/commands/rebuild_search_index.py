@@ -0,0 +1,11 @@
+from django.core.management.base import BaseCommand
+
+from crm.search import rebuild_index
+
+
+class Command(BaseCommand):
+    help = "Rebuild the customer full-text search index from the customer table."
+
+    def handle(self, *args, **options):
+        rebuild_index()
+        self.stdout.write("Customer search index rebuilt.")
@@ -0,0 +1,26 @@
+from django.core.management.base import BaseCommand
+
+from crm.models import Customer, refresh_next_schedule
+
+
+class Command(BaseCommand):
+    help = "Recompute the denormalized next_schedule_date / has_pending_message columns of every customer."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--batch-size', type=int, default=500,
+                            help="Number of customers updated per statement.")
+
+    def handle(self, *args, **options):
+        batch_size = options['batch_size']
+        last_id = 0
+        total = 0
+        while True:
+            ids = list(
+                Customer.objects.filter(id__gt=last_id).order_by('id').values_list('id', flat=True)[:batch_size]
+            )
+            if not ids:
+                break
+            refresh_next_schedule(ids, batch_size=batch_size)
+            total += len(ids)
+            last_id = ids[-1]
+        self.stdout.write(f"Refreshed schedule columns of {total} customer(s).")
@@ -0,0 +1,21 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from crm.receipts import convert_receipt, stuck_receipts
+
+
+class Command(BaseCommand):
+    help = "Convert image receipts whose background conversion was lost (e.g. by a restart)."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=10,
+                            help="Minutes a receipt must have been processing (default: 10).")
+
+    def handle(self, *args, **options):
+        invoice_ids = list(
+            stuck_receipts(timedelta(minutes=options['older_than'])).order_by('id').values_list('id', flat=True)
+        )
+        for invoice_id in invoice_ids:
+            convert_receipt(invoice_id)
+        self.stdout.write(f"Converted {len(invoice_ids)} stuck receipt(s).")
@@ -0,0 +1,19 @@
+from datetime import timedelta
+
+from django.core.management.base import BaseCommand
+
+from crm.campaigns import resume_campaigns
+
+
+class Command(BaseCommand):
+    help = "Finish scheduling campaigns whose background job was interrupted."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--older-than', type=int, default=10,
+                            help="Minutes without progress from the scheduling job (default: 10).")
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Messages created per transaction.")
+
+    def handle(self, *args, **options):
+        resumed = resume_campaigns(timedelta(minutes=options['older_than']), batch_size=options['batch_size'])
+        self.stdout.write(f"Resumed {resumed} campaign(s).")
@@ -0,0 +1,24 @@
+from django.core.management.base import BaseCommand
+
+from crm.provider_stub import StubProvider
+
+
+class Command(BaseCommand):
+    help = "Run a local SMS/WhatsApp provider stub that prints the messages it receives."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--host', default='127.0.0.1')
+        parser.add_argument('--port', type=int, default=8025)
+        parser.add_argument('--reject', nargs='*', default=[],
+                            help="Phone numbers the stub rejects.")
+
+    def handle(self, *args, **options):
+        stub = StubProvider(options['host'], options['port'], verbose=True)
+        stub.reject.update(options['reject'])
+        self.stdout.write(f"Provider stub listening on {stub.url} (set CRM_PROVIDER_URL to this). Ctrl-C to stop.")
+        try:
+            stub.server.serve_forever()
+        except KeyboardInterrupt:
+            pass
+        finally:
+            stub.server.server_close()
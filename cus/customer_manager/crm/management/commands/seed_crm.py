@@ -0,0 +1,29 @@
+from django.core.management.base import BaseCommand
+
+from crm.seeding import seed
+
+
+class Command(BaseCommand):
+    help = "Fill the database with synthetic customers, invoices and scheduled messages."
+
+    def add_arguments(self, parser):
+        parser.add_argument('--customers', type=int, default=1000)
+        parser.add_argument('--invoices-per-customer', type=int, default=2)
+        parser.add_argument('--messages-per-customer', type=int, default=2)
+        parser.add_argument('--batch-size', type=int, default=1000,
+                            help="Customers inserted per batch.")
+        parser.add_argument('--seed', type=int, default=None,
+                            help="Random seed, for reproducible data.")
+
+    def handle(self, *args, **options):
+        counts = seed(
+            customers=options['customers'],
+            invoices_per_customer=options['invoices_per_customer'],
+            messages_per_customer=options['messages_per_customer'],
+            batch_size=options['batch_size'],
+            random_seed=options['seed'],
+        )
+        self.stdout.write(
+            f"Created {counts['customers']} customer(s), {counts['invoices']} invoice(s) "
+            f"and {counts['messages']} message(s)."
+        )
@@ -0,0 +1,230 @@
+"""
+In-process request metrics, exposed in the Prometheus text format at /metrics.
+
+``crm.middleware.PerformanceMetricsMiddleware`` measures every request and
+adds it to the histograms below, labelled with the URL name of the view
+(``customer_list``, ``invoice_create``, ...) and the HTTP method. Each server
+process keeps its own registry; Prometheus sums them when it scrapes every
+worker.
+
+Template time is measured by the ``crm.metrics.TimedDjangoTemplates``
+template backend (``TEMPLATES['BACKEND']``), which covers ``render()``,
+``render_to_string()`` and template responses. It counts the outermost
+template rendered at a time, so it includes queries run lazily from templates;
+those are counted in the DB time as well.
+
+The /metrics view only answers ``CRM_METRICS_ALLOWED_IPS`` and staff users.
+"""
+import threading
+from bisect import bisect_left
+from contextvars import ContextVar
+from time import perf_counter
+
+from django.conf import settings
+from django.template.backends.django import DjangoTemplates
+
+# Queries kept per request for the slow request log
+MAX_LOGGED_QUERIES = 50
+
+TIME_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10)
+QUERY_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100, 200, 500)
+SIZE_BUCKETS = (1024, 4096, 16384, 65536, 262144, 1048576, 4194304)
+
+
+class RequestStats:
+    """Counters for the request being handled, updated by the query and template hooks."""
+
+    __slots__ = ('queries', 'db_time', 'template_time', 'template_depth', 'sql')
+
+    def __init__(self, log_sql=False):
+        self.queries = 0
+        self.db_time = 0.0
+        self.template_time = 0.0
+        self.template_depth = 0
+        self.sql = [] if log_sql else None
+
+
+_current = ContextVar('crm_request_stats', default=None)
+
+
+def start_request(log_sql=False):
+    """Start collecting stats for the current request; returns ``(stats, token)``."""
+    stats = RequestStats(log_sql)
+    return stats, _current.set(stats)
+
+
+def end_request(token):
+    _current.reset(token)
+
+
+def record_query(execute, sql, params, many, context):
+    """``connection.execute_wrapper`` hook counting queries and their time."""
+    stats = _current.get()
+    if stats is None:
+        return execute(sql, params, many, context)
+    start = perf_counter()
+    try:
+        return execute(sql, params, many, context)
+    finally:
+        elapsed = perf_counter() - start
+        stats.queries += 1
+        stats.db_time += elapsed
+        if stats.sql is not None and len(stats.sql) < MAX_LOGGED_QUERIES:
+            stats.sql.append((elapsed, sql))
+
+
+class TimedTemplate:
+    """Backend template wrapper adding its render time to the current request's stats."""
+
+    def __init__(self, template):
+        self.template = template
+
+    def __getattr__(self, name):
+        return getattr(self.template, name)
+
+    def render(self, context=None, request=None):
+        stats = _current.get()
+        # Templates rendered from inside another one are already in its time
+        if stats is None or stats.template_depth:
+            return self.template.render(context, request)
+        stats.template_depth += 1
+        start = perf_counter()
+        try:
+            return self.template.render(context, request)
+        finally:
+            stats.template_time += perf_counter() - start
+            stats.template_depth -= 1
+
+
+class TimedDjangoTemplates(DjangoTemplates):
+    """The Django template backend, with template time recorded per request."""
+
+    def from_string(self, template_code):
+        return TimedTemplate(super().from_string(template_code))
+
+    def get_template(self, template_name):
+        return TimedTemplate(super().get_template(template_name))
+
+
+def allowed(request):
+    """Whether ``request`` may read the metrics: an allowed IP or a staff user."""
+    if request.META.get('REMOTE_ADDR') in getattr(settings, 'CRM_METRICS_ALLOWED_IPS', ('127.0.0.1', '::1')):
+        return True
+    user = getattr(request, 'user', None)
+    return bool(user and user.is_staff)
+
+
+def _escape(value):
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(names, values, extra=''):
+    labels = ','.join(f'{name}="{_escape(value)}"' for name, value in zip(names, values))
+    if extra:
+        labels = f'{labels},{extra}' if labels else extra
+    return '{' + labels + '}' if labels else ''
+
+
+class Histogram:
+    def __init__(self, name, documentation, buckets, labels=('view', 'method')):
+        self.name = name
+        self.documentation = documentation
+        self.buckets = tuple(buckets)
+        self.labels = labels
+        # label values -> [per-bucket counts (last one is +Inf), sum, count]
+        self.series = {}
+
+    def observe(self, label_values, value):
+        series = self.series.get(label_values)
+        if series is None:
+            series = self.series[label_values] = [[0] * (len(self.buckets) + 1), 0.0, 0]
+        series[0][bisect_left(self.buckets, value)] += 1
+        series[1] += value
+        series[2] += 1
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} histogram']
+        for label_values, (counts, total, count) in sorted(self.series.items()):
+            cumulative = 0
+            for bound, bucket_count in zip(self.buckets + ('+Inf',), counts):
+                cumulative += bucket_count
+                le = _format_labels(self.labels, label_values, f'le="{bound}"')
+                lines.append(f'{self.name}_bucket{le} {cumulative}')
+            labels = _format_labels(self.labels, label_values)
+            lines.append(f'{self.name}_sum{labels} {total}')
+            lines.append(f'{self.name}_count{labels} {count}')
+        return lines
+
+
+class Counter:
+    def __init__(self, name, documentation, labels):
+        self.name = name
+        self.documentation = documentation
+        self.labels = labels
+        self.series = {}
+
+    def inc(self, label_values, amount=1):
+        self.series[label_values] = self.series.get(label_values, 0) + amount
+
+    def render(self):
+        lines = [f'# HELP {self.name} {self.documentation}', f'# TYPE {self.name} counter']
+        for label_values, value in sorted(self.series.items()):
+            lines.append(f'{self.name}{_format_labels(self.labels, label_values)} {value}')
+        return lines
+
+
+class Registry:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.reset()
+
+    def reset(self):
+        with self.lock:
+            self.requests = Counter(
+                'crm_requests_total', 'Requests handled.', ('view', 'method', 'status'),
+            )
+            self.duration = Histogram(
+                'crm_request_duration_seconds', 'Wall time spent handling the request.', TIME_BUCKETS,
+            )
+            self.queries = Histogram(
+                'crm_request_db_queries', 'Database queries run by the request.', QUERY_BUCKETS,
+            )
+            self.db_time = Histogram(
+                'crm_request_db_duration_seconds', 'Time spent in database queries.', TIME_BUCKETS,
+            )
+            self.template_time = Histogram(
+                'crm_request_template_duration_seconds', 'Time spent rendering templates.', TIME_BUCKETS,
+            )
+            self.response_size = Histogram(
+                'crm_response_size_bytes', 'Response body size (non-streaming responses).', SIZE_BUCKETS,
+            )
+            self.fragments = Counter(
+                'crm_fragment_cache_requests_total', 'Customer list row cache lookups.', ('result',),
+            )
+
+    def observe(self, view, method, status, duration, stats, size=None):
+        labels = (view, method)
+        with self.lock:
+            self.requests.inc((view, method, str(status)))
+            self.duration.observe(labels, duration)
+            self.queries.observe(labels, stats.queries)
+            self.db_time.observe(labels, stats.db_time)
+            self.template_time.observe(labels, stats.template_time)
+            if size is not None:
+                self.response_size.observe(labels, size)
+
+    def count_fragments(self, hits, misses):
+        with self.lock:
+            self.fragments.inc(('hit',), hits)
+            self.fragments.inc(('miss',), misses)
+
+    def render(self):
+        with self.lock:
+            lines = []
+            for metric in (self.requests, self.duration, self.queries, self.db_time,
+                           self.template_time, self.response_size, self.fragments):
+                lines.extend(metric.render())
+        return '\n'.join(lines) + '\n'
+
+
+registry = Registry()
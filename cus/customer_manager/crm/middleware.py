@@ -0,0 +1,70 @@
+import logging
+from contextlib import ExitStack
+from time import perf_counter
+
+from django.conf import settings
+from django.db import connections
+
+from . import metrics, routers
+
+logger = logging.getLogger('crm.slow_requests')
+
+
+class PerformanceMetricsMiddleware:
+    """
+    Record wall time, query count, DB time, template time and response size
+    per view into ``crm.metrics.registry`` (served at /metrics).
+
+    Requests slower than ``CRM_SLOW_REQUEST_MS`` are logged to
+    ``crm.slow_requests`` with their slowest SQL statements. Put it first in
+    MIDDLEWARE so the other middleware is included in the wall time.
+    """
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.slow_ms = getattr(settings, 'CRM_SLOW_REQUEST_MS', None)
+
+    def __call__(self, request):
+        stats, token = metrics.start_request(log_sql=self.slow_ms is not None)
+        start = perf_counter()
+        try:
+            with ExitStack() as stack:
+                for alias in connections:
+                    stack.enter_context(connections[alias].execute_wrapper(metrics.record_query))
+                response = self.get_response(request)
+        finally:
+            metrics.end_request(token)
+        duration = perf_counter() - start
+
+        match = request.resolver_match
+        view = (match.url_name or match.view_name) if match else 'unmatched'
+        size = None if response.streaming else len(response.content)
+        metrics.registry.observe(view, request.method, response.status_code, duration, stats, size)
+
+        if self.slow_ms is not None and duration * 1000 >= self.slow_ms:
+            self.log_slow_request(request, view, duration, stats)
+        return response
+
+    def log_slow_request(self, request, view, duration, stats):
+        slowest = sorted(stats.sql, key=lambda query: query[0], reverse=True)[:10]
+        logger.warning(
+            "Slow request %s %s (%s): %.0f ms, %d queries in %.0f ms, templates %.0f ms%s",
+            request.method, request.path, view, duration * 1000, stats.queries,
+            stats.db_time * 1000, stats.template_time * 1000,
+            ''.join(f"\n  {elapsed * 1000:.1f} ms: {sql}" for elapsed, sql in slowest),
+        )
+
+
+class ReplicaPinningMiddleware:
+    """Keep a client's reads on the primary for a few seconds after it writes."""
+
+    def __init__(self, get_response):
+        self.get_response = get_response
+
+    def __call__(self, request):
+        response = self.get_response(request)
+        if routers.replica_alias() and request.method not in ('GET', 'HEAD', 'OPTIONS', 'TRACE'):
+            response.set_cookie(
+                routers.PIN_COOKIE, '1', max_age=getattr(settings, 'CRM_REPLICA_PIN_SECONDS', 5), httponly=True, samesite='Lax',
+            )
+        return response
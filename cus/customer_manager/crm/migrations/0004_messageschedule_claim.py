@@ -0,0 +1,23 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:56
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0003_treatment_customer_age_customer_problem_customer_sex_and_more'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='messageschedule',
+            name='claim_token',
+            field=models.CharField(blank=True, db_index=True, default='', editable=False, max_length=32),
+        ),
+        migrations.AddField(
+            model_name='messageschedule',
+            name='claimed_at',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+    ]
@@ -0,0 +1,44 @@
+from django.db import migrations
+
+SQLITE_CREATE = (
+    "CREATE VIRTUAL TABLE crm_customer_fts USING fts5("
+    "name, phone_number, email, problem, tokenize='trigram')"
+)
+SQLITE_POPULATE = (
+    "INSERT INTO crm_customer_fts (rowid, name, phone_number, email, problem) "
+    "SELECT id, name, phone_number, email, problem FROM crm_customer"
+)
+POSTGRES_CREATE = [
+    "CREATE EXTENSION IF NOT EXISTS pg_trgm",
+    "CREATE INDEX crm_customer_search_trgm ON crm_customer USING gin "
+    "((name || ' ' || phone_number || ' ' || email || ' ' || problem) gin_trgm_ops)",
+]
+
+
+def create_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute(SQLITE_CREATE)
+        schema_editor.execute(SQLITE_POPULATE)
+    elif vendor == 'postgresql':
+        for sql in POSTGRES_CREATE:
+            schema_editor.execute(sql)
+
+
+def drop_search_index(apps, schema_editor):
+    vendor = schema_editor.connection.vendor
+    if vendor == 'sqlite':
+        schema_editor.execute("DROP TABLE IF EXISTS crm_customer_fts")
+    elif vendor == 'postgresql':
+        schema_editor.execute("DROP INDEX IF EXISTS crm_customer_search_trgm")
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0004_messageschedule_claim'),
+    ]
+
+    operations = [
+        migrations.RunPython(create_search_index, drop_search_index),
+    ]
@@ -0,0 +1,21 @@
+# Generated by Django 5.1.3 on 2026-10-18 09:58
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0005_customer_search_index'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='messageschedule',
+            index=models.Index(fields=['customer', 'is_sent', 'schedule_date'], name='crm_msg_customer_unsent_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='messageschedule',
+            index=models.Index(condition=models.Q(('is_sent', False)), fields=['schedule_date', 'is_reminder_sent'], name='crm_msg_pending_idx'),
+        ),
+    ]
@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:01
+
+from django.db import migrations, models
+from django.db.models import Exists, OuterRef, Subquery
+
+
+def backfill_next_schedule(apps, schema_editor):
+    Customer = apps.get_model('crm', 'Customer')
+    MessageSchedule = apps.get_model('crm', 'MessageSchedule')
+    db_alias = schema_editor.connection.alias
+    pending = MessageSchedule.objects.using(db_alias).filter(customer=OuterRef('pk'), is_sent=False)
+    Customer.objects.using(db_alias).update(
+        next_schedule_date=Subquery(pending.order_by('schedule_date').values('schedule_date')[:1]),
+        has_pending_message=Exists(pending),
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0007_invoice_receipt_status'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='has_pending_message',
+            field=models.BooleanField(default=False, editable=False),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='next_schedule_date',
+            field=models.DateTimeField(blank=True, editable=False, null=True),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(fields=['-has_pending_message', 'next_schedule_date', 'id'], name='crm_customer_list_order_idx'),
+        ),
+        migrations.RunPython(backfill_next_schedule, migrations.RunPython.noop),
+    ]
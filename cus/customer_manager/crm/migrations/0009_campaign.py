@@ -0,0 +1,40 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:02
+
+import django.core.validators
+import django.db.models.deletion
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0008_customer_next_schedule'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='Campaign',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('name', models.CharField(max_length=100)),
+                ('message_content', models.TextField()),
+                ('message_type', models.CharField(choices=[('SMS', 'SMS'), ('WhatsApp', 'WhatsApp')], max_length=10)),
+                ('min_age', models.PositiveIntegerField(blank=True, null=True)),
+                ('max_age', models.PositiveIntegerField(blank=True, null=True)),
+                ('sex', models.CharField(blank=True, choices=[('M', 'Male'), ('F', 'Female'), ('O', 'Other')], max_length=1)),
+                ('search', models.CharField(blank=True, help_text='Only customers matching this search term.', max_length=100)),
+                ('start_date', models.DateTimeField()),
+                ('messages_per_minute', models.PositiveIntegerField(default=60, validators=[django.core.validators.MinValueValidator(1)])),
+                ('recipient_count', models.PositiveIntegerField(default=0, editable=False)),
+                ('scheduled_count', models.PositiveIntegerField(default=0, editable=False)),
+                ('sent_count', models.PositiveIntegerField(default=0, editable=False)),
+                ('created_at', models.DateTimeField(auto_now_add=True)),
+                ('treatment', models.ForeignKey(blank=True, null=True, on_delete=django.db.models.deletion.SET_NULL, to='crm.treatment')),
+            ],
+        ),
+        migrations.AddField(
+            model_name='messageschedule',
+            name='campaign',
+            field=models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='crm.campaign'),
+        ),
+    ]
@@ -0,0 +1,19 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:14
+
+import crm.storage
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0010_updated_at'),
+    ]
+
+    operations = [
+        migrations.AlterField(
+            model_name='invoice',
+            name='receipt',
+            field=models.FileField(db_index=True, storage=crm.storage.receipt_storage, upload_to='receipts/'),
+        ),
+    ]
@@ -0,0 +1,73 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:17
+
+import django.db.models.deletion
+from django.db import migrations, models
+from django.db.models import Count, Sum
+from django.db.models.functions import TruncDate
+
+
+def backfill_rollups(apps, schema_editor):
+    Invoice = apps.get_model('crm', 'Invoice')
+    DailyRevenue = apps.get_model('crm', 'DailyRevenue')
+    DailyTreatmentRevenue = apps.get_model('crm', 'DailyTreatmentRevenue')
+    CustomerRevenue = apps.get_model('crm', 'CustomerRevenue')
+    db_alias = schema_editor.connection.alias
+    totals = {'count': Count('id'), 'total': Sum('amount')}
+    daily = Invoice.objects.using(db_alias).order_by().annotate(day=TruncDate('date_created')).values('day')
+    DailyRevenue.objects.using(db_alias).bulk_create(
+        DailyRevenue(day=row['day'], invoice_count=row['count'], amount=row['total'])
+        for row in daily.annotate(**totals)
+    )
+    DailyTreatmentRevenue.objects.using(db_alias).bulk_create(
+        DailyTreatmentRevenue(day=row['day'], treatment_id=row['customer__treatment'],
+                              invoice_count=row['count'], amount=row['total'])
+        for row in daily.filter(customer__treatment__isnull=False).values('day', 'customer__treatment').annotate(**totals)
+    )
+    CustomerRevenue.objects.using(db_alias).bulk_create(
+        CustomerRevenue(customer_id=row['customer'], invoice_count=row['count'], amount=row['total'])
+        for row in Invoice.objects.using(db_alias).order_by().values('customer').annotate(**totals)
+    )
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0011_invoice_receipt_storage'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='DailyRevenue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField(unique=True)),
+                ('invoice_count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+        ),
+        migrations.CreateModel(
+            name='CustomerRevenue',
+            fields=[
+                ('customer', models.OneToOneField(on_delete=django.db.models.deletion.CASCADE, primary_key=True, related_name='revenue', serialize=False, to='crm.customer')),
+                ('invoice_count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+            ],
+            options={
+                'indexes': [models.Index(fields=['-amount'], name='crm_customer_revenue_amt_idx')],
+            },
+        ),
+        migrations.CreateModel(
+            name='DailyTreatmentRevenue',
+            fields=[
+                ('id', models.BigAutoField(auto_created=True, primary_key=True, serialize=False, verbose_name='ID')),
+                ('day', models.DateField()),
+                ('invoice_count', models.IntegerField(default=0)),
+                ('amount', models.DecimalField(decimal_places=2, default=0, max_digits=14)),
+                ('treatment', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='crm.treatment')),
+            ],
+            options={
+                'constraints': [models.UniqueConstraint(fields=('day', 'treatment'), name='crm_treatment_revenue_day_uniq')],
+            },
+        ),
+        migrations.RunPython(backfill_rollups, migrations.RunPython.noop),
+    ]
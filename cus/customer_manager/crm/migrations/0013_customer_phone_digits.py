@@ -0,0 +1,46 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:26
+
+import crm.phones
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+def backfill_phone_digits(apps, schema_editor):
+    Customer = apps.get_model('crm', 'Customer')
+    customers = Customer.objects.using(schema_editor.connection.alias)
+    last_id = 0
+    while True:
+        # One batch in memory at a time, read by id so no cursor stays open across the updates
+        batch = list(customers.filter(id__gt=last_id).order_by('id').only('id', 'phone_number')[:1000])
+        if not batch:
+            return
+        for customer in batch:
+            customer.phone_digits = crm.phones.normalize(customer.phone_number)
+            customer.phone_digits_reversed = customer.phone_digits[::-1]
+        customers.bulk_update(batch, ['phone_digits', 'phone_digits_reversed'])
+        last_id = batch[-1].id
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0012_revenue_rollups'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='customer',
+            name='phone_digits',
+            field=crm.phones.PhoneDigitsField(blank=True, db_index=True, editable=False, max_length=20, source='phone_number'),
+        ),
+        migrations.AddField(
+            model_name='customer',
+            name='phone_digits_reversed',
+            field=crm.phones.PhoneDigitsField(blank=True, db_index=True, editable=False, max_length=20, reverse=True, source='phone_number'),
+        ),
+        migrations.AddIndex(
+            model_name='customer',
+            index=models.Index(django.db.models.functions.text.Lower('email'), name='crm_customer_email_lower_idx'),
+        ),
+        migrations.RunPython(backfill_phone_digits, migrations.RunPython.noop),
+    ]
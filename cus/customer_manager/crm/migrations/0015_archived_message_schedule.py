@@ -0,0 +1,31 @@
+# Generated by Django 5.1.3 on 2026-10-18 10:31
+
+import django.db.models.deletion
+import django.utils.timezone
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('crm', '0014_customer_deleted_at'),
+    ]
+
+    operations = [
+        migrations.CreateModel(
+            name='ArchivedMessageSchedule',
+            fields=[
+                ('id', models.BigIntegerField(primary_key=True, serialize=False)),
+                ('message_content', models.TextField()),
+                ('schedule_date', models.DateTimeField()),
+                ('message_type', models.CharField(choices=[('SMS', 'SMS'), ('WhatsApp', 'WhatsApp')], max_length=10)),
+                ('updated_at', models.DateTimeField()),
+                ('archived_at', models.DateTimeField(default=django.utils.timezone.now, editable=False)),
+                ('campaign', models.ForeignKey(blank=True, editable=False, null=True, on_delete=django.db.models.deletion.SET_NULL, to='crm.campaign')),
+                ('customer', models.ForeignKey(on_delete=django.db.models.deletion.CASCADE, to='crm.customer')),
+            ],
+            options={
+                'indexes': [models.Index(fields=['customer', '-schedule_date', '-id'], name='crm_archived_msg_customer_idx')],
+            },
+        ),
+    ]
@@ -2,8 +2,28 @@ from django.db import models
 
 # Create your models here.
 from django.db import models
+from django.core.validators import MinValueValidator
+from django.db.models import Exists, OuterRef, Subquery
+from django.db.models.functions import Lower
+from django.utils import timezone
 from datetime import datetime, timedelta
 
+from .phones import PhoneDigitsField
+from .storage import receipt_storage
+
+class TimestampedQuerySet(models.QuerySet):
+    """Sets ``updated_at`` on bulk updates too; ``auto_now`` only covers ``save()``."""
+
+    def update(self, **kwargs):
+        kwargs.setdefault('updated_at', timezone.now())
+        return super().update(**kwargs)
+
+class CustomerManager(models.Manager.from_queryset(TimestampedQuerySet)):
+    """Customers that are not deleted; ``Customer.all_objects`` includes them."""
+
+    def get_queryset(self):
+        return super().get_queryset().filter(deleted_at__isnull=True)
+
 class Customer(models.Model):
     SEX_CHOICES = [
         ('M', 'Male'),
@@ -22,12 +42,39 @@ class Customer(models.Model):
     name = models.CharField(max_length=100)
     email = models.EmailField()
     phone_number = models.CharField(max_length=15)
+    # phone_number normalized to E.164 digits (and reversed, for "ends with") on every
+    # write, for indexed phone search and duplicate checks (see crm.phones)
+    phone_digits = PhoneDigitsField()
+    phone_digits_reversed = PhoneDigitsField(reverse=True)
     address = models.TextField()
     problem = models.TextField(verbose_name="Patient's Problem")  # Added field for patient's problem
     age = models.PositiveIntegerField()  # Added field for age
     sex = models.CharField(max_length=1, choices=SEX_CHOICES)  # Added field for sex with a choice dropdown
     treatment = models.ManyToManyField('Treatment')  # Added field for multiple treatment selection
+    # Denormalized from the customer's unsent messages (see refresh_next_schedule) so the
+    # customer list can be read in index order instead of aggregating MessageSchedule
+    next_schedule_date = models.DateTimeField(null=True, blank=True, editable=False)
+    has_pending_message = models.BooleanField(default=False, editable=False)
+    # Drives the ETag / Last-Modified of the customer pages (see crm.conditional)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+    # Set when the customer is deleted; the invoices, messages and the row itself are
+    # purged in the background afterwards (see crm.purge)
+    deleted_at = models.DateTimeField(null=True, blank=True, editable=False)
 
+    objects = CustomerManager()
+    all_objects = TimestampedQuerySet.as_manager()
+
+    class Meta:
+        # Related objects (invoice.customer) and cascades still reach deleted customers
+        base_manager_name = 'all_objects'
+        indexes = [
+            # Customer list order
+            models.Index(fields=['-has_pending_message', 'next_schedule_date', 'id'], name='crm_customer_list_order_idx'),
+            # Duplicate check on email (CustomerForm)
+            models.Index(Lower('email'), name='crm_customer_email_lower_idx'),
+            # Customers waiting to be purged; live customers (deleted_at IS NULL) are not indexed
+            models.Index(fields=['deleted_at'], name='crm_customer_deleted_idx', condition=models.Q(deleted_at__isnull=False)),
+        ]
 
     def __str__(self):
         return self.name
@@ -39,14 +86,50 @@ class Treatment(models.Model):
         return str(self.name)
 
 class Invoice(models.Model):
+    RECEIPT_PROCESSING = 'processing'
+    RECEIPT_READY = 'ready'
+    RECEIPT_FAILED = 'failed'
+    RECEIPT_STATUSES = (
+        (RECEIPT_PROCESSING, 'Processing'),
+        (RECEIPT_READY, 'Ready'),
+        (RECEIPT_FAILED, 'Failed'),
+    )
     customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
     amount = models.DecimalField(max_digits=10, decimal_places=2)
     date_created = models.DateTimeField(auto_now_add=True)
-    receipt = models.FileField(upload_to='receipts/')
+    # Stored once per distinct content; the index backs the reference lookups in crm.storage
+    receipt = models.FileField(upload_to='receipts/', storage=receipt_storage, db_index=True)
+    # Image receipts stay 'processing' until the background PDF conversion finishes
+    receipt_status = models.CharField(choices=RECEIPT_STATUSES, max_length=10, default=RECEIPT_READY, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    objects = TimestampedQuerySet.as_manager()
 
     def __str__(self):
         return f"Invoice {self.id} - {self.customer.name}"
 
+# MessageSchedule fields that Customer.next_schedule_date / has_pending_message depend on
+SCHEDULE_FIELDS = {'customer', 'customer_id', 'schedule_date', 'is_sent'}
+
+class MessageScheduleQuerySet(TimestampedQuerySet):
+    """Keeps the denormalized Customer schedule columns correct across bulk writes."""
+
+    def update(self, **kwargs):
+        if not SCHEDULE_FIELDS.intersection(kwargs):
+            return super().update(**kwargs)
+        customer_ids = set(self.values_list('customer_id', flat=True))
+        rows = super().update(**kwargs)
+        new_customer = kwargs.get('customer_id', kwargs.get('customer'))
+        if new_customer is not None:
+            customer_ids.add(getattr(new_customer, 'pk', new_customer))
+        refresh_next_schedule(customer_ids)
+        return rows
+
+    def bulk_create(self, objs, *args, **kwargs):
+        objs = super().bulk_create(objs, *args, **kwargs)
+        refresh_next_schedule({obj.customer_id for obj in objs})
+        return objs
+
 class MessageSchedule(models.Model):
     MESSAGE_TYPES = (
         ('SMS', 'SMS'),
@@ -58,6 +141,116 @@ class MessageSchedule(models.Model):
     message_type = models.CharField(choices=MESSAGE_TYPES, max_length=10)
     is_sent = models.BooleanField(default=False)
     is_reminder_sent = models.BooleanField(default=False)
+    # Set by the dispatcher while a worker owns the row (see crm.dispatch)
+    claimed_at = models.DateTimeField(null=True, blank=True, editable=False)
+    claim_token = models.CharField(max_length=32, blank=True, default='', db_index=True, editable=False)
+    # Set when the message was generated by a bulk Campaign
+    campaign = models.ForeignKey('Campaign', null=True, blank=True, on_delete=models.SET_NULL, editable=False)
+    updated_at = models.DateTimeField(auto_now=True, db_index=True)
+
+    class Meta:
+        indexes = [
+            # A customer's unsent messages by date (customer_list next_message, customer_detail)
+            models.Index(fields=['customer', 'is_sent', 'schedule_date'], name='crm_msg_customer_unsent_idx'),
+            # Due unsent messages: the dispatcher claim and the due reminders panel
+            models.Index(
+                fields=['schedule_date', 'is_reminder_sent'],
+                condition=models.Q(is_sent=False),
+                name='crm_msg_pending_idx',
+            ),
+        ]
+
+    objects = MessageScheduleQuerySet.as_manager()
 
     def __str__(self):
         return f"Message to {self.customer.name} at {self.schedule_date}"
+
+class ArchivedMessageSchedule(models.Model):
+    """A sent and acknowledged MessageSchedule, moved out of the hot table (see crm.archive)."""
+    # The id the message had in MessageSchedule
+    id = models.BigIntegerField(primary_key=True)
+    customer = models.ForeignKey(Customer, on_delete=models.CASCADE)
+    message_content = models.TextField()
+    schedule_date = models.DateTimeField()
+    message_type = models.CharField(choices=MessageSchedule.MESSAGE_TYPES, max_length=10)
+    campaign = models.ForeignKey('Campaign', null=True, blank=True, on_delete=models.SET_NULL, editable=False)
+    # Last change while the message was live (when it was acknowledged, usually)
+    updated_at = models.DateTimeField()
+    archived_at = models.DateTimeField(default=timezone.now, editable=False)
+
+    class Meta:
+        indexes = [
+            # A customer's message history, newest first (customer_message_history)
+            models.Index(fields=['customer', '-schedule_date', '-id'], name='crm_archived_msg_customer_idx'),
+        ]
+
+    def __str__(self):
+        return f"Archived message to {self.customer.name} at {self.schedule_date}"
+
+class Campaign(models.Model):
+    """One message scheduled to every customer matching the filters below."""
+    name = models.CharField(max_length=100)
+    message_content = models.TextField()
+    message_type = models.CharField(choices=MessageSchedule.MESSAGE_TYPES, max_length=10)
+    # Recipient filters; empty filters match everyone
+    treatment = models.ForeignKey(Treatment, null=True, blank=True, on_delete=models.SET_NULL)
+    min_age = models.PositiveIntegerField(null=True, blank=True)
+    max_age = models.PositiveIntegerField(null=True, blank=True)
+    sex = models.CharField(max_length=1, choices=Customer.SEX_CHOICES, blank=True)
+    search = models.CharField(max_length=100, blank=True, help_text="Only customers matching this search term.")
+    # Messages are staggered from start_date so the send backend is not flooded
+    start_date = models.DateTimeField()
+    messages_per_minute = models.PositiveIntegerField(default=60, validators=[MinValueValidator(1)])
+    # Progress counters
+    recipient_count = models.PositiveIntegerField(default=0, editable=False)
+    scheduled_count = models.PositiveIntegerField(default=0, editable=False)
+    sent_count = models.PositiveIntegerField(default=0, editable=False)
+    created_at = models.DateTimeField(auto_now_add=True)
+    # Heartbeat of the job scheduling the messages, touched once per batch
+    updated_at = models.DateTimeField(auto_now=True)
+
+    def __str__(self):
+        return self.name
+
+def refresh_next_schedule(customer_ids, batch_size=500):
+    """Recompute next_schedule_date / has_pending_message for the given customers."""
+    from .caching import bump_customer_versions
+
+    customer_ids = list(customer_ids)
+    # Their customer_list rows show the next unsent message
+    bump_customer_versions(customer_ids)
+    pending = MessageSchedule.objects.filter(customer=OuterRef('pk'), is_sent=False)
+    for start in range(0, len(customer_ids), batch_size):
+        Customer.objects.filter(id__in=customer_ids[start:start + batch_size]).update(
+            next_schedule_date=Subquery(pending.order_by('schedule_date').values('schedule_date')[:1]),
+            has_pending_message=Exists(pending),
+        )
+
+# Revenue rollups, kept in step with Invoice by crm.rollups so reports never scan invoices
+class DailyRevenue(models.Model):
+    day = models.DateField(unique=True)
+    invoice_count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+class DailyTreatmentRevenue(models.Model):
+    """An invoice counts in full towards every treatment its customer has."""
+    day = models.DateField()
+    treatment = models.ForeignKey(Treatment, on_delete=models.CASCADE)
+    invoice_count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        constraints = [
+            models.UniqueConstraint(fields=['day', 'treatment'], name='crm_treatment_revenue_day_uniq'),
+        ]
+
+class CustomerRevenue(models.Model):
+    customer = models.OneToOneField(Customer, primary_key=True, on_delete=models.CASCADE, related_name='revenue')
+    invoice_count = models.IntegerField(default=0)
+    amount = models.DecimalField(max_digits=14, decimal_places=2, default=0)
+
+    class Meta:
+        indexes = [
+            # Top customers on the revenue dashboard
+            models.Index(fields=['-amount'], name='crm_customer_revenue_amt_idx'),
+        ]
@@ -0,0 +1,92 @@
+"""Keyset (cursor) pagination for the customer list.
+
+The list is ordered by ``(-has_pending_message, next_schedule_date, id)``,
+which the ``crm_customer_list_order_idx`` index serves directly. Instead of an
+OFFSET, each page carries a cursor holding the sort key of its last row, and
+the next page starts strictly after that key. Page N costs the same as page 1.
+
+Search results are ordered by rank, which has no index to seek on; their
+cursor is simply the offset of the next page (see ``paginate_search``).
+"""
+import base64
+import json
+
+from django.db.models import Q
+from django.utils.dateparse import parse_datetime
+
+
+class InvalidCursor(ValueError):
+    pass
+
+
+def encode_cursor(customer):
+    """Build an opaque cursor from the sort key of the last row on a page."""
+    date = customer.next_schedule_date
+    key = [customer.has_pending_message, date.isoformat() if date else None, customer.id]
+    return base64.urlsafe_b64encode(json.dumps(key).encode()).decode().rstrip('=')
+
+
+def decode_cursor(cursor):
+    """Return ``(has_pending_message, next_schedule_date, id)`` from a cursor string."""
+    try:
+        padded = cursor + '=' * (-len(cursor) % 4)
+        has_pending, date, pk = json.loads(base64.urlsafe_b64decode(padded.encode()))
+        date = parse_datetime(date) if date else None
+        if not isinstance(has_pending, bool) or not isinstance(pk, int):
+            raise ValueError
+        if has_pending and date is None:
+            raise ValueError
+    except (TypeError, ValueError):
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}")
+    return has_pending, date, pk
+
+
+def after_cursor(has_pending, date, pk):
+    """Q object selecting the rows that sort strictly after the given key."""
+    if has_pending:
+        return (
+            Q(has_pending_message=True, next_schedule_date__gt=date)
+            | Q(has_pending_message=True, next_schedule_date=date, id__gt=pk)
+            | Q(has_pending_message=False)
+        )
+    return Q(has_pending_message=False, id__gt=pk)
+
+
+def paginate_customers(queryset, cursor=None, page_size=50):
+    """
+    Return ``(rows, next_cursor)`` for one page of ``queryset``.
+
+    ``queryset`` must be ordered by the list sort key. ``next_cursor`` is None
+    on the last page.
+    """
+    if cursor:
+        queryset = queryset.filter(after_cursor(*decode_cursor(cursor)))
+    rows = list(queryset[:page_size + 1])
+    if len(rows) > page_size:
+        rows = rows[:page_size]
+        return rows, encode_cursor(rows[-1])
+    return rows, None
+
+
+def decode_offset(cursor):
+    """Return the offset held by a search results cursor."""
+    try:
+        offset = int(cursor)
+    except (TypeError, ValueError):
+        offset = -1
+    if offset < 0:
+        raise InvalidCursor(f"Invalid cursor: {cursor!r}")
+    return offset
+
+
+def paginate_search(search_ids, cursor=None, page_size=50):
+    """
+    Return ``(ids, next_cursor)`` for one page of ranked search results.
+
+    ``search_ids(limit, offset)`` returns the matching ids, best first.
+    """
+    offset = decode_offset(cursor) if cursor else 0
+    ids = search_ids(page_size + 1, offset)
+    if len(ids) > page_size:
+        return ids[:page_size], str(offset + page_size)
+    return ids, None
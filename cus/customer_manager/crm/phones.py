@@ -0,0 +1,98 @@
+"""
+Normalized phone numbers.
+
+``Customer.phone_number`` stays as typed; ``phone_digits`` holds the number
+as E.164 digits without the '+' (national numbers get
+``CRM_DEFAULT_COUNTRY_CODE``), so "098765 43210", "+91 98765-43210" and
+"9876543210" are the same number. ``phone_digits_reversed`` holds the digits
+back to front, which turns "ends with" into a prefix lookup too.
+
+Both columns are ``PhoneDigitsField``s, filled in from ``phone_number`` when
+the row is written (``save()`` and ``bulk_create()`` alike), and indexed.
+Prefixes are matched with ``>=``/``<`` range conditions, which use the index
+on every backend (SQLite's ``LIKE`` is case-insensitive and would not).
+"""
+import re
+
+from django.conf import settings
+from django.db import models
+from django.db.models import Q
+
+NATIONAL_LENGTH = 10
+MIN_SEARCH_DIGITS = 3
+PHONE_QUERY_RE = re.compile(r'^\+?[\d\s().-]+$')
+
+
+def country_code():
+    return str(getattr(settings, 'CRM_DEFAULT_COUNTRY_CODE', '91'))
+
+
+def normalize(value):
+    """E.164 digits (no '+') for a phone number as typed; '' if it has no digits."""
+    value = (value or '').strip()
+    digits = re.sub(r'\D', '', value)
+    if not digits or value.startswith('+'):
+        return digits
+    if digits.startswith('00'):
+        # International call prefix
+        return digits[2:]
+    if digits.startswith('0') and len(digits) == NATIONAL_LENGTH + 1:
+        # National trunk prefix
+        digits = digits[1:]
+    if len(digits) == NATIONAL_LENGTH:
+        return country_code() + digits
+    return digits
+
+
+class PhoneDigitsField(models.CharField):
+    """Normalized digits of the ``source`` field (reversed with ``reverse=True``), set on every write."""
+
+    def __init__(self, *args, source='phone_number', reverse=False, **kwargs):
+        self.source = source
+        self.reverse = reverse
+        kwargs.setdefault('max_length', 20)
+        kwargs.setdefault('editable', False)
+        kwargs.setdefault('blank', True)
+        kwargs.setdefault('db_index', True)
+        super().__init__(*args, **kwargs)
+
+    def deconstruct(self):
+        name, path, args, kwargs = super().deconstruct()
+        kwargs['source'] = self.source
+        if self.reverse:
+            kwargs['reverse'] = True
+        return name, path, args, kwargs
+
+    def pre_save(self, model_instance, add):
+        value = normalize(getattr(model_instance, self.source))[:self.max_length]
+        if self.reverse:
+            value = value[::-1]
+        setattr(model_instance, self.attname, value)
+        return value
+
+
+def _prefix(field, prefix):
+    # '9' + 1 is ':', which sorts right after the digits
+    return Q(**{f'{field}__gte': prefix, f'{field}__lt': prefix[:-1] + chr(ord(prefix[-1]) + 1)})
+
+
+def is_phone_query(query):
+    query = query.strip()
+    return bool(PHONE_QUERY_RE.match(query)) and len(re.sub(r'\D', '', query)) >= MIN_SEARCH_DIGITS
+
+
+def phone_filter(query):
+    """Customers whose number starts or ends with the digits of ``query``."""
+    query = query.strip()
+    digits = re.sub(r'\D', '', query)
+    if query.startswith('+') or digits.startswith('00'):
+        starts = {normalize(query)}
+    elif digits.startswith('0'):
+        starts = {country_code() + digits[1:]}
+    else:
+        # A national number typed from the start, or an international one without the '+'
+        starts = {digits, country_code() + digits}
+    condition = _prefix('phone_digits_reversed', digits[::-1])
+    for start in starts:
+        condition |= _prefix('phone_digits', start)
+    return condition
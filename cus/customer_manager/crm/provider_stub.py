@@ -0,0 +1,104 @@
+"""
+Local stand-in for the SMS/WhatsApp provider API (see ``crm.providers``).
+
+Used by the tests and by ``python manage.py runproviderstub`` for local
+development. It accepts every message, except numbers listed in ``reject``,
+and can be told to fail the next requests with given HTTP statuses to
+exercise the client's retries and circuit breaker.
+"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+from .providers import MESSAGES_PATH
+
+
+class StubHandler(BaseHTTPRequestHandler):
+    # HTTP/1.1 keeps connections open between requests
+    protocol_version = 'HTTP/1.1'
+
+    def setup(self):
+        super().setup()
+        with self.server.stub.lock:
+            self.server.stub.connections += 1
+
+    def do_POST(self):
+        stub = self.server.stub
+        body = self.rfile.read(int(self.headers.get('Content-Length') or 0))
+        if self.path != MESSAGES_PATH:
+            return self.respond(404, {'error': 'not found'})
+        with stub.lock:
+            stub.requests += 1
+            status = stub.failures.pop(0) if stub.failures else None
+        if status:
+            return self.respond(status, {'error': 'stub failure'})
+        try:
+            messages = json.loads(body)['messages']
+        except (ValueError, KeyError):
+            return self.respond(400, {'error': 'invalid body'})
+
+        results = []
+        for message in messages:
+            if message.get('to') in stub.reject:
+                results.append({'id': message.get('id'), 'status': 'rejected', 'error': 'invalid number'})
+            else:
+                results.append({'id': message.get('id'), 'status': 'accepted'})
+                with stub.lock:
+                    stub.received.append(message)
+                if stub.verbose:
+                    print(f"[{message.get('channel')}] to {message.get('to')}: {message.get('body')}")
+        self.respond(200, {'results': results})
+
+    def respond(self, status, payload):
+        data = json.dumps(payload).encode()
+        self.send_response(status)
+        self.send_header('Content-Type', 'application/json')
+        self.send_header('Content-Length', str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+    def log_message(self, format, *args):
+        if self.server.stub.verbose:
+            super().log_message(format, *args)
+
+
+class StubProvider:
+    """Run the stub on ``host:port`` (port 0 picks a free one) in a background thread."""
+
+    def __init__(self, host='127.0.0.1', port=0, verbose=False):
+        self.server = ThreadingHTTPServer((host, port), StubHandler)
+        self.server.daemon_threads = True
+        self.server.stub = self
+        self.verbose = verbose
+        self.lock = threading.Lock()
+        self.received = []
+        self.reject = set()
+        self.failures = []
+        self.requests = 0
+        self.connections = 0
+        self.thread = None
+
+    @property
+    def url(self):
+        host, port = self.server.server_address[:2]
+        return f'http://{host}:{port}'
+
+    def fail_next(self, *statuses):
+        """Answer the next requests with these HTTP statuses, in order."""
+        with self.lock:
+            self.failures.extend(statuses)
+
+    def start(self):
+        self.thread = threading.Thread(target=self.server.serve_forever, args=(0.05,), daemon=True)
+        self.thread.start()
+        return self
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
+
+    def __enter__(self):
+        return self.start()
+
+    def __exit__(self, *exc_info):
+        self.stop()
@@ -0,0 +1,333 @@
+"""
+Outbound SMS/WhatsApp provider client.
+
+``ProviderClient`` posts messages to the provider's HTTP API in batches over a
+small pool of keep-alive connections (stdlib ``http.client``), so a dispatcher
+run reuses a handful of TCP/TLS sessions instead of opening one per message.
+Around each batch request it applies:
+
+* a token bucket, capping the send rate at ``RATE`` messages per second;
+* retries with exponential backoff on connection errors, 429 and 5xx;
+* a circuit breaker that stops calling the provider for ``RESET_TIMEOUT``
+  seconds after ``FAILURE_THRESHOLD`` consecutive failed batches.
+
+The client is configured by the ``CRM_PROVIDER`` setting. Without a
+``BASE_URL`` no client is built and nothing is sent: the dispatcher leaves
+the messages unsent and the invoice WhatsApp view refuses the request. ``python manage.py runproviderstub`` runs a local provider
+(``crm.provider_stub``) that speaks the same API.
+
+API: ``POST <BASE_URL>/v1/messages`` with
+``{"messages": [{"id", "to", "channel", "body"}, ...]}``, answered with
+``{"results": [{"id", "status": "accepted" | "rejected", ...}, ...]}``.
+"""
+import http.client
+import json
+import logging
+import queue
+import threading
+import time
+import uuid
+from urllib.parse import urlsplit
+
+from django.conf import settings
+from django.core.signals import setting_changed
+from django.dispatch import receiver
+
+from .models import Invoice
+
+logger = logging.getLogger(__name__)
+
+DEFAULTS = {
+    'BASE_URL': '',
+    'API_KEY': '',
+    'BATCH_SIZE': 50,
+    'RATE': 20,
+    'BURST': 50,
+    'MAX_RETRIES': 3,
+    'BACKOFF': 0.5,
+    'MAX_BACKOFF': 10,
+    'TIMEOUT': 10,
+    'POOL_SIZE': 4,
+    'FAILURE_THRESHOLD': 5,
+    'RESET_TIMEOUT': 30,
+}
+
+MESSAGES_PATH = '/v1/messages'
+
+
+class ProviderError(Exception):
+    """The provider rejected or failed a request."""
+
+    def __init__(self, message, status=None, retry_after=None):
+        super().__init__(message)
+        self.status = status
+        self.retry_after = retry_after
+
+    @property
+    def retryable(self):
+        return self.status is None or self.status == 429 or self.status >= 500
+
+
+class CircuitOpenError(ProviderError):
+    """The circuit breaker is open; the provider is not being called."""
+
+
+class TokenBucket:
+    """
+    Thread-safe token bucket: ``rate`` tokens per second, at most ``capacity`` banked.
+
+    ``acquire(n)`` may take the bucket into debt for batches larger than the
+    burst; the caller then sleeps until the debt is paid back.
+    """
+
+    def __init__(self, rate, capacity, clock=time.monotonic, sleep=time.sleep):
+        self.rate = rate
+        self.capacity = capacity
+        self.clock = clock
+        self.sleep = sleep
+        self.tokens = capacity
+        self.updated = clock()
+        self.lock = threading.Lock()
+
+    def acquire(self, tokens=1):
+        if not self.rate:
+            return 0
+        with self.lock:
+            now = self.clock()
+            self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+            self.updated = now
+            self.tokens -= tokens
+            delay = -self.tokens / self.rate if self.tokens < 0 else 0
+        if delay:
+            self.sleep(delay)
+        return delay
+
+
+class CircuitBreaker:
+    """Opens after ``failure_threshold`` consecutive failures, half-opens after ``reset_timeout`` seconds."""
+
+    CLOSED, OPEN, HALF_OPEN = 'closed', 'open', 'half-open'
+
+    def __init__(self, failure_threshold=5, reset_timeout=30, clock=time.monotonic):
+        self.failure_threshold = failure_threshold
+        self.reset_timeout = reset_timeout
+        self.clock = clock
+        self.failures = 0
+        self.opened_at = None
+        self.lock = threading.Lock()
+
+    @property
+    def state(self):
+        if self.opened_at is None:
+            return self.CLOSED
+        if self.clock() - self.opened_at >= self.reset_timeout:
+            return self.HALF_OPEN
+        return self.OPEN
+
+    def before_call(self):
+        with self.lock:
+            state = self.state
+            if state == self.OPEN:
+                raise CircuitOpenError("Provider circuit is open")
+            if state == self.HALF_OPEN:
+                # Let this one trial call through; others wait for its outcome
+                self.opened_at = self.clock()
+
+    def record_success(self):
+        with self.lock:
+            self.failures = 0
+            self.opened_at = None
+
+    def record_failure(self):
+        with self.lock:
+            self.failures += 1
+            if self.failures >= self.failure_threshold:
+                self.opened_at = self.clock()
+
+
+class ConnectionPool:
+    """Keep-alive HTTP(S) connections to one host, reused across requests and threads."""
+
+    def __init__(self, base_url, size=4, timeout=10):
+        url = urlsplit(base_url)
+        self.connection_class = http.client.HTTPSConnection if url.scheme == 'https' else http.client.HTTPConnection
+        self.host = url.hostname
+        self.port = url.port
+        self.prefix = url.path.rstrip('/')
+        self.timeout = timeout
+        self.idle = queue.LifoQueue(maxsize=size)
+
+    def _connect(self):
+        return self.connection_class(self.host, self.port, timeout=self.timeout)
+
+    def request(self, method, path, body=None, headers=None):
+        """Send a request and return ``(status, headers, body)``."""
+        try:
+            connection, reused = self.idle.get_nowait(), True
+        except queue.Empty:
+            connection, reused = self._connect(), False
+        try:
+            try:
+                response = self._send(connection, method, path, body, headers)
+            except (http.client.RemoteDisconnected, BrokenPipeError, ConnectionResetError):
+                if not reused:
+                    raise
+                # The server closed the idle connection; retry once on a fresh one
+                connection.close()
+                connection = self._connect()
+                response = self._send(connection, method, path, body, headers)
+        except Exception:
+            connection.close()
+            raise
+        if response.will_close:
+            connection.close()
+        else:
+            try:
+                self.idle.put_nowait(connection)
+            except queue.Full:
+                connection.close()
+        return response.status, response.headers, response.data
+
+    def _send(self, connection, method, path, body, headers):
+        connection.request(method, self.prefix + path, body=body, headers=headers or {})
+        response = connection.getresponse()
+        response.data = response.read()
+        return response
+
+    def close(self):
+        while True:
+            try:
+                self.idle.get_nowait().close()
+            except queue.Empty:
+                return
+
+
+class ProviderClient:
+    def __init__(self, base_url, api_key='', batch_size=50, rate=20, burst=50, max_retries=3,
+                 backoff=0.5, max_backoff=10, timeout=10, pool_size=4, failure_threshold=5,
+                 reset_timeout=30, sleep=time.sleep):
+        self.api_key = api_key
+        self.batch_size = max(1, batch_size)
+        self.max_retries = max_retries
+        self.backoff = backoff
+        self.max_backoff = max_backoff
+        self.sleep = sleep
+        self.pool = ConnectionPool(base_url, size=pool_size, timeout=timeout)
+        self.bucket = TokenBucket(rate, burst or rate, sleep=sleep)
+        self.breaker = CircuitBreaker(failure_threshold, reset_timeout)
+
+    @classmethod
+    def from_settings(cls, config):
+        return cls(**{key.lower(): value for key, value in config.items()})
+
+    def send(self, messages):
+        """
+        Send ``messages`` (dicts with id, to, channel and body) and return the
+        ids the provider accepted.
+
+        A batch that still fails after its retries is logged and left out of
+        the result, so the caller can retry those messages later. Once the
+        circuit opens, the remaining batches are not attempted.
+        """
+        accepted = []
+        for start in range(0, len(messages), self.batch_size):
+            batch = messages[start:start + self.batch_size]
+            try:
+                accepted.extend(self.send_batch(batch))
+            except CircuitOpenError:
+                logger.warning("Provider circuit open, deferring %d message(s)", len(messages) - start)
+                break
+            except ProviderError as e:
+                logger.error("Provider failed a batch of %d message(s): %s", len(batch), e)
+        return accepted
+
+    def send_batch(self, batch):
+        self.breaker.before_call()
+        self.bucket.acquire(len(batch))
+        body = json.dumps({'messages': batch}).encode()
+        headers = {
+            'Content-Type': 'application/json',
+            # Lets the provider drop a batch it already accepted before a retry
+            'Idempotency-Key': uuid.uuid4().hex,
+        }
+        if self.api_key:
+            headers['Authorization'] = f'Bearer {self.api_key}'
+        attempt = 0
+        while True:
+            try:
+                results = self._post(body, headers)
+            except ProviderError as e:
+                if not e.retryable:
+                    # The request itself is bad; the provider is healthy
+                    self.breaker.record_success()
+                    raise
+                if attempt >= self.max_retries:
+                    self.breaker.record_failure()
+                    raise
+                delay = min(self.max_backoff, self.backoff * 2 ** attempt)
+                self.sleep(max(delay, e.retry_after or 0))
+                attempt += 1
+                continue
+            self.breaker.record_success()
+            return [result['id'] for result in results if result.get('status') == 'accepted']
+
+    def _post(self, body, headers):
+        try:
+            status, response_headers, data = self.pool.request('POST', MESSAGES_PATH, body, headers)
+        except (OSError, http.client.HTTPException) as e:
+            raise ProviderError(f"Connection to provider failed: {e}") from e
+        if status >= 400:
+            retry_after = response_headers.get('Retry-After')
+            raise ProviderError(
+                f"Provider returned HTTP {status}", status=status,
+                retry_after=float(retry_after) if retry_after and retry_after.isdigit() else None,
+            )
+        try:
+            return json.loads(data)['results']
+        except (ValueError, KeyError) as e:
+            raise ProviderError(f"Invalid provider response: {e}", status=status) from e
+
+    def close(self):
+        self.pool.close()
+
+
+def outbound(ref, to, channel, body):
+    return {'id': str(ref), 'to': to, 'channel': channel.lower(), 'body': body}
+
+
+_client = None
+_client_lock = threading.Lock()
+
+
+def get_client():
+    """The shared ProviderClient, or None when no provider BASE_URL is configured."""
+    global _client
+    with _client_lock:
+        if _client is None:
+            config = {**DEFAULTS, **getattr(settings, 'CRM_PROVIDER', {})}
+            if not config['BASE_URL']:
+                return None
+            _client = ProviderClient.from_settings(config)
+    return _client
+
+
+@receiver(setting_changed)
+def reset_client(setting, **kwargs):
+    global _client
+    if setting == 'CRM_PROVIDER':
+        with _client_lock:
+            if _client is not None:
+                _client.close()
+            _client = None
+
+
+def send_invoice_whatsapp(invoice_id):
+    """Background job: send the invoice notification for ``invoice_id`` over WhatsApp. Returns whether it was sent."""
+    invoice = Invoice.objects.select_related('customer').get(id=invoice_id)
+    client = get_client()
+    if client is None:
+        logger.warning("No message provider configured; invoice %s was not sent over WhatsApp", invoice.id)
+        return False
+    body = f"Invoice #{invoice.id} Amount: ${invoice.amount} has been sent to you. Please find the receipt attached."
+    # E.164 digits (see crm.phones), whatever the spacing the number was typed with
+    return bool(client.send([outbound(f'invoice-{invoice.id}', invoice.customer.phone_digits, 'WhatsApp', body)]))
@@ -0,0 +1,85 @@
+"""
+Deleting customers.
+
+A customer with years of history has thousands of invoices and messages, and
+deleting them all in the request would hold the database write lock for as
+long as the cascade takes. ``soft_delete()`` only sets
+``Customer.deleted_at`` (the default manager hides the customer from the
+list, detail and search from then on) and hands the rest to a background job.
+
+``purge_deleted_customers()`` then deletes the children of every deleted
+customer in batches of ``CRM_PURGE_BATCH_SIZE`` rows, one short transaction
+per batch, subtracts the invoices from the revenue rollups, deletes receipt
+files nothing else refers to, and finally deletes the customer row. It
+carries on where it stopped, so a purge interrupted by a restart is finished
+by the next one (or ``manage.py purge_deleted_customers``).
+"""
+from django.conf import settings
+from django.db import transaction
+from django.utils import timezone
+
+from . import caching, rollups, search, storage, tasks
+from .models import ArchivedMessageSchedule, Customer, Invoice, MessageSchedule
+from .signals import batch_delete
+
+
+def batch_size():
+    return getattr(settings, 'CRM_PURGE_BATCH_SIZE', 500)
+
+
+def soft_delete(customer_id):
+    """Hide the customer at once and purge its history in the background. Returns False if already deleted."""
+    if not Customer.objects.filter(id=customer_id).update(deleted_at=timezone.now()):
+        return False
+    search.unindex_customers([customer_id])
+    caching.bump_customer_versions([customer_id])
+    tasks.submit(purge_deleted_customers)
+    return True
+
+
+def _purge_invoices(customer_id, treatments, size):
+    """Delete one batch of the customer's invoices; returns the number deleted."""
+    with transaction.atomic(), batch_delete():
+        invoices = list(
+            Invoice.objects.select_for_update().filter(customer_id=customer_id).order_by('id')
+            .values_list('id', 'date_created', 'amount', 'receipt')[:size]
+        )
+        if not invoices:
+            return 0
+        Invoice.objects.filter(id__in=[pk for pk, *_ in invoices]).delete()
+        rollups.apply(
+            (timezone.localdate(date_created), customer_id, treatments, amount, -1)
+            for _, date_created, amount, _ in invoices
+        )
+        for name in {receipt for *_, receipt in invoices}:
+            storage.release(name)
+    return len(invoices)
+
+
+def _purge_messages(model, customer_id, size):
+    with transaction.atomic(), batch_delete():
+        ids = list(model.objects.filter(customer_id=customer_id).order_by('id').values_list('id', flat=True)[:size])
+        if ids:
+            model.objects.filter(id__in=ids).delete()
+    return len(ids)
+
+
+def purge_customer(customer_id, size=None):
+    """Delete a soft-deleted customer and everything that belongs to it."""
+    size = size or batch_size()
+    treatments = rollups.treatment_ids(customer_id)
+    while _purge_invoices(customer_id, treatments, size):
+        pass
+    for model in (MessageSchedule, ArchivedMessageSchedule):
+        while _purge_messages(model, customer_id, size):
+            pass
+    # Only the treatment links and the customer's rollup row are left for the cascade
+    Customer.all_objects.filter(id=customer_id, deleted_at__isnull=False).delete()
+
+
+def purge_deleted_customers(size=None):
+    """Purge every soft-deleted customer; returns how many were purged."""
+    ids = list(Customer.all_objects.filter(deleted_at__isnull=False).order_by('id').values_list('id', flat=True))
+    for customer_id in ids:
+        purge_customer(customer_id, size)
+    return len(ids)
@@ -0,0 +1,68 @@
+"""
+Receipt conversion.
+
+Image receipts are stored as uploaded and the invoice is saved with
+``receipt_status='processing'``. ``convert_receipt`` then runs in the
+background pool (see ``crm.tasks``), encodes the image as a PDF, swaps it in
+and marks the receipt ready. The image is deleted unless another invoice
+stores the same file (see ``crm.storage``).
+
+The job only lives in memory, so a restart or crash loses it and the invoice
+stays 'processing'. ``manage.py requeue_receipts`` converts such receipts.
+"""
+import logging
+from datetime import timedelta
+from io import BytesIO
+
+from django.core.files.base import ContentFile
+from django.utils import timezone
+from PIL import Image
+
+from . import storage
+from .models import Invoice
+
+logger = logging.getLogger(__name__)
+
+
+def image_to_pdf(file):
+    """Return the bytes of a one-page PDF holding the image in ``file``."""
+    pdf_file = BytesIO()
+    with Image.open(file) as image:
+        image.convert('RGB').save(pdf_file, format='PDF')
+    return pdf_file.getvalue()
+
+
+def convert_receipt(invoice_id):
+    try:
+        invoice = Invoice.objects.get(id=invoice_id, receipt_status=Invoice.RECEIPT_PROCESSING)
+    except Invoice.DoesNotExist:
+        return
+
+    original_name = invoice.receipt.name
+    try:
+        with invoice.receipt.open('rb') as file:
+            pdf = image_to_pdf(file)
+    except Exception:
+        logger.exception("Error converting receipt of invoice %s to PDF", invoice_id)
+        Invoice.objects.filter(id=invoice_id).update(receipt_status=Invoice.RECEIPT_FAILED)
+        return
+
+    invoice.receipt.save(
+        f"invoice_{invoice.customer_id}.pdf",
+        ContentFile(pdf),
+        save=False,
+    )
+    # A requeued conversion may have finished first
+    if Invoice.objects.filter(
+        id=invoice_id, receipt=original_name, receipt_status=Invoice.RECEIPT_PROCESSING,
+    ).update(receipt=invoice.receipt.name, receipt_status=Invoice.RECEIPT_READY):
+        storage.release(original_name)
+    else:
+        storage.release(invoice.receipt.name)
+
+
+def stuck_receipts(older_than=timedelta(minutes=10)):
+    """Invoices still 'processing' ``older_than`` after their last change: their job was lost."""
+    return Invoice.objects.filter(
+        receipt_status=Invoice.RECEIPT_PROCESSING, updated_at__lt=timezone.now() - older_than,
+    )
@@ -0,0 +1,150 @@
+"""
+Live due reminders for the customer list, pushed as Server-Sent Events.
+
+Each server process runs one ``ReminderHub`` poller (per event loop) while at
+least one page is listening: every ``CRM_REMINDER_POLL_SECONDS`` it reads the
+ids of the due reminders (from ``crm_msg_pending_idx``, skipping deleted
+customers), loads the details of the new ones only, and hands the changes to
+every connected page. The cost is one small query per interval, however many pages
+are open.
+
+A page first receives a ``snapshot`` event with all due reminders, then
+``update`` events with ``added`` reminders and ``removed`` ids. The stream
+needs an ASGI server; under WSGI the endpoint answers with the snapshot and
+asks the browser to reconnect after the poll interval instead.
+"""
+import asyncio
+import json
+import logging
+import weakref
+
+from django.conf import settings
+from django.urls import reverse
+from django.utils import timezone
+
+from .models import MessageSchedule
+
+logger = logging.getLogger(__name__)
+
+# Comment line sent when nothing happened, so proxies keep the connection open
+HEARTBEAT_SECONDS = 15
+
+
+def poll_interval():
+    return getattr(settings, 'CRM_REMINDER_POLL_SECONDS', 5)
+
+
+def due_messages(now=None):
+    # A deleted customer's reminders drop out at once, not when the purge removes them
+    return MessageSchedule.objects.filter(
+        schedule_date__lte=now or timezone.now(), is_reminder_sent=False, is_sent=False,
+        customer__deleted_at__isnull=True,
+    )
+
+
+def serialize(row):
+    return {
+        'id': row['id'],
+        'customer': row['customer__name'],
+        'customer_url': reverse('customer_detail', args=[row['customer_id']]),
+        'schedule_date': row['schedule_date'].isoformat(),
+        'message_type': row['message_type'],
+    }
+
+
+def _details(ids):
+    return MessageSchedule.objects.filter(id__in=ids).order_by('schedule_date', 'id').values(
+        'id', 'customer_id', 'customer__name', 'schedule_date', 'message_type',
+    )
+
+
+def current_reminders():
+    """All due reminders, serialized (synchronous; used when there is no hub)."""
+    return [serialize(row) for row in _details(due_messages().values('id'))]
+
+
+def event(name, data, retry=None):
+    lines = [f'retry: {retry}'] if retry is not None else []
+    lines += [f'event: {name}', f'data: {json.dumps(data)}']
+    return '\n'.join(lines) + '\n\n'
+
+
+class ReminderHub:
+    def __init__(self):
+        self.reminders = {}
+        self.subscribers = set()
+        self.task = None
+        self.ready = asyncio.Event()
+
+    async def poll(self):
+        """Refresh ``reminders``; returns ``(added, removed)``."""
+        ids = {pk async for pk in due_messages().values_list('id', flat=True)}
+        removed = [pk for pk in self.reminders if pk not in ids]
+        for pk in removed:
+            del self.reminders[pk]
+        new_ids = ids.difference(self.reminders)
+        added = [serialize(row) async for row in _details(new_ids)] if new_ids else []
+        self.reminders.update((reminder['id'], reminder) for reminder in added)
+        return added, removed
+
+    async def run(self):
+        try:
+            while self.subscribers:
+                try:
+                    added, removed = await self.poll()
+                except Exception:
+                    logger.exception("Polling due reminders failed")
+                else:
+                    if added or removed:
+                        for queue in self.subscribers:
+                            queue.put_nowait({'added': added, 'removed': removed})
+                self.ready.set()
+                await asyncio.sleep(poll_interval())
+        finally:
+            # Nobody is listening, so the state would go stale
+            self.reminders = {}
+            self.ready = asyncio.Event()
+
+    async def subscribe(self):
+        """Returns ``(queue of updates, snapshot of the due reminders)``."""
+        queue = asyncio.Queue()
+        self.subscribers.add(queue)
+        if self.task is None or self.task.done():
+            self.task = asyncio.create_task(self.run())
+        await self.ready.wait()
+        # The snapshot already contains anything queued before it
+        while not queue.empty():
+            queue.get_nowait()
+        return queue, sorted(self.reminders.values(), key=lambda reminder: (reminder['schedule_date'], reminder['id']))
+
+    def unsubscribe(self, queue):
+        self.subscribers.discard(queue)
+
+
+_hubs = weakref.WeakKeyDictionary()
+
+
+def get_hub():
+    """The hub of the running event loop (one per process under an ASGI server)."""
+    loop = asyncio.get_running_loop()
+    hub = _hubs.get(loop)
+    if hub is None:
+        hub = _hubs[loop] = ReminderHub()
+    return hub
+
+
+async def stream():
+    """SSE body for one page: a snapshot, then the changes as they happen."""
+    hub = get_hub()
+    queue, snapshot = await hub.subscribe()
+    try:
+        yield event('snapshot', snapshot, retry=1000)
+        while True:
+            try:
+                update = await asyncio.wait_for(queue.get(), HEARTBEAT_SECONDS)
+            except asyncio.TimeoutError:
+                yield ': heartbeat\n\n'
+            else:
+                yield event('update', update)
+    finally:
+        hub.unsubscribe(queue)
@@ -0,0 +1,157 @@
+"""
+Revenue rollups for the reporting dashboard.
+
+``DailyRevenue`` (per day), ``DailyTreatmentRevenue`` (per day and treatment)
+and ``CustomerRevenue`` (per customer) are kept in step with Invoice by the
+signals in ``crm.signals``: every save or delete adds or subtracts the
+invoice as an ``F()`` delta, so concurrent writers never overwrite each
+other's totals and the cost does not grow with the number of invoices.
+Adding or removing a customer's treatment moves that customer's revenue
+between treatments the same way.
+
+Days are local dates (``TIME_ZONE``). Invoices written with ``bulk_create``
+are added with ``add_invoices()``; other writes that bypass the signals
+(``QuerySet.update()`` of amounts, raw SQL, ``loaddata``) must be followed by
+``rebuild()`` (``manage.py rebuild_rollups``), which also repairs any drift.
+"""
+from collections import defaultdict
+from decimal import Decimal
+
+from django.db import transaction
+from django.db.models import Count, F, Sum
+from django.db.models.functions import TruncDate, TruncMonth
+from django.utils import timezone
+
+from .models import Customer, CustomerRevenue, DailyRevenue, DailyTreatmentRevenue, Invoice
+
+
+def treatment_ids(customer_id):
+    return list(Customer.treatment.through.objects.filter(customer_id=customer_id).values_list('treatment_id', flat=True))
+
+
+def _add(model, lookup, count, amount):
+    # Removing only ever applies to rows that exist; never create one for it (the
+    # customer may be half way through a cascading delete)
+    if model.objects.filter(**lookup).update(
+        invoice_count=F('invoice_count') + count, amount=F('amount') + amount,
+    ) or count <= 0:
+        return
+    row, created = model.objects.get_or_create(**lookup, defaults={'invoice_count': count, 'amount': amount})
+    if not created:
+        # Another writer created the row between the update and the insert
+        model.objects.filter(pk=row.pk).update(invoice_count=F('invoice_count') + count, amount=F('amount') + amount)
+
+
+def apply(changes):
+    """Apply ``(day, customer_id, treatment_ids, amount, sign)`` changes, one delta per rollup row."""
+    deltas = defaultdict(lambda: [0, Decimal('0')])
+    for day, customer_id, treatments, amount, sign in changes:
+        amount = Decimal(str(amount)) * sign
+        keys = [(DailyRevenue, (('day', day),)), (CustomerRevenue, (('customer_id', customer_id),))]
+        keys += [(DailyTreatmentRevenue, (('day', day), ('treatment_id', treatment_id))) for treatment_id in treatments]
+        for key in keys:
+            deltas[key][0] += sign
+            deltas[key][1] += amount
+    with transaction.atomic():
+        for (model, lookup), (count, amount) in deltas.items():
+            if count or amount:
+                _add(model, dict(lookup), count, amount)
+
+
+def invoice_day(invoice):
+    return timezone.localdate(invoice.date_created)
+
+
+def add_invoices(invoices):
+    """Add new invoices, e.g. after a ``bulk_create`` (which sends no signals)."""
+    invoices = list(invoices)
+    treatments = defaultdict(list)
+    for customer_id, treatment_id in Customer.treatment.through.objects.filter(
+        customer_id__in={invoice.customer_id for invoice in invoices},
+    ).values_list('customer_id', 'treatment_id'):
+        treatments[customer_id].append(treatment_id)
+    apply((invoice_day(invoice), invoice.customer_id, treatments[invoice.customer_id], invoice.amount, 1)
+          for invoice in invoices)
+
+
+def remove_invoice(invoice, treatments):
+    apply([(invoice_day(invoice), invoice.customer_id, treatments, invoice.amount, -1)])
+
+
+def _daily(invoices):
+    return invoices.order_by().annotate(day=TruncDate('date_created')).values('day')
+
+
+def move_treatments(customer_ids, treatments, sign):
+    """Add (``sign=1``) or remove (``sign=-1``) the customers' revenue to/from the treatments."""
+    days = _daily(Invoice.objects.filter(customer_id__in=customer_ids)).annotate(
+        count=Count('id'), total=Sum('amount'),
+    )
+    with transaction.atomic():
+        for row in days:
+            for treatment_id in treatments:
+                _add(DailyTreatmentRevenue, {'day': row['day'], 'treatment_id': treatment_id},
+                     row['count'] * sign, row['total'] * sign)
+
+
+def rebuild(batch_size=1000):
+    """Recompute every rollup from the invoice table."""
+    invoices = Invoice.objects.all()
+    totals = {'count': Count('id'), 'total': Sum('amount')}
+    with transaction.atomic():
+        DailyRevenue.objects.all().delete()
+        DailyTreatmentRevenue.objects.all().delete()
+        CustomerRevenue.objects.all().delete()
+        DailyRevenue.objects.bulk_create(
+            (DailyRevenue(day=row['day'], invoice_count=row['count'], amount=row['total'])
+             for row in _daily(invoices).annotate(**totals).iterator()),
+            batch_size=batch_size,
+        )
+        DailyTreatmentRevenue.objects.bulk_create(
+            (DailyTreatmentRevenue(
+                day=row['day'], treatment_id=row['customer__treatment'],
+                invoice_count=row['count'], amount=row['total'],
+            ) for row in _daily(invoices.filter(customer__treatment__isnull=False))
+                .values('day', 'customer__treatment').annotate(**totals).iterator()),
+            batch_size=batch_size,
+        )
+        CustomerRevenue.objects.bulk_create(
+            (CustomerRevenue(customer_id=row['customer'], invoice_count=row['count'], amount=row['total'])
+             for row in invoices.order_by().values('customer').annotate(**totals).iterator()),
+            batch_size=batch_size,
+        )
+
+
+def report(date_from=None, date_to=None, top_customers=10):
+    """Dashboard figures, read from the rollup tables only."""
+    days = DailyRevenue.objects.filter(invoice_count__gt=0)
+    treatments = DailyTreatmentRevenue.objects.filter(invoice_count__gt=0)
+    if date_from:
+        days = days.filter(day__gte=date_from)
+        treatments = treatments.filter(day__gte=date_from)
+    if date_to:
+        days = days.filter(day__lte=date_to)
+        treatments = treatments.filter(day__lte=date_to)
+
+    months = list(
+        days.annotate(month=TruncMonth('day')).values('month')
+        .annotate(invoices=Sum('invoice_count'), revenue=Sum('amount'))
+        .order_by('month')
+    )
+
+    return {
+        'months': months,
+        'total': {
+            'invoices': sum(month['invoices'] for month in months),
+            'revenue': sum((month['revenue'] for month in months), Decimal('0')),
+        },
+        'treatments': list(
+            treatments.values('treatment__name')
+            .annotate(invoices=Sum('invoice_count'), revenue=Sum('amount'))
+            .order_by('-revenue', 'treatment__name')
+        ),
+        # All time: the per-customer rollup has no date dimension
+        'customers': list(
+            CustomerRevenue.objects.filter(invoice_count__gt=0, customer__deleted_at__isnull=True).select_related('customer').order_by('-amount')[:top_customers]
+        ),
+    }
@@ -0,0 +1,71 @@
+"""
+Read replica routing.
+
+Views decorated with ``use_replica`` read from the ``CRM_REPLICA_DATABASE``
+alias (when one is configured) for GET and HEAD requests, including the
+rows a streaming response reads while it is sent. Writes always go to the
+default database, and so does everything outside those views.
+
+Replicas lag behind the primary, so a browser that has just written (any
+POST, see ``crm.middleware.ReplicaPinningMiddleware``) carries a cookie for
+``CRM_REPLICA_PIN_SECONDS`` that keeps its reads on the primary: a customer
+created and then shown on the list does not seem to vanish.
+"""
+from contextvars import ContextVar
+from functools import wraps
+
+from django.conf import settings
+
+PIN_COOKIE = 'crm_primary'
+
+_reading_replica = ContextVar('crm_reading_replica', default=False)
+
+
+def replica_alias():
+    return getattr(settings, 'CRM_REPLICA_DATABASE', None)
+
+
+class ReplicaRouter:
+    def db_for_read(self, model, **hints):
+        if _reading_replica.get():
+            return replica_alias()
+        return None
+
+    def db_for_write(self, model, **hints):
+        return None
+
+    def allow_relation(self, obj1, obj2, **hints):
+        # Both aliases hold the same data
+        return True
+
+
+def _stream_from_replica(content):
+    # Switch per chunk: the response may be iterated in another context than the view ran in
+    iterator = iter(content)
+    while True:
+        token = _reading_replica.set(True)
+        try:
+            chunk = next(iterator, None)
+        finally:
+            _reading_replica.reset(token)
+        if chunk is None:
+            return
+        yield chunk
+
+
+def use_replica(view):
+    """Serve the safe requests of ``view`` from the read replica."""
+    @wraps(view)
+    def wrapper(request, *args, **kwargs):
+        if not replica_alias() or request.method not in ('GET', 'HEAD') or PIN_COOKIE in request.COOKIES:
+            return view(request, *args, **kwargs)
+        token = _reading_replica.set(True)
+        try:
+            response = view(request, *args, **kwargs)
+        finally:
+            _reading_replica.reset(token)
+        if response.streaming:
+            response.streaming_content = _stream_from_replica(response.streaming_content)
+        return response
+    return wrapper
+
@@ -0,0 +1,159 @@
+"""
+Indexed customer search.
+
+On SQLite, customers are mirrored into an FTS5 table using the trigram
+tokenizer, which keeps the substring semantics of the old ``icontains`` search
+while being served from an index. On PostgreSQL, a trigram GIN index over the
+same columns serves ``ILIKE '%term%'`` lookups. Both are created by migration
+0005. Terms shorter than three characters cannot use a trigram index, so they
+(and any other database backend) fall back to ``icontains``. Queries that
+look like a phone number are matched against the normalized phone columns
+instead (see ``crm.phones``): the customers whose number starts or ends with
+those digits.
+
+The FTS5 table is kept in sync by the signal handlers in ``crm.signals``;
+code that bypasses ``Model.save()`` (``bulk_create``, ``update()``) must call
+``index_customers()`` itself.
+
+Searches run on the database the routers pick for reading customers (the
+replica in ``use_replica`` views), index writes on the one for writing.
+"""
+from django.db import connections, router
+from django.db.models import Q
+from django.db.models.expressions import RawSQL
+
+from . import phones
+from .models import Customer
+
+FTS_TABLE = 'crm_customer_fts'
+SEARCH_FIELDS = ('name', 'phone_number', 'email', 'problem')
+# bm25() column weights: a hit in the name ranks above one in the problem text
+FTS_WEIGHTS = (10.0, 5.0, 2.0, 1.0)
+MIN_TERM_LENGTH = 3
+
+# Must match the expression of the crm_customer_search_trgm index exactly
+PG_DOCUMENT = "(name || ' ' || phone_number || ' ' || email || ' ' || problem)"
+
+
+def _terms(query):
+    return query.split()
+
+
+def _read_connection():
+    return connections[router.db_for_read(Customer)]
+
+
+def _write_connection(using=None):
+    return connections[using or router.db_for_write(Customer)]
+
+
+def uses_index(query, connection=None):
+    connection = connection or _read_connection()
+    terms = _terms(query)
+    return (
+        connection.vendor in ('sqlite', 'postgresql')
+        and bool(terms)
+        and all(len(term) >= MIN_TERM_LENGTH for term in terms)
+    )
+
+
+def _fts_match(terms):
+    # Quote each term so FTS5 treats it as a plain substring, not query syntax
+    return ' AND '.join('"%s"' % term.replace('"', '""') for term in terms)
+
+
+def _like_patterns(terms):
+    escaped = (term.replace('\\', '\\\\').replace('%', '\\%').replace('_', '\\_') for term in terms)
+    return ['%' + term + '%' for term in escaped]
+
+
+def _matching_ids_sql(query, connection):
+    terms = _terms(query)
+    if connection.vendor == 'sqlite':
+        return f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s", [_fts_match(terms)]
+    return f"SELECT id FROM crm_customer WHERE {PG_DOCUMENT} ILIKE ALL(%s)", [_like_patterns(terms)]
+
+
+def _fallback_filter(query):
+    condition = Q()
+    for term in _terms(query):
+        condition &= Q(name__icontains=term) | Q(phone_number__icontains=term) | Q(email__icontains=term) | Q(problem__icontains=term)
+    return condition
+
+
+def filter_customers(queryset, query):
+    """Restrict ``queryset`` to customers matching ``query`` (unranked)."""
+    if phones.is_phone_query(query):
+        return queryset.filter(phones.phone_filter(query))
+    connection = connections[queryset.db]
+    if not uses_index(query, connection):
+        return queryset.filter(_fallback_filter(query))
+    sql, params = _matching_ids_sql(query, connection)
+    return queryset.filter(id__in=RawSQL(sql, params))
+
+
+def search_customer_ids(query, limit=50, offset=0):
+    """Return the ids of ``limit`` matches for ``query``, best first, skipping the first ``offset``."""
+    if phones.is_phone_query(query):
+        return list(
+            Customer.objects.filter(phones.phone_filter(query)).order_by('name', 'id')
+            .values_list('id', flat=True)[offset:offset + limit]
+        )
+    connection = _read_connection()
+    if not uses_index(query, connection):
+        return list(
+            Customer.objects.filter(_fallback_filter(query)).order_by('name', 'id')
+            .values_list('id', flat=True)[offset:offset + limit]
+        )
+    terms = _terms(query)
+    if connection.vendor == 'sqlite':
+        weights = ', '.join(str(w) for w in FTS_WEIGHTS)
+        sql = (
+            f"SELECT rowid FROM {FTS_TABLE} WHERE {FTS_TABLE} MATCH %s "
+            f"ORDER BY bm25({FTS_TABLE}, {weights}), rowid LIMIT %s OFFSET %s"
+        )
+        params = [_fts_match(terms), limit, offset]
+    else:
+        sql = (
+            f"SELECT id FROM crm_customer WHERE {PG_DOCUMENT} ILIKE ALL(%s) "
+            f"ORDER BY word_similarity(%s, {PG_DOCUMENT}) DESC, id LIMIT %s OFFSET %s"
+        )
+        params = [_like_patterns(terms), query, limit, offset]
+    with connection.cursor() as cursor:
+        cursor.execute(sql, params)
+        return [row[0] for row in cursor.fetchall()]
+
+
+def index_customers(customers, using=None):
+    """Write ``customers`` into the SQLite FTS5 table, replacing any old entries."""
+    connection = _write_connection(using)
+    if connection.vendor != 'sqlite':
+        return
+    rows = [(c.id,) + tuple(getattr(c, field) for field in SEARCH_FIELDS) for c in customers]
+    if not rows:
+        return
+    columns = ', '.join(SEARCH_FIELDS)
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(row[0],) for row in rows])
+        cursor.executemany(
+            f"INSERT INTO {FTS_TABLE} (rowid, {columns}) VALUES (%s, %s, %s, %s, %s)", rows
+        )
+
+
+def unindex_customers(customer_ids, using=None):
+    connection = _write_connection(using)
+    if connection.vendor != 'sqlite':
+        return
+    with connection.cursor() as cursor:
+        cursor.executemany(f"DELETE FROM {FTS_TABLE} WHERE rowid = %s", [(pk,) for pk in customer_ids])
+
+
+def rebuild_index():
+    """Repopulate the SQLite FTS5 table from ``crm_customer``."""
+    connection = _write_connection()
+    if connection.vendor != 'sqlite':
+        return
+    columns = ', '.join(SEARCH_FIELDS)
+    with connection.cursor() as cursor:
+        cursor.execute(f"DELETE FROM {FTS_TABLE}")
+        cursor.execute(f"INSERT INTO {FTS_TABLE} (rowid, {columns}) SELECT id, {columns} FROM crm_customer")
@@ -0,0 +1,90 @@
+"""
+Synthetic data for benchmarks and local development (``manage.py seed_crm``).
+
+Rows are written with ``bulk_create`` in batches. Invoices share a handful of
+small receipt files rather than writing one file per invoice.
+"""
+import random
+from datetime import timedelta
+
+from django.core.files.base import ContentFile
+from django.utils import timezone
+
+from . import caching, rollups, search, storage
+from .models import Customer, Invoice, MessageSchedule, Treatment
+
+FIRST_NAMES = ['Aarav', 'Priya', 'Rahul', 'Sara', 'Omar', 'Meera', 'John', 'Fatima', 'Vikram', 'Anita',
+               'Arjun', 'Leela', 'Karan', 'Nisha', 'David', 'Zara', 'Rohan', 'Asha', 'Imran', 'Kavya']
+LAST_NAMES = ['Sharma', 'Khan', 'Patel', 'Iyer', 'Reddy', 'Smith', 'Das', 'Nair', 'Gupta', 'Ali',
+              'Mehta', 'Joshi', 'Rao', 'Singh', 'Verma', 'Fernandes', 'Bose', 'Pillai', 'Menon', 'Shah']
+PROBLEMS = ['Lower back pain', 'Neck stiffness', 'Knee injury', 'Shoulder pain', 'Sciatica',
+            'Sports injury', 'Posture correction', 'Migraine', 'Frozen shoulder', 'Ankle sprain']
+CITIES = ['Mumbai', 'Delhi', 'Bengaluru', 'Chennai', 'Hyderabad', 'Pune', 'Kochi', 'Jaipur']
+
+RECEIPT_FILES = 10
+
+
+def _receipts():
+    """Store RECEIPT_FILES small PDFs and return their storage names."""
+    names = []
+    for i in range(RECEIPT_FILES):
+        content = b'%PDF-1.4\n% seeded receipt ' + str(i).encode() + b'\n%%EOF\n'
+        names.append(storage.receipt_storage().save(f'receipts/seed-{i}.pdf', ContentFile(content)))
+    return names
+
+
+def seed(customers=1000, invoices_per_customer=2, messages_per_customer=2, batch_size=1000, random_seed=None):
+    """Create ``customers`` customers with their treatments, invoices and messages. Returns the counts."""
+    rng = random.Random(random_seed)
+    treatments = [Treatment.objects.get_or_create(name=name)[0] for name, _ in Customer.TREATMENT_CHOICES]
+    receipts = _receipts() if invoices_per_customer else []
+    now = timezone.now()
+    counts = {'customers': 0, 'invoices': 0, 'messages': 0}
+
+    for start in range(0, customers, batch_size):
+        batch = []
+        for i in range(start, min(start + batch_size, customers)):
+            first, last = rng.choice(FIRST_NAMES), rng.choice(LAST_NAMES)
+            batch.append(Customer(
+                name=f'{first} {last}',
+                email=f'{first.lower()}.{last.lower()}{i}@example.com',
+                phone_number=f'9{rng.randrange(10 ** 9):09d}',
+                address=f'{rng.randrange(1, 500)} Main Road, {rng.choice(CITIES)}',
+                problem=rng.choice(PROBLEMS),
+                age=rng.randint(18, 85),
+                sex=rng.choice('MFO'),
+            ))
+        batch = Customer.objects.bulk_create(batch)
+        Customer.treatment.through.objects.bulk_create([
+            Customer.treatment.through(customer_id=customer.id, treatment_id=treatment.id)
+            for customer in batch
+            for treatment in rng.sample(treatments, rng.randint(1, 2))
+        ])
+        search.index_customers(batch)
+        caching.bump_customer_versions(customer.id for customer in batch)
+
+        invoices = [
+            Invoice(customer=customer, amount=rng.randrange(500, 20000) / 10, receipt=rng.choice(receipts))
+            for customer in batch
+            for _ in range(invoices_per_customer)
+        ]
+        Invoice.objects.bulk_create(invoices)
+        rollups.add_invoices(invoices)
+
+        messages = []
+        for customer in batch:
+            for _ in range(messages_per_customer):
+                schedule_date = now + timedelta(minutes=rng.randint(-30 * 24 * 60, 60 * 24 * 60))
+                messages.append(MessageSchedule(
+                    customer=customer,
+                    message_content=f'Reminder for {customer.name}: your next session is coming up.',
+                    message_type=rng.choice(['SMS', 'WhatsApp']),
+                    schedule_date=schedule_date,
+                    is_sent=schedule_date < now and rng.random() < 0.8,
+                ))
+        MessageSchedule.objects.bulk_create(messages)
+
+        counts['customers'] += len(batch)
+        counts['invoices'] += len(invoices)
+        counts['messages'] += len(messages)
+    return counts
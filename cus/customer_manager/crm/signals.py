@@ -0,0 +1,127 @@
+from contextlib import contextmanager
+from contextvars import ContextVar
+
+from django.db.models.signals import m2m_changed, post_delete, post_save, pre_delete, pre_save
+from django.dispatch import receiver
+from django.utils import timezone
+
+from . import caching, rollups, search, storage
+from .models import Customer, Invoice, MessageSchedule, Treatment, refresh_next_schedule
+
+# Set by the batch deletes of crm.purge and crm.archive, which do the per-row work below per batch
+_batch_deleting = ContextVar('crm_batch_deleting', default=False)
+
+
+@contextmanager
+def batch_delete():
+    """Skip the Invoice and MessageSchedule delete handlers; the caller does their work."""
+    token = _batch_deleting.set(True)
+    try:
+        yield
+    finally:
+        _batch_deleting.reset(token)
+
+
+@receiver(post_save, sender=Customer)
+def index_customer(sender, instance, raw=False, using=None, **kwargs):
+    if not raw:
+        search.index_customers([instance], using=using)
+        caching.bump_customer_versions([instance.pk])
+
+
+@receiver(post_delete, sender=Customer)
+def unindex_customer(sender, instance, using=None, **kwargs):
+    search.unindex_customers([instance.pk], using=using)
+    caching.bump_customer_versions([instance.pk])
+
+
+@receiver(post_save, sender=MessageSchedule)
+def message_saved(sender, instance, raw=False, **kwargs):
+    if not raw:
+        refresh_next_schedule([instance.customer_id])
+
+
+@receiver(post_delete, sender=MessageSchedule)
+def message_deleted(sender, instance, **kwargs):
+    if _batch_deleting.get():
+        return
+    # A sent message never counts towards the customer's next schedule
+    if not instance.is_sent:
+        refresh_next_schedule([instance.customer_id])
+    else:
+        touch_customer(instance.customer_id)
+
+
+@receiver(pre_save, sender=Invoice)
+def invoice_saving(sender, instance, raw=False, **kwargs):
+    # What the rollups currently count for this invoice
+    if not raw and not instance._state.adding:
+        instance._rollup_previous = Invoice.objects.filter(pk=instance.pk).values(
+            'customer_id', 'amount', 'date_created',
+        ).first()
+
+
+@receiver(post_save, sender=Invoice)
+def invoice_saved(sender, instance, created, raw=False, **kwargs):
+    if raw:
+        return
+    previous = getattr(instance, '_rollup_previous', None)
+    instance._rollup_previous = None
+    if previous is None:
+        rollups.add_invoices([instance])
+        return
+    old = Invoice(**previous)
+    if (old.customer_id, old.amount, rollups.invoice_day(old)) != (
+        instance.customer_id, instance.amount, rollups.invoice_day(instance)
+    ):
+        rollups.remove_invoice(old, rollups.treatment_ids(old.customer_id))
+        rollups.add_invoices([instance])
+
+
+@receiver(pre_delete, sender=Invoice)
+def invoice_deleting(sender, instance, **kwargs):
+    if _batch_deleting.get():
+        return
+    # Read before a cascading Customer delete removes the treatment links
+    instance._rollup_treatments = rollups.treatment_ids(instance.customer_id)
+
+
+@receiver(post_delete, sender=Invoice)
+def invoice_deleted(sender, instance, **kwargs):
+    if _batch_deleting.get():
+        return
+    touch_customer(instance.customer_id)
+    storage.release(instance.receipt.name)
+    rollups.remove_invoice(instance, instance._rollup_treatments)
+
+
+@receiver(m2m_changed, sender=Customer.treatment.through)
+def customer_treatments_changed(sender, instance, action, reverse, pk_set, **kwargs):
+    # Revenue per treatment follows the customer's current treatments
+    if action == 'post_add':
+        pairs = [(pk, instance.pk) if reverse else (instance.pk, pk) for pk in pk_set]
+    elif action in ('pre_remove', 'pre_clear'):
+        links = sender.objects.filter(**{'treatment_id' if reverse else 'customer_id': instance.pk})
+        if pk_set is not None:
+            links = links.filter(**{'customer_id__in' if reverse else 'treatment_id__in': pk_set})
+        pairs = list(links.values_list('customer_id', 'treatment_id'))
+    else:
+        return
+    if not pairs:
+        return
+    sign = 1 if action == 'post_add' else -1
+    if reverse:
+        rollups.move_treatments([customer_id for customer_id, _ in pairs], [instance.pk], sign)
+    else:
+        rollups.move_treatments([instance.pk], [treatment_id for _, treatment_id in pairs], sign)
+
+
+def touch_customer(customer_id):
+    # A deleted row leaves no updated_at behind; the customer's Last-Modified moves instead
+    Customer.objects.filter(id=customer_id).update(updated_at=timezone.now())
+
+
+@receiver(post_save, sender=Treatment)
+@receiver(post_delete, sender=Treatment)
+def treatment_changed(sender, **kwargs):
+    caching.bump_treatment_version()
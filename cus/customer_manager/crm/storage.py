@@ -0,0 +1,116 @@
+"""
+Content-addressed storage for receipts.
+
+Uploads are hashed (SHA-256) while they are streamed to a temporary file and
+then moved to ``<dir>/<digest[:2]>/<digest><ext>``. Identical receipts are
+therefore stored once, and a stored name never changes content, so it doubles
+as the strong ETag of the file.
+
+There is no reference counter to keep in step: the references to a blob are
+the Invoice rows whose ``receipt`` is its name (an indexed column), and
+``release`` deletes a blob once no invoice refers to it.
+
+An upload of content that is already stored can race the deletion of the
+last invoice using it: the delete sees no reference (the upload's row is not
+committed yet) and removes the blob the upload relies on. So an upload that
+found its blob keeps its temporary copy and checks again once its row is
+committed, writing the blob back if it is gone. Both checks hold a file lock
+on ``.tmp/.lock`` (``django.core.files.locks``: ``flock`` on POSIX,
+``LockFileEx`` on Windows), which serializes them across processes.
+"""
+import hashlib
+import os
+import tempfile
+from contextlib import contextmanager
+
+from django.core.files import locks
+from django.core.files.storage import FileSystemStorage
+from django.db import transaction
+
+CHUNK_SIZE = 64 * 1024
+
+
+class ContentAddressedStorage(FileSystemStorage):
+    def get_available_name(self, name, max_length=None):
+        # The final name is derived from the content in _save
+        return name
+
+    def _save(self, name, content):
+        directory, filename = os.path.split(name)
+        extension = os.path.splitext(filename)[1].lower()
+        tmp_dir = self.path('.tmp')
+        os.makedirs(tmp_dir, exist_ok=True)
+
+        digest = hashlib.sha256()
+        if hasattr(content, 'seek'):
+            content.seek(0)
+        with tempfile.NamedTemporaryFile(dir=tmp_dir, delete=False) as tmp:
+            try:
+                for chunk in content.chunks(CHUNK_SIZE):
+                    digest.update(chunk)
+                    tmp.write(chunk)
+            except BaseException:
+                tmp.close()
+                os.unlink(tmp.name)
+                raise
+
+        hexdigest = digest.hexdigest()
+        final_name = '/'.join(part for part in (directory, hexdigest[:2], hexdigest + extension) if part)
+        with self.lock():
+            if not self.exists(final_name):
+                self._move(tmp.name, final_name)
+                return final_name
+        # Already stored; make sure it still is once the new reference is committed
+        transaction.on_commit(lambda: self._restore(tmp.name, final_name))
+        return final_name
+
+    def _move(self, tmp_name, name):
+        os.makedirs(os.path.dirname(self.path(name)), exist_ok=True)
+        # Atomic: readers see either no file or the complete one
+        os.replace(tmp_name, self.path(name))
+        if self.file_permissions_mode is not None:
+            os.chmod(self.path(name), self.file_permissions_mode)
+
+    def _restore(self, tmp_name, name):
+        with self.lock():
+            if self.exists(name):
+                os.unlink(tmp_name)
+            else:
+                self._move(tmp_name, name)
+
+    @contextmanager
+    def lock(self):
+        """Exclusive lock between blob existence checks and deletes."""
+        path = self.path(os.path.join('.tmp', '.lock'))
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'a') as lock_file:
+            locks.lock(lock_file, locks.LOCK_EX)
+            try:
+                yield
+            finally:
+                locks.unlock(lock_file)
+
+
+def receipt_storage():
+    return _receipt_storage
+
+
+_receipt_storage = ContentAddressedStorage()
+
+
+def references(name):
+    from .models import Invoice
+
+    return Invoice.objects.filter(receipt=name).count()
+
+
+def release(name):
+    """Delete the stored file ``name`` once the current transaction commits, if nothing refers to it."""
+    def delete_if_unreferenced():
+        if not name:
+            return
+        with _receipt_storage.lock():
+            if not references(name):
+                _receipt_storage.delete(name)
+
+    transaction.on_commit(delete_if_unreferenced)
@@ -0,0 +1,51 @@
+"""
+In-process background worker pool.
+
+Work that should not hold up a request (receipt conversion, ...) is handed to
+``submit()``, which runs it on a shared thread pool once the current
+transaction commits. Like a request, each job ends with
+``close_old_connections()``: the worker thread keeps its connection for
+``CONN_MAX_AGE`` unless it is broken.
+
+Set ``CRM_TASKS_INLINE = True`` to run jobs synchronously at commit time
+instead (tests, management commands).
+"""
+import logging
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from django.conf import settings
+from django.db import close_old_connections, transaction
+
+logger = logging.getLogger(__name__)
+
+_executor = None
+_executor_lock = threading.Lock()
+
+
+def get_executor():
+    global _executor
+    with _executor_lock:
+        if _executor is None:
+            _executor = ThreadPoolExecutor(
+                max_workers=getattr(settings, 'CRM_TASK_WORKERS', 2),
+                thread_name_prefix='crm-task',
+            )
+    return _executor
+
+
+def _run(func, args, kwargs):
+    try:
+        func(*args, **kwargs)
+    except Exception:
+        logger.exception("Background task %s failed", getattr(func, '__name__', func))
+    finally:
+        close_old_connections()
+
+
+def submit(func, *args, **kwargs):
+    """Run ``func(*args, **kwargs)`` in the background after the current transaction commits."""
+    if getattr(settings, 'CRM_TASKS_INLINE', False):
+        transaction.on_commit(lambda: func(*args, **kwargs))
+    else:
+        transaction.on_commit(lambda: get_executor().submit(_run, func, args, kwargs))
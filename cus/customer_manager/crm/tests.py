@@ -1,3 +1,1654 @@
-from django.test import TestCase
+import asyncio
+import csv
+import hashlib
+import json
+import os
+import re
+import shutil
+import tempfile
+from datetime import timedelta
+from decimal import Decimal
+from io import BytesIO, StringIO
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth.models import User
+from django.core.cache import cache
+from django.core import mail as django_mail
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.core.management import call_command
+from django.db import connection, connections
+from django.test import TestCase, override_settings
+from django.test.utils import CaptureQueriesContext
+from django.urls import reverse
+from django.utils import timezone
+from PIL import Image
+
+from . import (
+    archive, benchmarks, caching, campaigns, dispatch, exports, importers, mail, metrics, phones, providers, reminders,
+    rollups, search, seeding, storage,
+)
+from .forms import CustomerForm
+from .provider_stub import StubProvider
+from .routers import PIN_COOKIE
+from .models import (
+    ArchivedMessageSchedule, Campaign, Customer, CustomerRevenue, DailyRevenue, DailyTreatmentRevenue, Invoice,
+    MessageSchedule, Treatment,
+)
+
+
+def make_customer(name='Test Patient', **kwargs):
+    fields = {
+        'name': name,
+        'email': 'patient@example.com',
+        'phone_number': '9876543210',
+        'address': '1 Clinic Road',
+        'problem': 'Back pain',
+        'age': 40,
+        'sex': 'F',
+    }
+    fields.update(kwargs)
+    return Customer.objects.create(**fields)
+
+
+def make_message(customer, days=1, **kwargs):
+    fields = {
+        'customer': customer,
+        'message_content': 'Follow-up reminder',
+        'schedule_date': timezone.now() + timedelta(days=days),
+        'message_type': 'SMS',
+    }
+    fields.update(kwargs)
+    return MessageSchedule.objects.create(**fields)
+
+
+class CustomerListTests(TestCase):
+    def populate(self, count):
+        for i in range(count):
+            customer = make_customer(name=f'Patient {i}')
+            make_message(customer, days=i + 1)
+            make_message(customer, days=-1)
+
+    def test_query_count_does_not_grow_with_customers(self):
+        # ETag aggregate, customer page (due reminders are streamed separately)
+        self.populate(3)
+        with self.assertNumQueries(2):
+            self.client.get(reverse('customer_list'))
+
+        self.populate(20)
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('customer_list'))
+        self.assertEqual(len(response.context['customers']), 23)
+
+    def test_next_message_is_earliest_unsent(self):
+        customer = make_customer()
+        make_message(customer, days=1, is_sent=True)
+        later = make_message(customer, days=5)
+        earlier = make_message(customer, days=2)
+
+        response = self.client.get(reverse('customer_list'))
+        row = response.context['customers'][0]
+        self.assertEqual(row.next_message_id, earlier.id)
+        self.assertNotEqual(row.next_message_id, later.id)
+
+
+@override_settings(CUSTOMER_LIST_PAGE_SIZE=4)
+class CustomerListPaginationTests(TestCase):
+    def setUp(self):
+        self.expected = []
+        for i in range(5):
+            customer = make_customer(name=f'Scheduled {i}')
+            make_message(customer, days=5 - i)
+            self.expected.insert(0, customer.id)
+        # Two customers share a schedule date, so the id tie-breaker matters
+        same_date = timezone.now() + timedelta(days=10)
+        for i in range(2):
+            customer = make_customer(name=f'Same date {i}')
+            make_message(customer, schedule_date=same_date)
+            self.expected.append(customer.id)
+        for i in range(4):
+            self.expected.append(make_customer(name=f'Unscheduled {i}').id)
+
+    def test_feed_walks_every_customer_once_in_list_order(self):
+        response = self.client.get(reverse('customer_list'))
+        seen = [c.id for c in response.context['customers']]
+        cursor = response.context['next_cursor']
+        while cursor:
+            response = self.client.get(reverse('customer_list_feed'), {'cursor': cursor})
+            data = response.json()
+            self.assertTrue(data['success'])
+            seen.extend(int(pk) for pk in re.findall(r'data-customer-id="(\d+)"', data['html']))
+            cursor = data['next_cursor']
+        self.assertEqual(seen, self.expected)
+
+    def test_deep_page_costs_the_same_as_first_page(self):
+        response = self.client.get(reverse('customer_list'))
+        cursor = response.context['next_cursor']
+        # ETag aggregate and the page itself
+        with self.assertNumQueries(2):
+            response = self.client.get(reverse('customer_list_feed'), {'cursor': cursor})
+        cursor = response.json()['next_cursor']
+        with self.assertNumQueries(2):
+            self.client.get(reverse('customer_list_feed'), {'cursor': cursor})
+
+    def test_invalid_cursor_is_rejected(self):
+        response = self.client.get(reverse('customer_list_feed'), {'cursor': 'not-a-cursor'})
+        self.assertEqual(response.status_code, 400)
+        self.assertFalse(response.json()['success'])
+
+
+@override_settings(CRM_MESSAGE_BACKEND='crm.dispatch.LocMemBackend')
+class DispatcherTests(TestCase):
+    def setUp(self):
+        dispatch.outbox.clear()
+        self.customer = make_customer()
+
+    def test_only_due_unsent_messages_are_claimed(self):
+        due = make_message(self.customer, days=-1)
+        make_message(self.customer, days=-1, is_sent=True)
+        make_message(self.customer, days=3)
+
+        claimed = dispatch.claim_due_messages()
+        self.assertEqual([m.id for m in claimed], [due.id])
+        # A second worker finds nothing left to claim
+        self.assertEqual(dispatch.claim_due_messages(), [])
+
+    def test_stale_claims_are_reclaimed(self):
+        due = make_message(self.customer, days=-1)
+        dispatch.claim_due_messages()
+        later = timezone.now() + timedelta(seconds=601)
+        self.assertEqual([m.id for m in dispatch.claim_due_messages(now=later)], [due.id])
+
+    def test_command_sends_due_messages_in_batches(self):
+        for _ in range(5):
+            make_message(self.customer, days=-1)
+        pending = make_message(self.customer, days=2)
+
+        call_command('dispatch_messages', '--once', '--batch-size=2', stdout=StringIO())
+
+        self.assertEqual(len(dispatch.outbox), 5)
+        self.assertEqual(MessageSchedule.objects.filter(is_sent=True).count(), 5)
+        pending.refresh_from_db()
+        self.assertFalse(pending.is_sent)
+
+    def test_failed_messages_are_released(self):
+        class FailingBackend(dispatch.BaseMessageBackend):
+            def send_messages(self, messages):
+                return []
+
+        message = make_message(self.customer, days=-1)
+        self.assertEqual(dispatch.dispatch_due_messages(FailingBackend()), (0, 1))
+        message.refresh_from_db()
+        self.assertFalse(message.is_sent)
+        self.assertIsNone(message.claimed_at)
+
+
+class CustomerSearchTests(TestCase):
+    def setUp(self):
+        self.alice = make_customer(name='Alice Fernandes', phone_number='9811122233', problem='Knee pain')
+        self.bob = make_customer(name='Bob Mathew', phone_number='9744455566', email='bob@clinic.in',
+                                 problem='Referred by Alice')
+
+    def search(self, query):
+        response = self.client.get(reverse('customer_list'), {'search': query})
+        return [c.id for c in response.context['customers']]
+
+    def test_substring_match_on_name_email_and_problem(self):
+        self.assertEqual(self.search('fernand'), [self.alice.id])
+        self.assertEqual(self.search('clinic.in'), [self.bob.id])
+        self.assertEqual(self.search('knee'), [self.alice.id])
+
+    def test_name_matches_rank_first(self):
+        self.assertEqual(self.search('alice'), [self.alice.id, self.bob.id])
+
+    def test_index_follows_saves_and_deletes(self):
+        self.alice.name = 'Alicia Rao'
+        self.alice.save()
+        self.assertEqual(self.search('fernandes'), [])
+        self.assertEqual(self.search('alicia'), [self.alice.id])
+        self.bob.delete()
+        self.assertEqual(self.search('mathew'), [])
+
+    def test_short_terms_fall_back_to_a_scan(self):
+        self.assertEqual(self.search('Bo'), [self.bob.id])
+
+    def test_phone_numbers_match_by_prefix_or_suffix(self):
+        self.assertEqual(self.search('97444'), [self.bob.id])
+        self.assertEqual(self.search('55566'), [self.bob.id])
+        self.assertEqual(self.search('+91 97444-55566'), [self.bob.id])
+        self.assertEqual(self.search('098111'), [self.alice.id])
+        # Only the ends of the number match, not the middle
+        self.assertEqual(self.search('4445'), [])
+
+    @override_settings(CUSTOMER_LIST_PAGE_SIZE=2)
+    def test_feed_walks_every_search_match(self):
+        matches = [self.alice.id, self.bob.id] + [
+            make_customer(name=f'Alice {i}', problem='Back pain').id for i in range(3)
+        ]
+        make_customer(name='Carol Dsouza')
+        for query in ('alice', 'Al'):
+            response = self.client.get(reverse('customer_list'), {'search': query})
+            seen = [c.id for c in response.context['customers']]
+            cursor = response.context['next_cursor']
+            self.assertEqual(cursor, '2')
+            while cursor:
+                data = self.client.get(reverse('customer_list_feed'), {'search': query, 'cursor': cursor}).json()
+                seen.extend(int(pk) for pk in re.findall(r'data-customer-id="(\d+)"', data['html']))
+                cursor = data['next_cursor']
+            self.assertEqual(sorted(seen), sorted(matches))
+            self.assertEqual(len(seen), len(set(seen)))
+        response = self.client.get(reverse('customer_list_feed'), {'search': 'alice', 'cursor': '-1'})
+        self.assertEqual(response.status_code, 400)
+
+
+@skipUnless(connection.vendor == 'sqlite', "EXPLAIN output checked here is SQLite's")
+class MessageScheduleIndexTests(TestCase):
+    def setUp(self):
+        self.customer = make_customer()
+        for days in range(-3, 3):
+            make_message(self.customer, days=days)
+
+    def assertUsesIndex(self, queryset, index_name):
+        plan = queryset.explain()
+        self.assertIn(f'USING INDEX {index_name}', plan.replace('COVERING INDEX', 'INDEX'))
+        self.assertNotRegex(plan, r'SCAN crm_messageschedule(?! USING)')
+
+    def test_due_reminders_use_pending_index(self):
+        queryset = MessageSchedule.objects.filter(
+            schedule_date__lte=timezone.now(), is_reminder_sent=False, is_sent=False
+        )
+        self.assertUsesIndex(queryset, 'crm_msg_pending_idx')
+
+    def test_next_message_uses_customer_index(self):
+        queryset = MessageSchedule.objects.filter(
+            customer=self.customer, is_sent=False
+        ).order_by('schedule_date', 'id')[:1]
+        self.assertUsesIndex(queryset, 'crm_msg_customer_unsent_idx')
+
+    def test_customer_detail_messages_use_customer_index(self):
+        queryset = MessageSchedule.objects.filter(customer=self.customer, is_sent=False)
+        self.assertUsesIndex(queryset, 'crm_msg_customer_unsent_idx')
+
+    def test_dispatcher_claim_uses_pending_index(self):
+        queryset = dispatch.claimable_messages(timezone.now()).order_by('schedule_date', 'id')
+        self.assertUsesIndex(queryset, 'crm_msg_pending_idx')
+
+
+def make_image_upload(name='receipt.png'):
+    buffer = BytesIO()
+    Image.new('RGB', (40, 30), 'white').save(buffer, format='PNG')
+    return SimpleUploadedFile(name, buffer.getvalue(), content_type='image/png')
+
+
+class MediaRootMixin:
+    def setUp(self):
+        super().setUp()
+        media_root = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, media_root, ignore_errors=True)
+        override = override_settings(MEDIA_ROOT=media_root, CRM_TASKS_INLINE=True)
+        override.enable()
+        self.addCleanup(override.disable)
+
+
+class ReceiptConversionTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = make_customer()
+
+    def post_invoice(self, receipt):
+        return self.client.post(
+            reverse('invoice_create', args=[self.customer.id]),
+            {'customer': self.customer.id, 'amount': '150.00', 'receipt': receipt},
+        )
+
+    def test_image_is_stored_and_converted_after_the_response(self):
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.post_invoice(make_image_upload())
+        invoice = Invoice.objects.get()
+        self.assertEqual(invoice.receipt_status, Invoice.RECEIPT_PROCESSING)
+        image_path = invoice.receipt.path
+        status = self.client.get(reverse('invoice_receipt_status', args=[invoice.id])).json()
+        self.assertEqual(status['status'], 'processing')
+        self.assertIsNone(status['receipt_url'])
+
+        # The replaced image is released when the conversion commits
+        with self.captureOnCommitCallbacks(execute=True):
+            for callback in callbacks:
+                callback()
+
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.receipt_status, Invoice.RECEIPT_READY)
+        self.assertTrue(invoice.receipt.name.endswith('.pdf'))
+        self.assertTrue(invoice.receipt.read().startswith(b'%PDF'))
+        self.assertFalse(os.path.exists(image_path))
+        status = self.client.get(reverse('invoice_receipt_status', args=[invoice.id])).json()
+        self.assertEqual(status['receipt_url'], reverse('receipt_download', args=[invoice.id]))
+
+    def test_pdf_is_ready_immediately(self):
+        pdf = SimpleUploadedFile('receipt.pdf', b'%PDF-1.4 test', content_type='application/pdf')
+        with self.captureOnCommitCallbacks() as callbacks:
+            self.post_invoice(pdf)
+        self.assertEqual(callbacks, [])
+        self.assertEqual(Invoice.objects.get().receipt_status, Invoice.RECEIPT_READY)
+
+    def test_lost_conversions_are_requeued(self):
+        # The worker died with the job: the on-commit callback never runs
+        with self.captureOnCommitCallbacks():
+            self.post_invoice(make_image_upload())
+        invoice = Invoice.objects.get()
+
+        out = StringIO()
+        call_command('requeue_receipts', stdout=out)
+        self.assertIn('Converted 0 stuck receipt(s).', out.getvalue())
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.receipt_status, Invoice.RECEIPT_PROCESSING)
+
+        with self.captureOnCommitCallbacks(execute=True):
+            call_command('requeue_receipts', older_than=0, stdout=out)
+        self.assertIn('Converted 1 stuck receipt(s).', out.getvalue())
+        invoice.refresh_from_db()
+        self.assertEqual(invoice.receipt_status, Invoice.RECEIPT_READY)
+        self.assertTrue(invoice.receipt.read().startswith(b'%PDF'))
+
+    def test_unreadable_image_is_rejected(self):
+        broken = SimpleUploadedFile('receipt.png', b'not an image', content_type='image/png')
+        response = self.post_invoice(broken)
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse(Invoice.objects.exists())
+
+
+class CustomerImportTests(TestCase):
+    header = 'name,email,phone_number,address,problem,age,sex,treatment\n'
+
+    def setUp(self):
+        self.physio = Treatment.objects.create(name='Physiotherapy')
+        self.hijama = Treatment.objects.create(name='Hijama')
+
+    def csv_file(self, *lines):
+        return BytesIO((self.header + ''.join(lines)).encode())
+
+    def test_valid_rows_are_bulk_inserted_with_treatments(self):
+        rows = importers.read_rows(self.csv_file(
+            'Asha,asha@example.com,9876500001,Road 1,Neck pain,31,F,Physiotherapy; hijama\n',
+            'Ravi,ravi@example.com,9876500002,Road 2,Back pain,45,M,Hijama\n',
+            'Meena,meena@example.com,9876500003,Road 3,Shoulder,52,F,Physiotherapy\n',
+        ))
+        # One treatment lookup, then a fixed 6 queries per batch (savepoint, release,
+        # customers, through-rows and two search index writes), however big the batch
+        with self.assertNumQueries(1 + 6 * 2):
+            result = importers.import_customers(rows, batch_size=2)
+        self.assertEqual(result, {'created': 3, 'rejected': 0})
+        asha = Customer.objects.get(name='Asha')
+        self.assertEqual(set(asha.treatment.all()), {self.physio, self.hijama})
+
+    def test_invalid_rows_are_reported_and_skipped(self):
+        rejects = []
+        rows = importers.read_rows(self.csv_file(
+            'Asha,asha@example.com,98765,Road 1,Neck pain,31,F,Physiotherapy\n',
+            'Ravi,not-an-email,9876500002,Road 2,Back pain,45,X,Reiki\n',
+            'Meena,meena@example.com,9876500003,Road 3,Shoulder,52,F,Physiotherapy\n',
+        ))
+        result = importers.import_customers(rows, on_reject=lambda line, errors: rejects.append((line, errors)))
+        self.assertEqual(result, {'created': 1, 'rejected': 2})
+        self.assertEqual([line for line, _ in rejects], [2, 3])
+        self.assertIn('phone_number', rejects[0][1])
+        self.assertEqual(set(rejects[1][1]), {'email', 'sex', 'treatment'})
+
+    def test_upload_view(self):
+        upload = SimpleUploadedFile('patients.csv', self.csv_file(
+            'Asha,asha@example.com,9876500001,Road 1,Neck pain,31,F,Physiotherapy\n',
+        ).getvalue(), content_type='text/csv')
+        response = self.client.post(reverse('customer_import'), {'file': upload},
+                                    HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertEqual(response.json()['created'], 1)
+        response = self.client.get(reverse('customer_list'), {'search': 'asha'})
+        self.assertEqual([c.name for c in response.context['customers']], ['Asha'])
+
+    def test_command_writes_rejects(self):
+        directory = tempfile.mkdtemp()
+        self.addCleanup(shutil.rmtree, directory)
+        path = os.path.join(directory, 'patients.csv')
+        with open(path, 'wb') as file:
+            file.write(self.csv_file('Ravi,ravi@example.com,123,Road 2,Back pain,45,M,Hijama\n').getvalue())
+        out = StringIO()
+        call_command('import_customers', path, '--rejects', path + '.rejects', stdout=out)
+        self.assertIn('Imported 0 customer(s), rejected 1 row(s).', out.getvalue())
+        with open(path + '.rejects') as file:
+            self.assertTrue(file.read().startswith('2,phone_number:'))
+
+
+class ExportTests(TestCase):
+    def setUp(self):
+        physio = Treatment.objects.create(name='Physiotherapy')
+        hijama = Treatment.objects.create(name='Hijama')
+        self.customers = [make_customer(name=f'Patient {i}') for i in range(5)]
+        self.customers[0].treatment.set([physio, hijama])
+        self.customers[3].treatment.set([physio])
+        make_message(self.customers[1], message_content='Hello, "friend"')
+
+    def export(self, table, chunk_size):
+        return list(csv.reader(''.join(exports.stream_csv(table, chunk_size)).splitlines()))
+
+    def test_customers_are_exported_with_one_treatment_query_per_chunk(self):
+        # One streaming customer query, plus one treatment query per chunk of 2
+        with self.assertNumQueries(1 + 3):
+            rows = self.export('customers', chunk_size=2)
+        self.assertEqual(rows[0][-1], 'treatments')
+        self.assertEqual(len(rows), 6)
+        self.assertEqual(rows[1][-1], 'Hijama; Physiotherapy')
+        self.assertEqual(rows[4][-1], 'Physiotherapy')
+        self.assertEqual(rows[2][-1], '')
+
+    def test_messages_export_quotes_content(self):
+        rows = self.export('messages', chunk_size=100)
+        self.assertEqual(rows[1][2], 'Patient 1')
+        self.assertEqual(rows[1][-1], 'Hello, "friend"')
+
+    def test_export_view_streams(self):
+        response = self.client.get(reverse('export_table', args=['invoices']))
+        self.assertTrue(response.streaming)
+        self.assertEqual(b''.join(response.streaming_content).splitlines()[0],
+                         b'id,customer_id,customer__name,amount,date_created,receipt')
+        self.assertEqual(self.client.get(reverse('export_table', args=['secrets'])).status_code, 404)
+
+
+class NextScheduleColumnTests(TestCase):
+    def setUp(self):
+        self.customer = make_customer()
+
+    def assertNextSchedule(self, expected):
+        self.customer.refresh_from_db()
+        self.assertEqual(self.customer.next_schedule_date, expected)
+        self.assertEqual(self.customer.has_pending_message, expected is not None)
+
+    def test_columns_follow_message_writes(self):
+        self.assertNextSchedule(None)
+        later = make_message(self.customer, days=5)
+        sooner = make_message(self.customer, days=2)
+        self.assertNextSchedule(sooner.schedule_date)
+
+        sooner.is_sent = True
+        sooner.save()
+        self.assertNextSchedule(later.schedule_date)
+
+        later.delete()
+        self.assertNextSchedule(None)
+
+    def test_columns_follow_bulk_writes(self):
+        messages = MessageSchedule.objects.bulk_create([
+            MessageSchedule(customer=self.customer, message_content='Hi', message_type='SMS',
+                            schedule_date=timezone.now() + timedelta(days=days))
+            for days in (3, 1)
+        ])
+        self.assertNextSchedule(messages[1].schedule_date)
+
+        # The dispatcher marks messages sent with a queryset update
+        dispatch.dispatch_due_messages(dispatch.LocMemBackend(), now=timezone.now() + timedelta(days=2))
+        self.assertNextSchedule(messages[0].schedule_date)
+
+        other = make_customer(name='Other')
+        MessageSchedule.objects.filter(customer=self.customer).update(customer=other)
+        self.assertNextSchedule(None)
+        other.refresh_from_db()
+        self.assertTrue(other.has_pending_message)
+
+    def test_repair_command(self):
+        message = make_message(self.customer, days=1)
+        Customer.objects.update(next_schedule_date=None, has_pending_message=False)
+        call_command('refresh_schedule_columns', stdout=StringIO())
+        self.assertNextSchedule(message.schedule_date)
+
+    @skipUnless(connection.vendor == 'sqlite', "EXPLAIN output checked here is SQLite's")
+    def test_list_order_reads_the_index(self):
+        plan = Customer.objects.order_by('-has_pending_message', 'next_schedule_date', 'id')[:50].explain()
+        self.assertIn('crm_customer_list_order_idx', plan)
+        self.assertNotIn('TEMP B-TREE', plan)
+
+
+class ReferenceDataCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        Treatment.objects.create(name='Physiotherapy')
+
+    def test_add_customer_modal_costs_no_queries_once_warm(self):
+        self.client.get(reverse('customer_create'))
+        with self.assertNumQueries(0):
+            response = self.client.get(reverse('customer_create'))
+        self.assertContains(response, 'Physiotherapy')
+        self.assertContains(response, 'csrfmiddlewaretoken')
+
+    def test_treatment_changes_invalidate_the_cache(self):
+        self.client.get(reverse('customer_create'))
+        Treatment.objects.create(name='Hijama')
+        self.assertContains(self.client.get(reverse('customer_create')), 'Hijama')
+        Treatment.objects.filter(name='Physiotherapy').get().delete()
+        self.assertNotContains(self.client.get(reverse('customer_create')), 'Physiotherapy')
+
+    def test_edit_form_keeps_selected_treatments(self):
+        customer = make_customer()
+        customer.treatment.set(Treatment.objects.all())
+        response = self.client.get(reverse('customer_update', args=[customer.id]))
+        self.assertContains(response, 'checked')
+
+    def test_customer_detail_loads_treatments_once(self):
+        customer = make_customer()
+        customer.treatment.set(Treatment.objects.all())
+        # ETag aggregate, customer, treatments, invoices, messages
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('customer_detail', args=[customer.id]))
+        self.assertContains(response, 'Physiotherapy')
+
+
+@override_settings(CRM_TASKS_INLINE=True)
+class CampaignTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        self.physio = Treatment.objects.create(name='Physiotherapy')
+        self.targets = []
+        for i in range(5):
+            customer = make_customer(name=f'Physio {i}', age=30 + i, sex='F')
+            customer.treatment.add(self.physio)
+            self.targets.append(customer)
+        make_customer(name='Too old', age=80, sex='F').treatment.add(self.physio)
+        make_customer(name='No treatment', age=31, sex='F')
+        make_customer(name='Male patient', age=31, sex='M').treatment.add(self.physio)
+        self.start = timezone.now() + timedelta(hours=1)
+
+    def create_campaign(self, **kwargs):
+        fields = {
+            'name': 'Holiday closure', 'message_content': 'Closed on Monday', 'message_type': 'SMS',
+            'treatment': self.physio, 'min_age': 18, 'max_age': 60, 'sex': 'F',
+            'start_date': self.start, 'messages_per_minute': 2,
+        }
+        fields.update(kwargs)
+        return Campaign.objects.create(**fields)
+
+    def test_messages_are_generated_in_batches_and_staggered(self):
+        campaign = self.create_campaign()
+        self.assertEqual(campaigns.schedule_campaign(campaign.id, batch_size=2), 5)
+
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.recipient_count, campaign.scheduled_count), (5, 5))
+        messages = list(MessageSchedule.objects.filter(campaign=campaign).order_by('customer_id'))
+        self.assertEqual([m.customer_id for m in messages], [c.id for c in self.targets])
+        offsets = [(m.schedule_date - self.start) // timedelta(minutes=1) for m in messages]
+        self.assertEqual(offsets, [0, 0, 1, 1, 2])
+        self.targets[0].refresh_from_db()
+        self.assertTrue(self.targets[0].has_pending_message)
+
+    def test_interrupted_campaign_is_resumed(self):
+        campaign = self.create_campaign()
+        campaigns.schedule_campaign(campaign.id, batch_size=2)
+        # As if the job had died after its first batch
+        MessageSchedule.objects.filter(campaign=campaign, customer__in=self.targets[2:]).delete()
+        Campaign.objects.filter(id=campaign.id).update(scheduled_count=2)
+
+        out = StringIO()
+        call_command('resume_campaigns', stdout=out)
+        self.assertIn('Resumed 0 campaign(s).', out.getvalue())
+        stale = timezone.now() - timedelta(hours=1)
+        Campaign.objects.filter(id=campaign.id).update(updated_at=stale)
+        call_command('resume_campaigns', stdout=out)
+        self.assertIn('Resumed 1 campaign(s).', out.getvalue())
+
+        campaign.refresh_from_db()
+        self.assertEqual((campaign.recipient_count, campaign.scheduled_count), (5, 5))
+        messages = MessageSchedule.objects.filter(campaign=campaign).order_by('customer_id')
+        self.assertEqual([m.customer_id for m in messages], [c.id for c in self.targets])
+        self.assertEqual(campaigns.resume_campaigns(timedelta(0)), 0)
+
+    def test_slow_job_stops_once_its_campaign_is_claimed(self):
+        campaign = self.create_campaign()
+        campaigns.schedule_campaign(campaign.id, batch_size=2)
+        MessageSchedule.objects.filter(campaign=campaign, customer__in=self.targets[2:]).delete()
+        stale = timezone.now() - timedelta(hours=1)
+        Campaign.objects.filter(id=campaign.id).update(scheduled_count=2, updated_at=stale)
+        self.assertEqual(campaigns.resume_campaigns(batch_size=2), 1)
+
+        # The original job wakes up holding its old heartbeat: it must not schedule anything
+        Campaign.objects.filter(id=campaign.id).update(scheduled_count=2)
+        MessageSchedule.objects.filter(campaign=campaign, customer__in=self.targets[2:]).delete()
+        campaigns.schedule_campaign(campaign.id, batch_size=2, claimed_at=stale)
+        self.assertEqual(MessageSchedule.objects.filter(campaign=campaign).count(), 2)
+        self.assertEqual(campaigns.resume_campaigns(), 0)
+
+    def test_dispatch_updates_sent_counter(self):
+        campaign = self.create_campaign()
+        campaigns.schedule_campaign(campaign.id)
+        dispatch.dispatch_due_messages(dispatch.LocMemBackend(), now=self.start + timedelta(minutes=1, seconds=1))
+        campaign.refresh_from_db()
+        self.assertEqual(campaign.sent_count, 4)
+
+    def test_dispatch_rate_limit_paces_batches(self):
+        campaign = self.create_campaign()
+        campaigns.schedule_campaign(campaign.id)
+        with mock.patch('crm.dispatch.time.sleep') as sleep:
+            sent, _ = dispatch.dispatch_due_messages(
+                dispatch.LocMemBackend(), batch_size=100, now=self.start + timedelta(hours=1), rate=2
+            )
+        self.assertEqual(sent, 5)
+        # Batches are capped at the rate (2, 2, 1), each followed by a pause until
+        # the average is back under it
+        self.assertEqual(sleep.call_count, 3)
+
+    def test_create_view_schedules_campaign(self):
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(reverse('campaign_create'), {
+                'name': 'Check-up', 'message_content': 'Time for a check-up', 'message_type': 'WhatsApp',
+                'treatment': self.physio.id, 'sex': '', 'search': '',
+                'start_date': self.start.strftime('%Y-%m-%dT%H:%M'), 'messages_per_minute': 60,
+            })
+        self.assertRedirects(response, reverse('campaign_list'))
+        campaign = Campaign.objects.get()
+        # Every physiotherapy patient, whatever their age or sex
+        self.assertEqual(campaign.scheduled_count, 7)
+        self.assertContains(self.client.get(reverse('campaign_list')), 'Check-up')
+
+
+@override_settings(EMAIL_BACKEND='django.core.mail.backends.locmem.EmailBackend')
+class InvoiceEmailTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = make_customer(email='patient@example.com')
+        self.invoices = [
+            Invoice.objects.create(
+                customer=self.customer, amount='100.00',
+                receipt=SimpleUploadedFile(f'receipt{i}.pdf', b'%PDF-1.4 test', content_type='application/pdf'),
+            )
+            for i in range(3)
+        ]
+
+    def test_invoices_share_one_connection(self):
+        with mock.patch('crm.mail.get_connection', wraps=mail.get_connection) as get_connection:
+            sent = mail.send_invoice_emails(Invoice.objects.all(), batch_size=2)
+        self.assertEqual(sent, (3, 0))
+        get_connection.assert_called_once()
+        self.assertEqual(len(django_mail.outbox), 3)
+        filename, content, mimetype = django_mail.outbox[0].attachments[0]
+        self.assertTrue(filename.endswith('.pdf'))
+        self.assertEqual((content, mimetype), (b'%PDF-1.4 test', 'application/pdf'))
+
+    def test_processing_receipt_is_not_attached(self):
+        Invoice.objects.filter(id=self.invoices[0].id).update(receipt_status=Invoice.RECEIPT_PROCESSING)
+        mail.send_invoice_emails(Invoice.objects.filter(id=self.invoices[0].id))
+        self.assertEqual(django_mail.outbox[0].attachments, [])
+
+    def test_single_invoice_view_queues_email(self):
+        url = reverse('send_invoice_email', args=[self.customer.id, self.invoices[0].id])
+        with self.captureOnCommitCallbacks() as callbacks:
+            response = self.client.get(url)
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(django_mail.outbox, [])
+        for callback in callbacks:
+            callback()
+        self.assertEqual(len(django_mail.outbox), 1)
+        self.assertIn(f'Invoice #{self.invoices[0].id}', django_mail.outbox[0].subject)
+
+    def test_bulk_view_filters_by_date(self):
+        Invoice.objects.filter(id=self.invoices[0].id).update(date_created=timezone.now() - timedelta(days=30))
+        today = timezone.localdate().isoformat()
+        with self.captureOnCommitCallbacks(execute=True):
+            response = self.client.post(
+                reverse('send_invoice_email_bulk'),
+                {'customer': self.customer.id, 'date_from': today, 'date_to': today},
+                HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+            )
+        self.assertEqual(response.json()['queued'], 2)
+        self.assertEqual(len(django_mail.outbox), 2)
+
+    def test_bulk_view_needs_a_customer_or_dates(self):
+        for data in ({}, {'date_from': timezone.localdate().isoformat()}):
+            with self.captureOnCommitCallbacks() as callbacks:
+                response = self.client.post(
+                    reverse('send_invoice_email_bulk'), data, HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+                )
+            self.assertFalse(response.json()['success'])
+            self.assertEqual(callbacks, [])
+
+    def test_failed_invoices_are_logged_one_by_one(self):
+        real_email = mail.invoice_email
+
+        def invoice_email(invoice):
+            if invoice.id == self.invoices[0].id:
+                raise ValueError("Unreadable receipt")
+            return real_email(invoice)
+
+        with mock.patch('crm.mail.invoice_email', invoice_email), self.assertLogs('crm.mail', 'ERROR') as logs:
+            # The other invoices of the batch are sent and counted as sent
+            self.assertEqual(mail.send_invoice_emails(Invoice.objects.all()), (2, 1))
+            self.assertEqual(mail.send_invoices_job(customer_id=self.customer.id), 2)
+        self.assertIn(f'Failed to email invoice {self.invoices[0].id}', logs.output[0])
+        self.assertIn('2 invoice(s), 1 failed', logs.output[-1])
+        self.assertEqual(len(django_mail.outbox), 4)
+
+
+class ProviderClientTests(TestCase):
+    def setUp(self):
+        self.stub = StubProvider().start()
+        self.addCleanup(self.stub.stop)
+        self.sleeps = []
+
+    def make_client(self, **kwargs):
+        options = {'batch_size': 2, 'rate': 0, 'sleep': self.sleeps.append}
+        options.update(kwargs)
+        client = providers.ProviderClient(self.stub.url, **options)
+        self.addCleanup(client.close)
+        return client
+
+    def outbound(self, count, to='9876543210'):
+        return [providers.outbound(i, to, 'SMS', f'Message {i}') for i in range(count)]
+
+    def test_batches_share_a_keep_alive_connection(self):
+        accepted = self.make_client().send(self.outbound(5))
+        self.assertEqual(accepted, ['0', '1', '2', '3', '4'])
+        self.assertEqual(self.stub.requests, 3)
+        self.assertEqual(self.stub.connections, 1)
+        self.assertEqual(self.stub.received[0]['channel'], 'sms')
+
+    def test_rejected_messages_are_not_accepted(self):
+        self.stub.reject.add('000')
+        messages = self.outbound(1) + [providers.outbound('bad', '000', 'SMS', 'x')]
+        self.assertEqual(self.make_client().send(messages), ['0'])
+
+    def test_server_errors_are_retried_with_backoff(self):
+        self.stub.fail_next(503, 500)
+        self.assertEqual(self.make_client().send(self.outbound(2)), ['0', '1'])
+        self.assertEqual(self.stub.requests, 3)
+        self.assertEqual(self.sleeps, [0.5, 1.0])
+
+    def test_client_errors_are_not_retried(self):
+        self.stub.fail_next(400)
+        with self.assertLogs('crm.providers', 'ERROR'):
+            self.assertEqual(self.make_client().send(self.outbound(2)), [])
+        self.assertEqual(self.stub.requests, 1)
+
+    def test_circuit_opens_after_repeated_failures(self):
+        client = self.make_client(max_retries=0, failure_threshold=2, reset_timeout=60)
+        self.stub.fail_next(500, 500)
+        with self.assertLogs('crm.providers', 'WARNING') as logs:
+            self.assertEqual(client.send(self.outbound(6)), [])
+        self.assertIn('circuit open', logs.output[-1])
+        # Two failed batches open the circuit; the third is not attempted
+        self.assertEqual(self.stub.requests, 2)
+        with self.assertRaises(providers.CircuitOpenError):
+            client.send_batch(self.outbound(1))
+
+        client.breaker.opened_at -= 60
+        self.assertEqual(client.send(self.outbound(1)), ['0'])
+        self.assertEqual(client.breaker.state, providers.CircuitBreaker.CLOSED)
+
+    def test_token_bucket_limits_rate(self):
+        now = [0.0]
+        sleeps = []
+        bucket = providers.TokenBucket(rate=10, capacity=5, clock=lambda: now[0], sleep=sleeps.append)
+        bucket.acquire(5)
+        self.assertEqual(sleeps, [])
+        bucket.acquire(5)
+        self.assertEqual(sleeps, [0.5])
+        now[0] = 1.0
+        bucket.acquire(5)
+        self.assertEqual(sleeps, [0.5])
+
+    def test_dispatcher_sends_through_provider(self):
+        customer = make_customer()
+        messages = [make_message(customer, days=-1) for _ in range(3)]
+        with override_settings(CRM_PROVIDER={'BASE_URL': self.stub.url, 'RATE': 0}):
+            sent, failed = dispatch.dispatch_due_messages(dispatch.ProviderBackend())
+        self.assertEqual((sent, failed), (3, 0))
+        self.assertEqual({m['id'] for m in self.stub.received}, {str(m.id) for m in messages})
+        self.assertFalse(MessageSchedule.objects.filter(is_sent=False).exists())
+
+    @override_settings(CRM_TASKS_INLINE=True)
+    def test_invoice_whatsapp_is_sent_in_the_background(self):
+        customer = make_customer(phone_number='098765 43210')
+        invoice = Invoice.objects.create(customer=customer, amount='75.00', receipt='receipts/r.pdf')
+        url = reverse('send_invoice_whatsapp', args=[customer.id, invoice.id])
+        with override_settings(CRM_PROVIDER={'BASE_URL': self.stub.url, 'RATE': 0}):
+            with self.captureOnCommitCallbacks(execute=True):
+                response = self.client.get(url)
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(self.stub.received[0]['id'], f'invoice-{invoice.id}')
+        self.assertEqual(self.stub.received[0]['channel'], 'whatsapp')
+        self.assertEqual(self.stub.received[0]['to'], '919876543210')
+
+    def test_invoice_whatsapp_without_a_provider_is_not_sent(self):
+        invoice = Invoice.objects.create(customer=make_customer(), amount='75.00', receipt='receipts/r.pdf')
+        with override_settings(CRM_PROVIDER={'BASE_URL': ''}), self.assertLogs('crm.providers', 'WARNING'):
+            self.assertFalse(providers.send_invoice_whatsapp(invoice.id))
+
+    @override_settings(CRM_PROVIDER={'BASE_URL': ''})
+    def test_whatsapp_view_fails_without_a_provider(self):
+        customer = make_customer(phone_number='9876543210')
+        invoice = Invoice.objects.create(customer=customer, amount='75.00', receipt='receipts/r.pdf')
+        with mock.patch('crm.tasks.submit') as submit:
+            response = self.client.get(reverse('send_invoice_whatsapp', args=[customer.id, invoice.id]))
+        self.assertEqual(response.json(), {'success': False, 'message': 'No WhatsApp provider is configured.'})
+        submit.assert_not_called()
+
+    @override_settings(CRM_PROVIDER={'BASE_URL': ''})
+    def test_dispatcher_without_a_provider_leaves_messages_unsent(self):
+        message = make_message(make_customer(), days=-1)
+        with self.assertLogs('crm.dispatch', 'WARNING'):
+            self.assertEqual(dispatch.dispatch_due_messages(dispatch.ProviderBackend()), (0, 1))
+        message.refresh_from_db()
+        self.assertFalse(message.is_sent)
+
+
+class PerformanceMetricsTests(TestCase):
+    def setUp(self):
+        metrics.registry.reset()
+
+    def sample(self, text, name, **labels):
+        label_text = ','.join(f'{key}="{value}"' for key, value in labels.items())
+        match = re.search(rf'^{re.escape(name)}\{{{re.escape(label_text)}\}} (\S+)$', text, re.M)
+        return float(match.group(1)) if match else None
+
+    def test_requests_are_recorded_per_view(self):
+        make_customer()
+        self.client.get(reverse('customer_list'))
+        self.client.get(reverse('customer_list'))
+        self.client.get('/no-such-page/')
+
+        response = self.client.get(reverse('metrics'))
+        self.assertEqual(response['Content-Type'], 'text/plain; version=0.0.4; charset=utf-8')
+        text = response.content.decode()
+        self.assertEqual(self.sample(text, 'crm_requests_total', view='customer_list', method='GET', status='200'), 2)
+        self.assertEqual(self.sample(text, 'crm_requests_total', view='unmatched', method='GET', status='404'), 1)
+        self.assertEqual(self.sample(text, 'crm_request_duration_seconds_count', view='customer_list', method='GET'), 2)
+        # CustomerListTests pins the list page at 2 queries
+        self.assertEqual(self.sample(text, 'crm_request_db_queries_sum', view='customer_list', method='GET'), 4)
+        self.assertGreater(self.sample(text, 'crm_request_template_duration_seconds_sum', view='customer_list', method='GET'), 0)
+        self.assertGreater(self.sample(text, 'crm_response_size_bytes_sum', view='customer_list', method='GET'), 0)
+        self.assertEqual(
+            self.sample(text, 'crm_request_db_queries_bucket', view='customer_list', method='GET', le='+Inf'), 2
+        )
+
+    @override_settings(CRM_METRICS_ALLOWED_IPS=['10.0.0.5'])
+    def test_metrics_are_limited_to_allowed_addresses_and_staff(self):
+        url = reverse('metrics')
+        self.assertEqual(self.client.get(url).status_code, 403)
+        self.assertEqual(self.client.get(url, REMOTE_ADDR='10.0.0.5').status_code, 200)
+        self.client.force_login(User.objects.create_user('staff', is_staff=True))
+        self.assertEqual(self.client.get(url).status_code, 200)
+
+    @override_settings(CRM_SLOW_REQUEST_MS=0)
+    def test_slow_requests_are_logged_with_sql(self):
+        make_customer()
+        with self.assertLogs('crm.slow_requests', 'WARNING') as logs:
+            self.client.get(reverse('customer_list'))
+        self.assertIn('(customer_list)', logs.output[0])
+        self.assertIn('2 queries', logs.output[0])
+        self.assertIn('SELECT', logs.output[0])
+
+
+class BenchmarkTests(MediaRootMixin, TestCase):
+    def test_seed_creates_related_rows(self):
+        counts = seeding.seed(customers=30, invoices_per_customer=2, messages_per_customer=3,
+                              batch_size=10, random_seed=1)
+        self.assertEqual(counts, {'customers': 30, 'invoices': 60, 'messages': 90})
+        self.assertEqual(Customer.objects.filter(treatment__isnull=True).count(), 0)
+        self.assertTrue(Invoice.objects.first().receipt.read().startswith(b'%PDF'))
+        # The denormalized schedule columns are maintained by bulk_create
+        self.assertEqual(
+            Customer.objects.filter(has_pending_message=True).count(),
+            MessageSchedule.objects.filter(is_sent=False).values('customer').distinct().count(),
+        )
+        self.assertTrue(Customer.objects.filter(name__icontains=Customer.objects.first().name.split()[1]).exists())
+
+    def test_benchmark_reports_percentiles_and_leaves_no_rows(self):
+        seeding.seed(customers=5, invoices_per_customer=1, messages_per_customer=1, random_seed=1)
+        invoices, messages = Invoice.objects.count(), MessageSchedule.objects.count()
+        out = StringIO()
+        call_command('benchmark_crm', iterations=3, warmup=1, stdout=out)
+        report = json.loads(out.getvalue())
+
+        self.assertEqual(report['customers'], 5)
+        self.assertEqual(set(report['results']), {
+            'customer_list', 'customer_list_search', 'customer_detail', 'invoice_create', 'message_schedule',
+        })
+        for result in report['results'].values():
+            self.assertLessEqual(result['p50_ms'], result['p99_ms'])
+            self.assertGreater(result['queries_max'], 0)
+            self.assertIn(result['statuses'], [[200], [302]])
+        self.assertEqual((Invoice.objects.count(), MessageSchedule.objects.count()), (invoices, messages))
+
+    def test_percentile_interpolates(self):
+        self.assertEqual(benchmarks.percentile([1, 2, 3, 4], 50), 2.5)
+        self.assertEqual(benchmarks.percentile([1, 2, 3, 4], 100), 4)
+
+
+class CustomerRowCacheTests(TestCase):
+    def setUp(self):
+        cache.clear()
+        metrics.registry.reset()
+        self.customer = make_customer(name='Asha Rao')
+
+    def rows(self):
+        return self.client.get(reverse('customer_list')).content.decode()
+
+    def fragment_counts(self):
+        return dict(metrics.registry.fragments.series)
+
+    def test_unchanged_rows_are_served_from_the_cache(self):
+        for i in range(3):
+            make_customer(name=f'Patient {i}')
+        self.rows()
+        self.assertEqual(self.fragment_counts(), {('hit',): 0, ('miss',): 4})
+        with mock.patch('crm.caching.render_to_string') as render:
+            html = self.rows()
+        render.assert_not_called()
+        self.assertEqual(self.fragment_counts(), {('hit',): 4, ('miss',): 4})
+        self.assertIn('Asha Rao', html)
+        # The delete form is outside the fragment and keeps its own CSRF token
+        self.assertEqual(html.count('name="csrfmiddlewaretoken"'), 4)
+
+    def test_row_fragment_is_well_formed(self):
+        self.customer.next_message_id = None
+        html = caching.attach_customer_rows([self.customer])[0].row_html
+        self.assertEqual(html.count('<div'), html.count('</div>'))
+        self.assertEqual(html.count('<a '), html.count('</a>'))
+
+    def test_customer_edit_replaces_its_row(self):
+        self.rows()
+        self.customer.name = 'Asha Menon'
+        self.customer.save()
+        html = self.rows()
+        self.assertIn('Asha Menon', html)
+        self.assertNotIn('Asha Rao', html)
+
+    def test_message_changes_replace_the_row(self):
+        self.rows()
+        message = make_message(self.customer)
+        self.assertIn(f'data-message-id="{message.id}"', self.rows())
+
+        # Bulk update path (the dispatcher marking messages sent)
+        MessageSchedule.objects.filter(id=message.id).update(is_sent=True)
+        self.assertNotIn('data-message-id=', self.rows())
+
+
+class ConditionalGetTests(TestCase):
+    def setUp(self):
+        self.customer = make_customer()
+
+    def revalidate(self, url, response, **headers):
+        return self.client.get(url, HTTP_IF_NONE_MATCH=response['ETag'], **headers)
+
+    def test_unchanged_list_is_not_modified(self):
+        url = reverse('customer_list')
+        # The first visit sets the CSRF cookie, which is part of the ETag
+        self.client.get(url)
+        response = self.client.get(url)
+        self.assertTrue(response['ETag'].startswith('W/"'))
+        self.assertIn('no-cache', response['Cache-Control'])
+        # Only the ETag aggregate runs
+        with self.assertNumQueries(1):
+            response = self.revalidate(url, response)
+        self.assertEqual(response.status_code, 304)
+
+    def test_list_changes_invalidate_the_etag(self):
+        url = reverse('customer_list')
+        first = self.client.get(url)
+        make_message(self.customer, days=2)
+        second = self.revalidate(url, first)
+        self.assertEqual(second.status_code, 200)
+
+        # Bulk updates move updated_at as well
+        MessageSchedule.objects.update(is_reminder_sent=True)
+        self.assertEqual(self.revalidate(url, second).status_code, 200)
+
+    def test_reminder_falling_due_keeps_the_list(self):
+        # Due reminders are pushed by the event stream, not part of the page
+        url = reverse('customer_list')
+        make_message(self.customer, days=1)
+        self.client.get(url)
+        response = self.client.get(url)
+        with mock.patch('django.utils.timezone.now', return_value=timezone.now() + timedelta(days=2)):
+            self.assertEqual(self.revalidate(url, response).status_code, 304)
+
+    def test_detail_etag_and_last_modified(self):
+        url = reverse('customer_detail', args=[self.customer.id])
+        response = self.client.get(url)
+        self.assertEqual(self.revalidate(url, response).status_code, 304)
+        response = self.client.get(url, HTTP_IF_MODIFIED_SINCE=response['Last-Modified'])
+        self.assertEqual(response.status_code, 304)
+
+        invoice = Invoice.objects.create(customer=self.customer, amount='10.00', receipt='receipts/r.pdf')
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+        response = self.client.get(url)
+        invoice.delete()
+        self.assertEqual(self.revalidate(url, response).status_code, 200)
+
+    def test_pending_flash_message_is_rendered(self):
+        url = reverse('customer_list')
+        response = self.client.get(url)
+        self.client.post(reverse('message_schedule', args=[self.customer.id]), {
+            'customer': self.customer.id, 'message_content': 'Hi', 'message_type': 'SMS', 'days_from_today': 1,
+        })
+        response = self.revalidate(url, response)
+        self.assertContains(response, 'Message scheduled successfully!')
+
+    def test_unknown_customer_is_404(self):
+        self.assertEqual(self.client.get(reverse('customer_detail', args=[999])).status_code, 404)
+
+
+class ReceiptStorageTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.customer = make_customer()
+        self.content = b'%PDF-1.4 ' + bytes(range(256)) * 40
+
+    def create_invoice(self, content=None, name='receipt.pdf'):
+        upload = SimpleUploadedFile(name, content or self.content, content_type='application/pdf')
+        return Invoice.objects.create(customer=self.customer, amount='10.00', receipt=upload)
+
+    def test_identical_receipts_are_stored_once(self):
+        first = self.create_invoice()
+        second = self.create_invoice(name='copy.PDF')
+        digest = hashlib.sha256(self.content).hexdigest()
+        self.assertEqual(first.receipt.name, f'receipts/{digest[:2]}/{digest}.pdf')
+        self.assertEqual(second.receipt.name, first.receipt.name)
+        self.assertEqual(storage.references(first.receipt.name), 2)
+
+        # The blob outlives the first invoice and goes with the last one
+        path = first.receipt.path
+        with self.captureOnCommitCallbacks(execute=True):
+            first.delete()
+        self.assertTrue(os.path.exists(path))
+        with self.captureOnCommitCallbacks(execute=True):
+            second.delete()
+        self.assertFalse(os.path.exists(path))
+
+    def test_upload_restores_a_blob_deleted_by_a_concurrent_release(self):
+        first = self.create_invoice()
+        path = first.receipt.path
+        with self.captureOnCommitCallbacks() as deletes:
+            first.delete()
+        with self.captureOnCommitCallbacks() as uploads:
+            second = self.create_invoice()
+        self.assertEqual(second.receipt.name, first.receipt.name)
+
+        # The delete commits first and does not see the upload's uncommitted row yet
+        with mock.patch('crm.storage.references', return_value=0):
+            for callback in deletes:
+                callback()
+        self.assertFalse(os.path.exists(path))
+        for callback in uploads:
+            callback()
+        with open(path, 'rb') as file:
+            self.assertEqual(file.read(), self.content)
+
+    def test_download_supports_ranges_and_revalidation(self):
+        invoice = self.create_invoice()
+        url = reverse('receipt_download', args=[invoice.id])
+
+        response = self.client.get(url)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+        self.assertEqual(response['Accept-Ranges'], 'bytes')
+        self.assertEqual(response['Cache-Control'], 'private, no-cache')
+        self.assertIn(f'invoice-{invoice.id}.pdf', response['Content-Disposition'])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=100-199')
+        self.assertEqual(response.status_code, 206)
+        self.assertEqual(response['Content-Range'], f'bytes 100-199/{len(self.content)}')
+        self.assertEqual(b''.join(response.streaming_content), self.content[100:200])
+
+        response = self.client.get(url, HTTP_RANGE='bytes=-10')
+        self.assertEqual(b''.join(response.streaming_content), self.content[-10:])
+
+        response = self.client.get(url, HTTP_RANGE=f'bytes={len(self.content)}-')
+        self.assertEqual(response.status_code, 416)
+
+        # A last position before the first makes the header invalid, not unsatisfiable
+        response = self.client.get(url, HTTP_RANGE='bytes=5-3')
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), self.content)
+
+        # A stale If-Range gets the whole file
+        response = self.client.get(url, HTTP_RANGE='bytes=0-9', HTTP_IF_RANGE='"other"')
+        self.assertEqual(response.status_code, 200)
+
+        etag = self.client.get(url)['ETag']
+        self.assertEqual(self.client.get(url, HTTP_IF_NONE_MATCH=etag).status_code, 304)
+
+        # A replaced receipt is served at the same URL, so the cached copy must not be reused
+        replacement = self.create_invoice(content=b'%PDF-1.4 replaced')
+        Invoice.objects.filter(id=invoice.id).update(receipt=replacement.receipt.name)
+        response = self.client.get(url, HTTP_IF_NONE_MATCH=etag)
+        self.assertEqual(response.status_code, 200)
+        self.assertEqual(b''.join(response.streaming_content), b'%PDF-1.4 replaced')
+
+    @override_settings(CRM_SENDFILE='x-accel-redirect', CRM_SENDFILE_PREFIX='/protected/')
+    def test_download_can_be_offloaded(self):
+        invoice = self.create_invoice()
+        response = self.client.get(reverse('receipt_download', args=[invoice.id]))
+        self.assertEqual(response['X-Accel-Redirect'], '/protected/' + invoice.receipt.name)
+        self.assertEqual(response.content, b'')
+
+    def test_processing_receipt_is_not_downloadable(self):
+        invoice = self.create_invoice()
+        Invoice.objects.filter(id=invoice.id).update(receipt_status=Invoice.RECEIPT_PROCESSING)
+        self.assertEqual(self.client.get(reverse('receipt_download', args=[invoice.id])).status_code, 404)
+
+
+class RevenueRollupTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.physio, self.cupping, self.hijama = (
+            Treatment.objects.create(name=name) for name in ('Physiotherapy', 'Cupping Therapy', 'Hijama')
+        )
+        self.alice = make_customer('Alice')
+        self.alice.treatment.set([self.physio, self.cupping])
+        self.bob = make_customer('Bob')
+        self.bob.treatment.set([self.physio])
+
+    def invoice(self, customer, amount, days_ago=0):
+        invoice = Invoice.objects.create(customer=customer, amount=amount, receipt='receipts/r.pdf')
+        if days_ago:
+            invoice.date_created -= timedelta(days=days_ago)
+            invoice.save()
+        return invoice
+
+    def snapshot(self):
+        return (
+            set(DailyRevenue.objects.filter(invoice_count__gt=0).values_list('day', 'invoice_count', 'amount')),
+            set(DailyTreatmentRevenue.objects.filter(invoice_count__gt=0).values_list('day', 'treatment', 'invoice_count', 'amount')),
+            set(CustomerRevenue.objects.filter(invoice_count__gt=0).values_list('customer', 'invoice_count', 'amount')),
+        )
+
+    def assertMatchesRebuild(self):
+        incremental = self.snapshot()
+        rollups.rebuild()
+        self.assertEqual(incremental, self.snapshot())
+
+    def test_incremental_rollups_match_a_rebuild(self):
+        first = self.invoice(self.alice, '100.00')
+        second = self.invoice(self.alice, '50.50', days_ago=40)
+        third = self.invoice(self.bob, '20.00')
+        today = timezone.localdate()
+        self.assertEqual(DailyRevenue.objects.get(day=today).amount, Decimal('120.00'))
+        self.assertEqual(DailyTreatmentRevenue.objects.get(day=today, treatment=self.physio).invoice_count, 2)
+        self.assertEqual(CustomerRevenue.objects.get(customer=self.alice).amount, Decimal('150.50'))
+        self.assertMatchesRebuild()
+
+        first.amount = Decimal('75.00')
+        first.save()
+        second.customer = self.bob
+        second.save()
+        third.delete()
+        self.assertMatchesRebuild()
+
+        # Treatment changes move the customer's revenue, from either side of the relation
+        self.alice.treatment.remove(self.cupping, self.hijama)
+        self.bob.treatment.add(self.hijama)
+        self.cupping.customer_set.add(self.bob)
+        self.physio.customer_set.clear()
+        self.assertMatchesRebuild()
+
+        self.bob.delete()
+        self.assertMatchesRebuild()
+        self.assertEqual(self.snapshot()[0], {(today, 1, Decimal('75.00'))})
+
+    def test_seeded_invoices_are_rolled_up(self):
+        seeding.seed(customers=20, invoices_per_customer=3, messages_per_customer=0, batch_size=7, random_seed=3)
+        self.assertEqual(DailyRevenue.objects.get().invoice_count, 60)
+        self.assertMatchesRebuild()
+
+    def test_dashboard_reads_only_the_rollups(self):
+        self.invoice(self.alice, '100.00')
+        self.invoice(self.bob, '20.00', days_ago=400)
+        with CaptureQueriesContext(connection) as queries:
+            response = self.client.get(reverse('revenue_dashboard'))
+        self.assertEqual(response.status_code, 200)
+        self.assertFalse([query for query in queries if 'crm_invoice' in query['sql']])
+        report = response.context['report']
+        self.assertEqual(report['total'], {'invoices': 2, 'revenue': Decimal('120.00')})
+        self.assertEqual(len(report['months']), 2)
+        self.assertEqual(report['customers'][0].customer, self.alice)
+
+        since = (timezone.localdate() - timedelta(days=30)).isoformat()
+        report = self.client.get(reverse('revenue_dashboard'), {'date_from': since}).context['report']
+        self.assertEqual(report['total'], {'invoices': 1, 'revenue': Decimal('100.00')})
+        self.assertEqual(
+            [(row['treatment__name'], row['revenue']) for row in report['treatments']],
+            [('Cupping Therapy', Decimal('100.00')), ('Physiotherapy', Decimal('100.00'))],
+        )
+
+
+class ReplicaRoutingTests(TestCase):
+    """A second SQLite file stands in for the read replica."""
+
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        # Added after the test runner set up its databases; a temporary file, not a test database
+        cls.replica_dir = tempfile.mkdtemp()
+        connections.settings['replica'] = {
+            **connections.settings['default'],
+            'NAME': os.path.join(cls.replica_dir, 'replica.sqlite3'),
+        }
+        cls.databases = cls.databases | {'replica'}
+        call_command('migrate', database='replica', verbosity=0)
+        # A distinct id, so the two databases never share a customer_list row cache key
+        Customer.objects.db_manager('replica').create(
+            id=1000, name='Replica Patient', email='r@example.com', phone_number='1', address='-',
+            problem='-', age=30, sex='M',
+        )
+
+    @classmethod
+    def tearDownClass(cls):
+        connections['replica'].close()
+        del connections['replica']
+        del connections.settings['replica']
+        del cls.databases
+        shutil.rmtree(cls.replica_dir, ignore_errors=True)
+        super().tearDownClass()
+
+    def setUp(self):
+        self.primary = make_customer('Primary Patient')
+        self.other = make_customer('Departing Patient')
+
+    def test_sqlite_pragmas_are_applied(self):
+        with connections['replica'].cursor() as cursor:
+            pragmas = {}
+            for name in ('journal_mode', 'synchronous', 'busy_timeout'):
+                cursor.execute(f'PRAGMA {name}')
+                pragmas[name] = cursor.fetchone()[0]
+        self.assertEqual(pragmas, {'journal_mode': 'wal', 'synchronous': 1, 'busy_timeout': 5000})
+
+    def test_reads_use_the_primary_without_a_replica(self):
+        response = self.client.get(reverse('customer_list'))
+        self.assertContains(response, 'Primary Patient')
+        self.assertNotContains(response, 'Replica Patient')
+
+    @override_settings(CRM_REPLICA_DATABASE='replica')
+    def test_read_only_views_use_the_replica(self):
+        response = self.client.get(reverse('customer_list'))
+        self.assertContains(response, 'Replica Patient')
+        self.assertNotContains(response, 'Primary Patient')
+        self.assertContains(self.client.get(reverse('customer_detail', args=[1000])), 'Replica Patient')
+        # Streaming exports read while the response is sent
+        export = b''.join(self.client.get(reverse('export_table', args=['customers'])).streaming_content)
+        self.assertIn(b'Replica Patient', export)
+
+        # Writes go to the primary and keep this client's reads there for a while
+        response = self.client.post(reverse('customer_delete', args=[self.other.id]))
+        self.assertFalse(Customer.objects.filter(id=self.other.id).exists())
+        self.assertIn(PIN_COOKIE, response.cookies)
+        response = self.client.get(reverse('customer_list'))
+        self.assertContains(response, 'Primary Patient')
+        self.assertNotContains(response, 'Replica Patient')
+
+        del self.client.cookies[PIN_COOKIE]
+        self.assertContains(self.client.get(reverse('customer_list')), 'Replica Patient')
+
+    @override_settings(CRM_REPLICA_DATABASE='replica')
+    def test_search_reads_the_replica(self):
+        response = self.client.get(reverse('customer_list'), {'search': 'Patient'})
+        self.assertEqual([c.id for c in response.context['customers']], [1000])
+        response = self.client.get(reverse('customer_list_feed'), {'search': 'Replica'})
+        self.assertIn('data-customer-id="1000"', response.json()['html'])
+
+
+@override_settings(CRM_REMINDER_POLL_SECONDS=0.01)
+class DueReminderStreamTests(TestCase):
+    def setUp(self):
+        self.customer = make_customer('Due Patient')
+        self.due = make_message(self.customer, days=-1)
+        make_message(self.customer, days=1)
+        make_message(self.customer, days=-1, is_reminder_sent=True)
+
+    def test_list_page_does_not_query_due_reminders(self):
+        with CaptureQueriesContext(connection) as queries:
+            self.client.get(reverse('customer_list'))
+        self.assertFalse([query for query in queries if 'is_reminder_sent' in query['sql']])
+
+    def test_wsgi_request_gets_a_snapshot_and_a_retry(self):
+        response = self.client.get(reverse('due_reminders_stream'))
+        self.assertEqual(response['Content-Type'], 'text/event-stream')
+        body = response.content.decode()
+        self.assertIn('retry: 10\nevent: snapshot\n', body)
+        data = json.loads(body.split('data: ')[1])
+        self.assertEqual([reminder['id'] for reminder in data], [self.due.id])
+        self.assertEqual(data[0]['customer'], 'Due Patient')
+
+    async def read_event(self, stream):
+        while True:
+            chunk = (await asyncio.wait_for(anext(stream), 5)).decode()
+            if not chunk.startswith(':'):
+                name = re.search(r'^event: (\w+)$', chunk, re.M).group(1)
+                return name, json.loads(re.search(r'^data: (.*)$', chunk, re.M).group(1))
+
+    async def test_pages_share_one_poller_and_receive_changes(self):
+        url = reverse('due_reminders_stream')
+        first = (await self.async_client.get(url)).streaming_content
+        second = (await self.async_client.get(url)).streaming_content
+        name, snapshot = await self.read_event(first)
+        self.assertEqual((name, [reminder['id'] for reminder in snapshot]), ('snapshot', [self.due.id]))
+        await self.read_event(second)
+
+        hub = reminders.get_hub()
+        self.assertEqual(len(hub.subscribers), 2)
+        poller = hub.task
+
+        later = await MessageSchedule.objects.acreate(
+            customer=self.customer, message_content='Now due', message_type='SMS',
+            schedule_date=timezone.now() - timedelta(minutes=1),
+        )
+        for stream in (first, second):
+            name, update = await self.read_event(stream)
+            self.assertEqual((name, [reminder['id'] for reminder in update['added']]), ('update', [later.id]))
+
+        await MessageSchedule.objects.filter(id=self.due.id).aupdate(is_reminder_sent=True)
+        for stream in (first, second):
+            self.assertEqual(await self.read_event(stream), ('update', {'added': [], 'removed': [self.due.id]}))
+        self.assertIs(hub.task, poller)
+
+        # Deleting the customer removes its reminders before the purge does
+        await Customer.objects.filter(id=self.customer.id).aupdate(deleted_at=timezone.now())
+        for stream in (first, second):
+            self.assertEqual(await self.read_event(stream), ('update', {'added': [], 'removed': [later.id]}))
+
+        # A disconnect cancels the task sending the response (as the ASGI handler does)
+        for stream in (first, second):
+            reader = asyncio.ensure_future(anext(stream))
+            await asyncio.sleep(0.05)
+            reader.cancel()
+            with self.assertRaises(asyncio.CancelledError):
+                await reader
+        self.assertFalse(hub.subscribers)
+        await asyncio.wait_for(poller, 5)
+
+
+class ReminderAcknowledgeTests(TestCase):
+    def setUp(self):
+        customer = make_customer()
+        self.due = [make_message(customer, days=-1) for _ in range(3)]
+        self.future = make_message(customer, days=1)
+        self.done = make_message(customer, days=-2, is_reminder_sent=True)
+
+    def post(self, **data):
+        return self.client.post(reverse('mark_reminders_sent'), data, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+
+    def test_listed_reminders_are_marked_in_one_statement(self):
+        ids = [self.due[0].id, self.due[1].id, self.done.id]
+        with self.assertNumQueries(1):
+            response = self.post(message_ids=','.join(map(str, ids)))
+        # The already acknowledged one is not counted
+        self.assertEqual(response.json()['updated'], 2)
+        self.assertEqual(
+            set(MessageSchedule.objects.filter(is_reminder_sent=False).values_list('id', flat=True)),
+            {self.due[2].id, self.future.id},
+        )
+
+    def test_all_due_reminders_can_be_marked(self):
+        response = self.post(due_before=timezone.now().isoformat())
+        self.assertEqual(response.json()['updated'], 3)
+        self.assertFalse(MessageSchedule.objects.get(id=self.future.id).is_reminder_sent)
+
+    def test_invalid_requests_change_nothing(self):
+        self.assertIn('__all__', self.post().json()['errors'])
+        self.assertIn('message_ids', self.post(message_ids='1,x').json()['errors'])
+        self.assertEqual(self.client.get(reverse('mark_reminders_sent')).status_code, 405)
+        self.assertEqual(MessageSchedule.objects.filter(is_reminder_sent=True).count(), 1)
+
+    def test_single_reminder_is_one_update(self):
+        url = reverse('mark_reminder_sent', args=[self.due[0].id])
+        with self.assertNumQueries(1):
+            response = self.client.post(url, HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        self.assertTrue(response.json()['success'])
+        self.assertTrue(MessageSchedule.objects.get(id=self.due[0].id).is_reminder_sent)
+        self.assertEqual(self.client.post(reverse('mark_reminder_sent', args=[999])).status_code, 404)
+
+
+class PhoneNumberTests(TestCase):
+    def test_numbers_are_normalized_on_every_write(self):
+        self.assertEqual(phones.normalize('098765 43210'), '919876543210')
+        self.assertEqual(phones.normalize('+44 20 7946 0958'), '442079460958')
+        self.assertEqual(phones.normalize('0044 20 7946 0958'), '442079460958')
+        self.assertEqual(phones.normalize(''), '')
+
+        customer = make_customer(phone_number='98765 43210')
+        self.assertEqual((customer.phone_digits, customer.phone_digits_reversed), ('919876543210', '012345678919'))
+        customer.phone_number = '+1 555 0100'
+        customer.save()
+        self.assertEqual(Customer.objects.get(id=customer.id).phone_digits, '15550100')
+        bulk, = Customer.objects.bulk_create([Customer(
+            name='Bulk', email='b@example.com', phone_number='9876500000', address='-', problem='-', age=1, sex='M',
+        )])
+        self.assertEqual(Customer.objects.get(id=bulk.id).phone_digits, '919876500000')
+
+    @skipUnless(connection.vendor == 'sqlite', "EXPLAIN output checked here is SQLite's")
+    def test_phone_search_uses_the_indexes(self):
+        queryset = search.filter_customers(Customer.objects.all(), '98765')
+        plan = queryset.explain()
+        self.assertIn('phone_digits', plan)
+        self.assertNotIn('SCAN crm_customer', plan)
+
+    def customer_data(self, **overrides):
+        data = {
+            'name': 'New Patient', 'email': 'new@example.com', 'phone_number': '9876543210',
+            'address': '1 Road', 'problem': 'Back pain', 'age': 30, 'sex': 'F',
+            'treatment': [Treatment.objects.create(name='Physiotherapy').id],
+        }
+        data.update(overrides)
+        return data
+
+    def test_customer_form_warns_about_duplicates(self):
+        existing = make_customer('Existing', phone_number='+91 98765 43210', email='Same@Example.com')
+        response = self.client.post(reverse('customer_create'), self.customer_data(), HTTP_X_REQUESTED_WITH='XMLHttpRequest')
+        errors = response.json()['errors']
+        self.assertIn(f'#{existing.id}', errors['phone_number'][0])
+        self.assertNotIn('email', errors)
+
+        errors = self.client.post(
+            reverse('customer_create'), self.customer_data(phone_number='9000000000', email='same@example.com'),
+            HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        ).json()['errors']
+        self.assertEqual(list(errors), ['email'])
+
+        response = self.client.post(
+            reverse('customer_create'), self.customer_data(allow_duplicate='on'), HTTP_X_REQUESTED_WITH='XMLHttpRequest',
+        )
+        self.assertTrue(response.json()['success'])
+        self.assertEqual(Customer.objects.filter(phone_digits='919876543210').count(), 2)
+
+        # Editing a customer does not flag the customer itself
+        form = CustomerForm(self.customer_data(phone_number='9111111111', email='x@example.com'), instance=existing)
+        self.assertTrue(form.is_valid(), form.errors)
+
+    def test_duplicates_are_merged_into_the_oldest(self):
+        physio, cupping = Treatment.objects.create(name='Physiotherapy'), Treatment.objects.create(name='Cupping')
+        keeper = make_customer('First Visit', phone_number='9876543210', email='patient@example.com')
+        keeper.treatment.set([physio])
+        duplicate = make_customer('Second Visit', phone_number='+91 98765-43210', email='Patient@Example.com')
+        duplicate.treatment.set([cupping])
+        other = make_customer('Someone Else', phone_number='9000000000')
+        Invoice.objects.create(customer=keeper, amount='10.00', receipt='receipts/a.pdf')
+        Invoice.objects.create(customer=duplicate, amount='5.00', receipt='receipts/b.pdf')
+        make_message(duplicate, days=3)
+
+        out = StringIO()
+        call_command('merge_duplicate_customers', batch_size=1, stdout=out)
+        self.assertIn('Merged 1 duplicate customer(s)', out.getvalue())
+
+        self.assertEqual(set(Customer.objects.values_list('id', flat=True)), {keeper.id, other.id})
+        self.assertEqual(keeper.invoice_set.count(), 2)
+        self.assertEqual(set(keeper.treatment.all()), {physio, cupping})
+        keeper.refresh_from_db()
+        self.assertTrue(keeper.has_pending_message)
+        # The revenue rollups follow the invoices
+        incremental = (
+            set(DailyTreatmentRevenue.objects.filter(invoice_count__gt=0).values_list('day', 'treatment', 'invoice_count', 'amount')),
+            set(CustomerRevenue.objects.filter(invoice_count__gt=0).values_list('customer', 'invoice_count', 'amount')),
+        )
+        rollups.rebuild()
+        self.assertEqual(incremental, (
+            set(DailyTreatmentRevenue.objects.values_list('day', 'treatment', 'invoice_count', 'amount')),
+            set(CustomerRevenue.objects.values_list('customer', 'invoice_count', 'amount')),
+        ))
+
+
+    def test_household_sharing_a_phone_is_only_reported(self):
+        parent = make_customer('Asha Rao', phone_number='9876543210', email='asha@example.com')
+        again = make_customer('asha  RAO', phone_number='09876543210', email='')
+        child = make_customer('Kiran Rao', phone_number='+91 98765 43210', email='kiran@example.com')
+
+        out = StringIO()
+        call_command('merge_duplicate_customers', dry_run=True, stdout=out)
+        self.assertIn(f'#{parent.id} Asha Rao <asha@example.com> (kept)', out.getvalue())
+        self.assertIn(f'#{again.id} asha  RAO <-> (merged into #{parent.id})', out.getvalue())
+        self.assertIn(f'#{child.id} Kiran Rao <kiran@example.com> (review)', out.getvalue())
+        self.assertEqual(Customer.objects.count(), 3)
+
+        out = StringIO()
+        call_command('merge_duplicate_customers', stdout=out)
+        self.assertIn('Merged 1 duplicate customer(s) into 1 customer(s).', out.getvalue())
+        self.assertIn('1 phone number(s) are shared', out.getvalue())
+        self.assertIn(f'#{child.id} Kiran Rao <kiran@example.com>', out.getvalue())
+        self.assertEqual(set(Customer.objects.values_list('id', flat=True)), {parent.id, child.id})
+
+
+class CustomerDeletionTests(MediaRootMixin, TestCase):
+    def setUp(self):
+        super().setUp()
+        self.treatment = Treatment.objects.create(name='Physiotherapy')
+        self.customer = make_customer('Leaving Patient', phone_number='9876543210')
+        self.customer.treatment.set([self.treatment])
+        self.other = make_customer('Staying Patient', phone_number='9000000000')
+
+    def add_history(self, customer, invoices):
+        shared = SimpleUploadedFile('shared.pdf', b'%PDF-1.4 shared', content_type='application/pdf')
+        for i in range(invoices):
+            upload = SimpleUploadedFile(f'receipt{i}.pdf', b'%PDF-1.4 ' + str(i).encode(), content_type='application/pdf')
+            Invoice.objects.create(customer=customer, amount='10.00', receipt=upload)
+            make_message(customer, days=i + 1)
+        return Invoice.objects.create(customer=customer, amount='5.00', receipt=shared)
+
+    def test_delete_request_does_not_depend_on_the_history(self):
+        counts = []
+        for invoices in (1, 12):
+            customer = make_customer(f'Patient {invoices}')
+            self.add_history(customer, invoices)
+            with CaptureQueriesContext(connection) as queries:
+                response = self.client.post(reverse('customer_delete', args=[customer.id]))
+            self.assertRedirects(response, reverse('customer_list'), fetch_redirect_response=False)
+            counts.append(len(queries))
+        self.assertEqual(counts[0], counts[1])
+
+    def test_deleted_customer_is_hidden_until_purged(self):
+        self.add_history(self.customer, 2)
+        self.client.post(reverse('customer_delete', args=[self.customer.id]))
+
+        self.assertFalse(Customer.objects.filter(id=self.customer.id).exists())
+        self.assertTrue(Customer.all_objects.filter(id=self.customer.id, deleted_at__isnull=False).exists())
+        self.assertEqual(self.client.get(reverse('customer_detail', args=[self.customer.id])).status_code, 404)
+        detail_url = reverse('customer_detail', args=[self.customer.id])
+        response = self.client.get(reverse('customer_list'))
+        self.assertNotContains(response, detail_url)
+        self.assertContains(response, 'Staying Patient')
+        self.assertEqual(search.search_customer_ids('Leaving'), [])
+        self.assertNotContains(self.client.get(reverse('customer_list'), {'search': '98765'}), detail_url)
+        # Its messages are never sent in the meantime
+        self.assertEqual(dispatch.claim_due_messages(now=timezone.now() + timedelta(days=30)), [])
+
+    def test_deleted_customer_is_not_emailed_or_exported_before_the_purge(self):
+        self.add_history(self.customer, 2)
+        kept = Invoice.objects.create(customer=self.other, amount='7.00', receipt='receipts/kept.pdf')
+        make_message(self.other)
+        self.client.post(reverse('customer_delete', args=[self.customer.id]))
+
+        today = timezone.localdate()
+        self.assertEqual(list(mail.invoices_for(date_from=today, date_to=today)), [kept])
+        for table in ('customers', 'invoices', 'messages'):
+            rows = list(csv.reader(exports.stream_csv(table)))
+            self.assertEqual(len(rows), 2, table)
+            self.assertNotIn('Leaving Patient', ''.join(exports.stream_csv(table)))
+
+    def test_purge_deletes_the_history_and_unused_receipts(self):
+        shared = self.add_history(self.customer, 3)
+        kept = Invoice.objects.create(customer=self.other, amount='7.00', receipt=shared.receipt.name)
+        paths = [invoice.receipt.path for invoice in self.customer.invoice_set.all()]
+
+        with override_settings(CRM_PURGE_BATCH_SIZE=2), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('customer_delete', args=[self.customer.id]))
+
+        self.assertFalse(Customer.all_objects.filter(id=self.customer.id).exists())
+        self.assertFalse(Invoice.objects.filter(customer_id=self.customer.id).exists())
+        self.assertFalse(MessageSchedule.objects.filter(customer_id=self.customer.id).exists())
+        # Receipts another invoice still refers to stay
+        self.assertEqual([os.path.exists(path) for path in paths].count(True), 1)
+        self.assertTrue(os.path.exists(kept.receipt.path))
+        # The rollups no longer count the customer's invoices
+        self.assertEqual(rollups.report()['total'], {'invoices': 1, 'revenue': Decimal('7.00')})
+        self.assertFalse(DailyTreatmentRevenue.objects.filter(invoice_count__gt=0).exists())
+
+    def test_command_finishes_an_interrupted_purge(self):
+        self.add_history(self.customer, 2)
+        self.client.post(reverse('customer_delete', args=[self.customer.id]))
+
+        out = StringIO()
+        call_command('purge_deleted_customers', batch_size=1, stdout=out)
+        self.assertIn('Purged 1 deleted customer(s).', out.getvalue())
+        self.assertEqual(list(Customer.all_objects.values_list('name', flat=True)), ['Staying Patient'])
+        self.assertFalse(Invoice.objects.exists())
+
+
+class MessageArchiveTests(TestCase):
+    def setUp(self):
+        self.customer = make_customer()
+        self.old = [
+            make_message(self.customer, days=-200 - i, message_content=f'Old {i}', is_sent=True, is_reminder_sent=True)
+            for i in range(5)
+        ]
+        self.unacknowledged = make_message(self.customer, days=-200, is_sent=True)
+        self.recent = make_message(self.customer, days=-10, message_content='Recent', is_sent=True, is_reminder_sent=True)
+        self.pending = make_message(self.customer, days=3)
+
+    def test_command_moves_old_history_in_chunks(self):
+        out = StringIO()
+        with CaptureQueriesContext(connection) as queries:
+            call_command('archive_messages', days=90, chunk_size=2, stdout=out)
+        self.assertIn('Archived 5 message(s)', out.getvalue())
+        self.assertEqual(
+            sorted(ArchivedMessageSchedule.objects.values_list('id', flat=True)), sorted(m.id for m in self.old),
+        )
+        self.assertEqual(
+            set(MessageSchedule.objects.values_list('id', flat=True)),
+            {self.unacknowledged.id, self.recent.id, self.pending.id},
+        )
+        archived = ArchivedMessageSchedule.objects.get(id=self.old[0].id)
+        self.assertEqual((archived.customer, archived.message_content), (self.customer, 'Old 0'))
+        # One short transaction per chunk of 2: three chunks and the empty check
+        self.assertEqual(sum(query['sql'].startswith('SAVEPOINT') for query in queries.captured_queries), 4)
+
+        self.customer.refresh_from_db()
+        self.assertTrue(self.customer.has_pending_message)
+        call_command('archive_messages', days=90, stdout=StringIO())
+        self.assertEqual(ArchivedMessageSchedule.objects.count(), 5)
+
+    def test_detail_loads_history_on_demand(self):
+        archive.archive_messages(days=90)
+        # Nothing is read from the archive for the page itself
+        with self.assertNumQueries(5):
+            response = self.client.get(reverse('customer_detail', args=[self.customer.id]))
+        self.assertContains(response, reverse('customer_message_history', args=[self.customer.id]))
+        self.assertNotContains(response, 'Old 0')
+
+        response = self.client.get(reverse('customer_message_history', args=[self.customer.id]))
+        content = response.content.decode()
+        # Live and archived sent messages, newest first; pending ones are not history
+        self.assertLess(content.index('Recent'), content.index('Old 0'))
+        self.assertLess(content.index('Old 0'), content.index('Old 4'))
+        self.assertEqual(
+            {message['id'] for message in archive.customer_history(self.customer.id)},
+            {m.id for m in self.old} | {self.unacknowledged.id, self.recent.id},
+        )
+
+    def test_archived_messages_are_exported_and_purged(self):
+        archive.archive_messages(days=90)
+        rows = list(csv.reader(exports.stream_csv('messages')))
+        self.assertEqual(len(rows), 1 + 8)
+        self.assertEqual(rows[-1][5:7], ['True', 'True'])
+
+        with override_settings(CRM_TASKS_INLINE=True), self.captureOnCommitCallbacks(execute=True):
+            self.client.post(reverse('customer_delete', args=[self.customer.id]))
+        self.assertFalse(ArchivedMessageSchedule.objects.exists())
@@ -3,13 +3,26 @@ from . import views
 
 urlpatterns = [
     path('', views.customer_list, name='customer_list'),
+    path('customer/feed/', views.customer_list_feed, name='customer_list_feed'),
     path('customer/create/', views.customer_create, name='customer_create'),
+    path('customer/import/', views.customer_import, name='customer_import'),
     path('customer/<int:customer_id>/', views.customer_detail, name='customer_detail'),
+    path('customer/<int:customer_id>/history/', views.customer_message_history, name='customer_message_history'),
     path('customer/update/<int:customer_id>/', views.customer_update, name='customer_update'),
     path('customer/delete/<int:customer_id>/', views.customer_delete, name='customer_delete'), 
     path('invoice/create/<int:customer_id>/', views.invoice_create, name='invoice_create'),
+    path('invoice/<int:invoice_id>/receipt/', views.receipt_download, name='receipt_download'),
+    path('invoice/<int:invoice_id>/status/', views.invoice_receipt_status, name='invoice_receipt_status'),
     path('invoice/send_whatsapp/<int:customer_id>/<int:invoice_id>/', views.send_invoice_whatsapp, name='send_invoice_whatsapp'),
     path('invoice/send_email/<int:customer_id>/<int:invoice_id>/', views.send_invoice_email, name='send_invoice_email'),
+    path('invoice/send_email/bulk/', views.send_invoice_email_bulk, name='send_invoice_email_bulk'),
     path('message/schedule/<int:customer_id>/', views.message_schedule, name='message_schedule'),
+    path('campaigns/', views.campaign_list, name='campaign_list'),
+    path('campaigns/create/', views.campaign_create, name='campaign_create'),
+    path('revenue/', views.revenue_dashboard, name='revenue_dashboard'),
+    path('export/<str:table>/', views.export_table, name='export_table'),
+    path('reminders/due/stream/', views.due_reminders_stream, name='due_reminders_stream'),
     path('mark-reminder-sent/<int:message_id>/', views.mark_reminder_sent, name='mark_reminder_sent'),
+    path('mark-reminders-sent/', views.mark_reminders_sent, name='mark_reminders_sent'),
+    path('metrics', views.metrics_view, name='metrics'),
 ]
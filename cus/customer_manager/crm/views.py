@@ -1,18 +1,28 @@
+from asgiref.sync import sync_to_async
+from django.core.handlers.asgi import ASGIRequest
 from django.shortcuts import render, redirect, get_object_or_404
-from django.http import JsonResponse
+from django.conf import settings
+from django.template.loader import render_to_string
+from django.http import Http404, HttpResponse, HttpResponseForbidden, JsonResponse, StreamingHttpResponse
 from django.utils import timezone
-from django.db.models import Min, Q, Case, When, Value, BooleanField
-from .models import Customer, Invoice, MessageSchedule
-from .forms import CustomerForm, InvoiceForm, MessageScheduleForm
-from threading import Timer
+from django.db.models import OuterRef, Subquery
+from .models import Campaign, Customer, Invoice, MessageSchedule
+from .forms import (
+    CampaignForm, CustomerForm, CustomerImportUploadForm, DateRangeForm, InvoiceEmailBulkForm, InvoiceForm, MessageScheduleForm,
+    ReminderAcknowledgeForm,
+)
+from . import (
+    archive, caching, campaigns, conditional, downloads, exports, importers, mail, metrics, providers, purge, receipts,
+    reminders, rollups, search, tasks,
+)
+from .pagination import InvalidCursor, paginate_customers, paginate_search
+from .routers import use_replica
+import os
 from datetime import timedelta
 from django.urls import reverse
-from django.core.mail import send_mail
+from django.views.decorators.http import require_POST
 from django.contrib import messages
 from PIL import Image
-import os
-from django.core.files.base import ContentFile
-from io import BytesIO
 
 # 1. Customer Create View (Updated to Include Message Scheduling)
 def customer_create(request):
@@ -55,8 +65,14 @@ def customer_create(request):
                 return JsonResponse({'success': False, 'errors': form.errors})
 
     else:
-        # If GET request, display an empty form
+        # If GET request, display an empty form (its fields are pre-rendered and cached)
         form = CustomerForm()
+        return render(request, 'crm/form.html', {
+            'form': form,
+            'form_fields_html': caching.empty_customer_form_html(),
+            'title': 'Add Customer',
+            'form_action_url': reverse('customer_create')
+        })
     return render(request, 'crm/form.html', {
         'form': form,
         'title': 'Add Customer',
@@ -65,6 +81,43 @@ def customer_create(request):
 
     # Render the customer creation form
 
+# Bulk Customer Import (CSV/XLSX upload)
+def customer_import(request):
+    if request.method == 'POST':
+        form = CustomerImportUploadForm(request.POST, request.FILES)
+        if form.is_valid():
+            upload = form.cleaned_data['file']
+            rejects = []
+
+            def on_reject(line_number, errors):
+                # Only the first rejects are returned; the counts cover the whole file
+                if len(rejects) < 100:
+                    rejects.append({'line': line_number, 'errors': errors})
+
+            try:
+                result = importers.import_customers(
+                    importers.read_rows(upload.file, importers.detect_format(upload.name)),
+                    batch_size=getattr(settings, 'CRM_IMPORT_BATCH_SIZE', 500),
+                    on_reject=on_reject,
+                )
+            except ValueError as e:
+                form.add_error('file', str(e))
+            else:
+                message = f"Imported {result['created']} customer(s), rejected {result['rejected']} row(s)."
+                if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+                    return JsonResponse({'success': True, 'message': message, **result, 'rejects': rejects})
+                messages.success(request, message)
+                return redirect('customer_list')
+        if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+            return JsonResponse({'success': False, 'errors': form.errors})
+    else:
+        form = CustomerImportUploadForm()
+    return render(request, 'crm/form.html', {
+        'form': form,
+        'title': 'Import Customers',
+        'form_action_url': reverse('customer_import'),
+    })
+
 # 2. Invoice Create View (Updated for Modern AJAX Handling)
 def invoice_create(request, customer_id):
     customer = get_object_or_404(Customer, id=customer_id)
@@ -74,34 +127,26 @@ def invoice_create(request, customer_id):
             invoice = form.save(commit=False)
             invoice.customer = customer
 
-            # Handle the receipt file - convert image to PDF if needed
+            # Store the receipt as uploaded. Images are converted to PDF in the background.
             uploaded_file = form.cleaned_data['receipt']
             if uploaded_file.content_type.startswith('image'):
-                # Convert image to PDF using Pillow
+                # Only the image header is read here; decoding happens in the worker
                 try:
-                    image = Image.open(uploaded_file)
-                    pdf_file = BytesIO()
-                    image.convert('RGB').save(pdf_file, format='PDF')
-
-                    # Construct a new ContentFile for the PDF
-                    pdf_file.seek(0)
-                    invoice.receipt.save(
-                        f"invoice_{invoice.customer.id}_{timezone.now().strftime('%Y%m%d%H%M%S')}.pdf",
-                        ContentFile(pdf_file.read()),
-                        save=False
-                    )
+                    Image.open(uploaded_file)
                 except Exception as e:
-                    form.add_error('receipt', f"Error converting image to PDF: {str(e)}")
+                    form.add_error('receipt', f"Error reading image: {str(e)}")
                     return render(request, 'crm/form.html', {
                         'form': form,
                         'customer': customer,
                         'title': 'Add Invoice'
                     })
-            else:
-                # Save the original PDF file if it's already a PDF
-                invoice.receipt = uploaded_file
+                uploaded_file.seek(0)
+                invoice.receipt_status = Invoice.RECEIPT_PROCESSING
+            invoice.receipt = uploaded_file
 
             invoice.save()  # Save the invoice to the database
+            if invoice.receipt_status == Invoice.RECEIPT_PROCESSING:
+                tasks.submit(receipts.convert_receipt, invoice.id)
             # Handle AJAX request success
             if request.headers.get('x-requested-with') == 'XMLHttpRequest':
                 return JsonResponse({'success': True, 'message': 'Invoice created successfully!'})
@@ -135,9 +180,7 @@ def message_schedule(request, customer_id):
             message.schedule_date = timezone.now() + timedelta(days=days_from_today)
             message.customer = customer  # Set the customer relationship
             message.save()  # Save the message schedule to the database
-
-            # Schedule the message to be sent
-            schedule_message_send(message)
+            # Sending is picked up by the dispatcher (manage.py dispatch_messages) once it is due
 
             # Handle AJAX request success response
             if request.headers.get('x-requested-with') == 'XMLHttpRequest':
@@ -174,28 +217,29 @@ def message_schedule(request, customer_id):
         'form_action_url': form_action_url,
     })
 
-# Function to Schedule Message Sending
-def schedule_message_send(message):
-    delay = (message.schedule_date - timezone.now()).total_seconds()
-    Timer(delay, send_message, [message]).start()
-
-# Function to Simulate Sending a Message
-def send_message(message):
-    # Simulating message sending
-    print(f"Sending {message.message_type} to {message.customer.phone_number}: {message.message_content}")
-    message.is_sent = True
-    message.save()
-
 # 4. Mark Reminder Sent (Updated for Modern AJAX Handling)
 def mark_reminder_sent(request, message_id):
-    message = get_object_or_404(MessageSchedule, id=message_id)
     if request.method == 'POST':
-        message.is_reminder_sent = True
-        message.save()
+        # One UPDATE of the flag (and updated_at) instead of loading and saving the whole row
+        if not MessageSchedule.objects.filter(id=message_id).update(is_reminder_sent=True):
+            raise Http404("No such message.")
         if request.headers.get('x-requested-with') == 'XMLHttpRequest':
             return JsonResponse({'success': True, 'message': 'Reminder marked as sent!'})
     return redirect('customer_list')
 
+# Mark many reminders as sent in one UPDATE (the "Mark all shown" button)
+@require_POST
+def mark_reminders_sent(request):
+    form = ReminderAcknowledgeForm(request.POST)
+    if not form.is_valid():
+        return JsonResponse({'success': False, 'errors': form.errors})
+    count = form.queryset().update(is_reminder_sent=True)
+    message = f"{count} reminder(s) marked as sent."
+    if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+        return JsonResponse({'success': True, 'message': message, 'updated': count})
+    messages.success(request, message)
+    return redirect('customer_list')
+
 # --------------------- NEW: Customer Update and Delete Views ---------------------
 def customer_update(request, customer_id):
     """Edit an existing Customer."""
@@ -222,11 +266,11 @@ def customer_update(request, customer_id):
     })
 
 def customer_delete(request, customer_id):
-    """Delete a Customer."""
+    """Delete a Customer (hidden at once, its history is purged in the background)."""
     customer = get_object_or_404(Customer, id=customer_id)
     if request.method == 'POST':
         customer_name = customer.name
-        customer.delete()
+        purge.soft_delete(customer.id)
         messages.success(request, f"Customer '{customer_name}' deleted successfully!")
         # If AJAX:
         if request.headers.get('x-requested-with') == 'XMLHttpRequest':
@@ -239,54 +283,87 @@ def customer_delete(request, customer_id):
     })
 
 # 5. Updated Customer List Function
-def customer_list(request):
-    # 1) Annotate each customer with earliest schedule date
-    customers = Customer.objects.annotate(
-        earliest_schedule_date=Min('messageschedule__schedule_date')
+def _customer_list_queryset():
+    """Customers in list order, annotated with what each row of the list shows."""
+    # 1) Sort by the denormalized next schedule date: customers with pending messages
+    #    first, soonest first, then everyone else. The id is a tie-breaker so the order
+    #    is total, which keyset pagination relies on.
+    customers = Customer.objects.order_by('-has_pending_message', 'next_schedule_date', 'id')
+
+    # 2) Annotate the earliest unsent message id to show "Mark as Done" (if needed).
+    #    Done as a correlated subquery so the page costs one query, not one per customer.
+    next_message = MessageSchedule.objects.filter(
+        customer=OuterRef('pk'), is_sent=False
+    ).order_by('schedule_date', 'id')
+    return customers.annotate(next_message_id=Subquery(next_message.values('id')[:1]))
+
+def _customer_list_page(search_query=None, cursor=None, page_size=50):
+    """``(customers, next_cursor)`` for one page of the list or of a search (name, phone, email or problem)."""
+    if not search_query:
+        return paginate_customers(_customer_list_queryset(), cursor=cursor, page_size=page_size)
+    # Searches show the best-ranked matches instead of the schedule order
+    ids, next_cursor = paginate_search(
+        lambda limit, offset: search.search_customer_ids(search_query, limit=limit, offset=offset),
+        cursor=cursor, page_size=page_size,
     )
+    rank = {pk: position for position, pk in enumerate(ids)}
+    customers = sorted(_customer_list_queryset().filter(id__in=ids), key=lambda c: rank[c.id])
+    return customers, next_cursor
 
-    # 2) Sort by earliest schedule date (those without schedules will have earliest_schedule_date=None)
-    # To put those with no schedules last, we can do a boolean sort:
-    customers = customers.annotate(
-        has_schedule=Case(
-            When(earliest_schedule_date__isnull=False, then=Value(True)),
-            default=Value(False),
-            output_field=BooleanField()
-        )
-    ).order_by('-has_schedule', 'earliest_schedule_date')
-
-    # 3) Search (by name or phone)
+@use_replica
+@conditional.conditional_page(conditional.customer_list_etag)
+def customer_list(request):
     search_query = request.GET.get('search')
-    if search_query:
-        customers = customers.filter(
-            Q(name__icontains=search_query) |
-            Q(phone_number__icontains=search_query)
-        )
+    page_size = getattr(settings, 'CUSTOMER_LIST_PAGE_SIZE', 50)
+    customers, next_cursor = _customer_list_page(search_query, page_size=page_size)
 
-    # 4) For each customer, get the earliest unsent message to show "Mark as Done" (if needed)
-    #    We'll store it in an attribute "next_message".
-    for c in customers:
-        c.next_message = (
-            MessageSchedule.objects.filter(customer=c, is_sent=False)
-            .order_by('schedule_date')
-            .first()
-        )
-
-    # 5) Retrieve due_messages for the "Due Reminders" section
-    now = timezone.now()
-    due_messages = MessageSchedule.objects.filter(
-        schedule_date__lte=now, is_reminder_sent=False, is_sent=False
-    )
+    # Rows come from the fragment cache; only changed customers are re-rendered
+    caching.attach_customer_rows(customers)
 
+    # Due reminders are pushed to the page by due_reminders_stream
     return render(request, 'crm/customer_list.html', {
         'customers': customers,
-        'due_messages': due_messages,
+        'next_cursor': next_cursor,
+        'max_acknowledge_ids': ReminderAcknowledgeForm.MAX_IDS,
         'search_query': search_query,  # to keep the search input in the template
     })
 
+# Server-Sent Events feed of the due reminders shown on the customer list (see crm.reminders)
+async def due_reminders_stream(request):
+    if isinstance(request, ASGIRequest):
+        response = StreamingHttpResponse(reminders.stream(), content_type='text/event-stream')
+    else:
+        # No long-lived streams under WSGI: send the snapshot and let the browser reconnect
+        snapshot = await sync_to_async(reminders.current_reminders)()
+        retry = int(reminders.poll_interval() * 1000)
+        response = HttpResponse(reminders.event('snapshot', snapshot, retry=retry), content_type='text/event-stream')
+    response['Cache-Control'] = 'no-cache'
+    # Stop nginx from buffering the stream
+    response['X-Accel-Buffering'] = 'no'
+    return response
+
+# JSON feed used by the customer list to load the next page on scroll
+@use_replica
+@conditional.conditional_page(conditional.customer_list_etag)
+def customer_list_feed(request):
+    search_query = request.GET.get('search')
+    page_size = getattr(settings, 'CUSTOMER_LIST_PAGE_SIZE', 50)
+    try:
+        customers, next_cursor = _customer_list_page(
+            search_query, cursor=request.GET.get('cursor'), page_size=page_size,
+        )
+    except InvalidCursor as e:
+        return JsonResponse({'success': False, 'message': str(e)}, status=400)
+
+    caching.attach_customer_rows(customers)
+    html = render_to_string('crm/customer_list_rows.html', {'customers': customers}, request=request)
+    return JsonResponse({'success': True, 'html': html, 'next_cursor': next_cursor})
+
 # Customer Detail
+@use_replica
+@conditional.conditional_page(conditional.customer_detail_etag, conditional.customer_detail_last_modified)
 def customer_detail(request, customer_id):
-    customer = get_object_or_404(Customer, id=customer_id)
+    customer = get_object_or_404(Customer.objects.prefetch_related('treatment'), id=customer_id)
     invoices = Invoice.objects.filter(customer=customer)
     messages = MessageSchedule.objects.filter(customer=customer, is_sent=False)  # Fetch unsent messages
     return render(request, 'crm/customer_detail.html', {
@@ -295,37 +372,133 @@ def customer_detail(request, customer_id):
         'messages': messages,
     })
 
+# Sent message history of a customer, loaded on demand by the detail page
+@use_replica
+def customer_message_history(request, customer_id):
+    customer = get_object_or_404(Customer, id=customer_id)
+    limit = 50
+    history = archive.customer_history(customer.id, limit=limit + 1)
+    return render(request, 'crm/message_history.html', {
+        'history': history[:limit],
+        'truncated': len(history) > limit,
+    })
+
+# Bulk Messaging Campaigns
+def campaign_create(request):
+    if request.method == 'POST':
+        form = CampaignForm(request.POST)
+        if form.is_valid():
+            campaign = form.save()
+            # Messages are generated in the background; progress shows on the campaign list
+            tasks.submit(campaigns.schedule_campaign, campaign.id)
+            if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+                return JsonResponse({'success': True, 'message': 'Campaign created, messages are being scheduled.'})
+            messages.success(request, f"Campaign '{campaign.name}' created, messages are being scheduled.")
+            return redirect('campaign_list')
+        if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+            return JsonResponse({'success': False, 'errors': form.errors})
+    else:
+        form = CampaignForm()
+    return render(request, 'crm/form.html', {
+        'form': form,
+        'title': 'New Campaign',
+        'form_action_url': reverse('campaign_create'),
+    })
+
+def campaign_list(request):
+    return render(request, 'crm/campaign_list.html', {
+        'campaigns': Campaign.objects.select_related('treatment').order_by('-created_at'),
+    })
+
+# Streaming CSV export of customers, invoices or messages
+@use_replica
+def export_table(request, table):
+    if table not in exports.EXPORTS:
+        raise Http404(f"Unknown export: {table}")
+    response = StreamingHttpResponse(exports.stream_csv(table), content_type='text/csv')
+    filename = f"{table}_{timezone.now().strftime('%Y%m%d%H%M%S')}.csv"
+    response['Content-Disposition'] = f'attachment; filename="{filename}"'
+    return response
+
+# Receipt status, polled by the customer detail page while a receipt is being converted
+def invoice_receipt_status(request, invoice_id):
+    invoice = get_object_or_404(Invoice, id=invoice_id)
+    return JsonResponse({
+        'success': True,
+        'status': invoice.receipt_status,
+        'receipt_url': (
+            reverse('receipt_download', args=[invoice.id]) if invoice.receipt_status == Invoice.RECEIPT_READY else None
+        ),
+    })
+
+# Receipt download (offloaded to the web server when CRM_SENDFILE is set)
+def receipt_download(request, invoice_id):
+    invoice = get_object_or_404(Invoice, id=invoice_id)
+    if not invoice.receipt or invoice.receipt_status != Invoice.RECEIPT_READY:
+        raise Http404("This invoice has no receipt to download.")
+    extension = os.path.splitext(invoice.receipt.name)[1]
+    return downloads.file_response(
+        request, invoice.receipt.storage, invoice.receipt.name, f"invoice-{invoice.id}{extension}"
+    )
+
 # Send Invoice via WhatsApp
 def send_invoice_whatsapp(request, customer_id, invoice_id):
     customer = get_object_or_404(Customer, id=customer_id)
     invoice = get_object_or_404(Invoice, id=invoice_id, customer=customer)
 
-    # Mockup for sending WhatsApp
-    phone_number = customer.phone_number
-    if len(phone_number) >= 10:
-        print(f"Sending WhatsApp message to {phone_number} with invoice details.")
-        # Here you would integrate with a WhatsApp API like Twilio or WhatsApp Business API.
-        message = f"Invoice #{invoice.id} Amount: ${invoice.amount} has been sent to you. Please find the receipt attached."
-        print(f"WhatsApp message content: {message}")
-        return JsonResponse({'success': True, 'message': 'Invoice sent via WhatsApp successfully.'})
+    # Sent through the provider client from the background pool, not the request thread
+    if providers.get_client() is None:
+        return JsonResponse({'success': False, 'message': 'No WhatsApp provider is configured.'})
+    if len(customer.phone_digits) >= 10:
+        tasks.submit(providers.send_invoice_whatsapp, invoice.id)
+        return JsonResponse({'success': True, 'message': 'Invoice WhatsApp message queued for sending.'})
     else:
         return JsonResponse({'success': False, 'message': 'Invalid phone number.'})
 
-# Send Invoice via Email
+# Send Invoice via Email (queued, sent from the background pool)
 def send_invoice_email(request, customer_id, invoice_id):
     customer = get_object_or_404(Customer, id=customer_id)
     invoice = get_object_or_404(Invoice, id=invoice_id, customer=customer)
+    tasks.submit(mail.send_invoices_job, customer_id=customer.id, invoice_id=invoice.id)
+    return JsonResponse({'success': True, 'message': 'Invoice email queued for sending.'})
 
-    # Sending Email using Django's send_mail function
-    subject = f"Invoice #{invoice.id} from Customer Management App"
-    message = (
-        f"Dear {customer.name},\n\nPlease find the details of your invoice.\n\n"
-        f"Invoice Amount: ${invoice.amount}\nDate: {invoice.date_created}\n\nThank you."
-    )
-    recipient_list = [customer.email]
+# Email all invoices for a date range and/or customer over one SMTP session
+def send_invoice_email_bulk(request):
+    if request.method == 'POST':
+        form = InvoiceEmailBulkForm(request.POST)
+        if form.is_valid():
+            filters = {
+                'customer_id': form.cleaned_data['customer'],
+                'date_from': form.cleaned_data['date_from'],
+                'date_to': form.cleaned_data['date_to'],
+            }
+            count = mail.invoices_for(**filters).count()
+            tasks.submit(mail.send_invoices_job, **filters)
+            message = f"{count} invoice email(s) queued for sending."
+            if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+                return JsonResponse({'success': True, 'message': message, 'queued': count})
+            messages.success(request, message)
+            return redirect('customer_list')
+        if request.headers.get('x-requested-with') == 'XMLHttpRequest':
+            return JsonResponse({'success': False, 'errors': form.errors})
+    else:
+        form = InvoiceEmailBulkForm(initial={'customer': request.GET.get('customer')})
+    return render(request, 'crm/form.html', {
+        'form': form,
+        'title': 'Email Invoices',
+        'form_action_url': reverse('send_invoice_email_bulk'),
+    })
 
-    try:
-        send_mail(subject, message, 'noreply@example.com', recipient_list)
-        return JsonResponse({'success': True, 'message': 'Invoice sent via email successfully.'})
-    except Exception as e:
-        return JsonResponse({'success': False, 'message': str(e)})
+# Revenue per month, treatment and customer, read from the rollups in crm.rollups
+@use_replica
+def revenue_dashboard(request):
+    form = DateRangeForm(request.GET or None)
+    filters = form.cleaned_data if form.is_valid() else {}
+    report = rollups.report(filters.get('date_from'), filters.get('date_to'))
+    return render(request, 'crm/revenue_dashboard.html', {'form': form, 'report': report})
+
+# Prometheus metrics collected by crm.middleware.PerformanceMetricsMiddleware
+def metrics_view(request):
+    if not metrics.allowed(request):
+        return HttpResponseForbidden()
+    return HttpResponse(metrics.registry.render(), content_type='text/plain; version=0.0.4; charset=utf-8')
@@ -43,6 +43,8 @@ INSTALLED_APPS = [
 ]
 
 MIDDLEWARE = [
+    'crm.middleware.PerformanceMetricsMiddleware',
+    'crm.middleware.ReplicaPinningMiddleware',
     'django.middleware.security.SecurityMiddleware',
     'django.contrib.sessions.middleware.SessionMiddleware',
     'django.middleware.common.CommonMiddleware',
@@ -56,7 +58,8 @@ ROOT_URLCONF = 'customer_manager.urls'
 
 TEMPLATES = [
     {
-        'BACKEND': 'django.template.backends.django.DjangoTemplates',
+        # DjangoTemplates, timing templates for the /metrics view
+        'BACKEND': 'crm.metrics.TimedDjangoTemplates',
         'DIRS': [],
         'APP_DIRS': True,
         'OPTIONS': {
@@ -80,9 +83,54 @@ DATABASES = {
     'default': {
         'ENGINE': 'django.db.backends.sqlite3',
         'NAME': BASE_DIR / 'db.sqlite3',
+        # Keep connections open between requests (seconds; 0 closes them after each
+        # request) and check them before reuse
+        'CONN_MAX_AGE': int(os.environ.get('CRM_DB_CONN_MAX_AGE', 600)),
+        'CONN_HEALTH_CHECKS': os.environ.get('CRM_DB_CONN_HEALTH_CHECKS', '1') != '0',
+        'OPTIONS': {
+            # Take the write lock when a transaction starts, so that busy_timeout applies
+            # instead of a read transaction failing to upgrade with "database is locked"
+            'transaction_mode': 'IMMEDIATE',
+        },
+    }
+}
+
+# Optional read replica for the read-only views (crm.routers). Any SQLite file kept in
+# step with the primary (e.g. by Litestream or a periodic backup) can stand in for one.
+if os.environ.get('CRM_REPLICA_DB'):
+    DATABASES['replica'] = {
+        **DATABASES['default'],
+        'NAME': os.environ['CRM_REPLICA_DB'],
+        'TEST': {'MIRROR': 'default'},
+    }
+CRM_REPLICA_DATABASE = 'replica' if 'replica' in DATABASES else None
+# Seconds a client's reads stay on the primary after it writes (replica lag)
+CRM_REPLICA_PIN_SECONDS = 5
+
+DATABASE_ROUTERS = ['crm.routers.ReplicaRouter']
+
+# SQLite connections get crm.db.DEFAULT_SQLITE_PRAGMAS; set CRM_SQLITE_PRAGMAS to override them
+
+
+# Cache
+# Holds the reference-data version and the customer list row fragments used by
+# crm.caching. Use a shared backend when running several worker processes so that
+# changes are seen by all of them: FileBasedCache on a single host, Redis or
+# Memcached otherwise.
+
+CACHES = {
+    'default': {
+        'BACKEND': 'django.core.cache.backends.locmem.LocMemCache',
+        'OPTIONS': {
+            # Two entries (version and fragment) per customer row
+            'MAX_ENTRIES': 20000,
+        },
     }
 }
 
+# Seconds a rendered customer_list row stays cached (rows are also replaced on change)
+CRM_ROW_CACHE_TIMEOUT = 86400
+
 
 # Password validation
 # https://docs.djangoproject.com/en/5.1/ref/settings/#auth-password-validators
@@ -144,3 +192,64 @@ BOOTSTRAP_DATEPICKER_PLUS = {
 
 MEDIA_ROOT = os.path.join(BASE_DIR, 'media')
 MEDIA_URL = '/media/'
+
+# Number of customers per page of the customer list / infinite-scroll feed
+CUSTOMER_LIST_PAGE_SIZE = 50
+
+# Scheduled message dispatcher (python manage.py dispatch_messages)
+CRM_MESSAGE_BACKEND = 'crm.dispatch.ProviderBackend'
+# Seconds after which a claimed but unfinished message may be claimed again
+CRM_DISPATCH_CLAIM_TIMEOUT = 600
+# Maximum messages sent per second by the dispatcher (None for no limit)
+CRM_DISPATCH_RATE = None
+
+# Seconds between checks for newly due reminders (one poller per server process, see crm.reminders)
+CRM_REMINDER_POLL_SECONDS = 5
+
+# Background worker pool (crm.tasks) for receipt conversion and other deferred work
+CRM_TASK_WORKERS = 2
+
+# Customers inserted per batch by the bulk import (view and import_customers command)
+CRM_IMPORT_BATCH_SIZE = 500
+
+# Sender address of invoice emails
+CRM_INVOICE_FROM_EMAIL = 'noreply@example.com'
+
+# Outbound SMS/WhatsApp provider (crm.providers). Nothing is sent while BASE_URL is
+# empty; `python manage.py runproviderstub` serves a local stand-in.
+CRM_PROVIDER = {
+    'BASE_URL': os.environ.get('CRM_PROVIDER_URL', ''),
+    'API_KEY': os.environ.get('CRM_PROVIDER_API_KEY', ''),
+    'BATCH_SIZE': 50,       # messages per API request
+    'RATE': 20,             # messages per second
+    'BURST': 50,
+    'MAX_RETRIES': 3,
+    'BACKOFF': 0.5,         # seconds, doubled on every retry
+    'TIMEOUT': 10,
+    'POOL_SIZE': 4,         # keep-alive connections
+    'FAILURE_THRESHOLD': 5, # failed batches before the circuit opens
+    'RESET_TIMEOUT': 30,    # seconds before the circuit is tried again
+}
+
+# Requests slower than this many milliseconds are logged with their SQL to the
+# crm.slow_requests logger (None to disable)
+CRM_SLOW_REQUEST_MS = None
+# Client addresses allowed to read /metrics (staff users always are). Behind a
+# reverse proxy, list the address Django sees in REMOTE_ADDR.
+CRM_METRICS_ALLOWED_IPS = ['127.0.0.1', '::1']
+
+# Receipt downloads: let the web server send the file instead of Django.
+# None, 'x-sendfile' (Apache/lighttpd) or 'x-accel-redirect' (nginx; CRM_SENDFILE_PREFIX
+# must be an internal location aliased to MEDIA_ROOT)
+CRM_SENDFILE = None
+CRM_SENDFILE_PREFIX = '/protected-media/'
+
+# Country code given to 10-digit national phone numbers when they are normalized (crm.phones)
+CRM_DEFAULT_COUNTRY_CODE = '91'
+
+# Rows deleted per transaction when a deleted customer's history is purged (crm.purge)
+CRM_PURGE_BATCH_SIZE = 500
+
+# Sent and acknowledged messages older than this many days are moved to the archive
+# table by `python manage.py archive_messages` (crm.archive)
+CRM_MESSAGE_RETENTION_DAYS = 90